@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del detector de IA
+
+Mide cada métrica de AIDetector (sobre un TextProfile compartido), la
+construcción del perfil y detect() completo, sobre corpus sintético y
+español real a 100, 1k, 10k y 100k palabras. Reporta tiempo, memoria
+asignada (tracemalloc) y el exponente de escalado de cada etapa, y guarda
+el resultado en JSON.
+
+Uso:
+    python bench_detector.py run --out bench.json
+    python bench_detector.py run --sizes 100,1000 --corpus-file tesis.txt --out bench.json
+    python bench_detector.py compare base.json bench.json --threshold 0.15
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from modules.ai_detector import AIDetector
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+# Párrafos de español real (académico, formal y coloquial) para el corpus "real"
+REAL_PARAGRAPHS = [
+    "La inteligencia artificial es fundamental para el desarrollo tecnológico moderno. "
+    "Mediante diversos algoritmos y técnicas de aprendizaje automático, es posible crear sistemas "
+    "que pueden realizar tareas complejas de manera eficiente. Además, estos sistemas son capaces "
+    "de mejorar continuamente su rendimiento a través del procesamiento de grandes cantidades de datos.",
+    "Mira, la verdad es que la IA está en todas partes ahora. O sea, literalmente no puedes escapar "
+    "de ella. El otro día estaba pensando... bueno, en realidad fue hace como una semana, que es súper "
+    "raro cómo las máquinas ahora pueden escribir textos que parecen humanos. Pero en fin, ¿no?",
+    "Según García (2019), el 85% de los estudiantes universitarios utiliza herramientas digitales "
+    "para preparar sus trabajos. Sin embargo, solo una minoría declara haber recibido formación "
+    "específica sobre su uso responsable, lo que plantea interrogantes sobre la integridad académica.",
+    "El río bajaba crecido aquel invierno. Nadie en el pueblo recordaba una crecida así desde 1962, "
+    "cuando el agua llegó hasta la plaza y se llevó el puente viejo. Mi abuela lo contaba siempre "
+    "igual: primero el ruido, luego el silencio, y al final el barro por todas partes.",
+    "En conclusión, resulta crucial considerar los múltiples factores que intervienen en el proceso. "
+    "Por lo tanto, es importante señalar que la implementación de soluciones integrales requiere un "
+    "enfoque significativo y extenso. Asimismo, cabe mencionar la relevancia de la evaluación continua.",
+    "¿Y si el problema no es la herramienta? Quizá lo que falla es cómo evaluamos. Un examen que se "
+    "puede aprobar copiando un párrafo generado en diez segundos dice más del examen que del alumno.",
+]
+
+SYNTHETIC_CONNECTORS = ["además", "sin embargo", "por lo tanto", "en conclusión", "asimismo", "o sea", "bueno"]
+
+
+def synthetic_corpus(words: int, seed: int = 13) -> str:
+    """Texto sintético con vocabulario Zipf, oraciones de longitud variable y párrafos"""
+    rnd = random.Random(seed)
+    vocabulary = [f"pal{i}" for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    tokens = rnd.choices(vocabulary, weights=weights, k=words)
+
+    paragraphs, sentence, paragraph = [], [], []
+    target = rnd.randint(5, 30)
+    for token in tokens:
+        if not sentence and rnd.random() < 0.15:
+            sentence.append(rnd.choice(SYNTHETIC_CONNECTORS).capitalize() + ",")
+        sentence.append(token)
+        if len(sentence) >= target:
+            paragraph.append(" ".join(sentence) + rnd.choice([".", ".", ".", "?", "!"]))
+            sentence, target = [], rnd.randint(5, 30)
+            if len(paragraph) >= rnd.randint(3, 7):
+                paragraphs.append(" ".join(paragraph))
+                paragraph = []
+    if sentence:
+        paragraph.append(" ".join(sentence) + ".")
+    if paragraph:
+        paragraphs.append(" ".join(paragraph))
+    return "\n\n".join(paragraphs)
+
+
+def real_corpus(words: int, paragraphs: List[str]) -> str:
+    """Repite párrafos reales (en orden rotado) hasta llegar al número de palabras"""
+    out, count, i = [], 0, 0
+    while count < words:
+        paragraph = paragraphs[i % len(paragraphs)]
+        remaining = words - count
+        paragraph_words = paragraph.split()
+        if len(paragraph_words) > remaining:
+            paragraph = " ".join(paragraph_words[:remaining]) + "."
+        out.append(paragraph)
+        count += min(len(paragraph_words), remaining)
+        i += 1
+    return "\n\n".join(out)
+
+
+def stage_functions(detector: AIDetector, text: str, language: str) -> Dict[str, Callable[[], object]]:
+    """Etapas medidas; las métricas comparten un perfil ya construido"""
+    profile = detector.build_profile(text)
+    detector._phrase_counts(profile)
+
+    def detect_cold():
+        detector.cache.clear()
+        return detector.detect(text, language)
+
+    return {
+        'build_profile': lambda: detector.build_profile(text),
+        'phrase_counts': lambda: detector.phrase_matcher.scan(profile.word_segments),
+        'perplexity': lambda: detector._calculate_perplexity(profile, language),
+        'burstiness': lambda: detector._calculate_burstiness(profile),
+        'sentence_variation': lambda: detector._calculate_sentence_variation(profile),
+        'vocabulary_diversity': lambda: detector._calculate_vocabulary_diversity(profile, language),
+        'pattern_score': lambda: detector._calculate_pattern_score(profile, language),
+        'readability': lambda: detector._calculate_readability(profile),
+        'repetition_score': lambda: detector._calculate_repetition_score(profile),
+        'connector_metrics': lambda: detector._connector_metrics(profile),
+        'clause_depth_variance': lambda: detector._clause_depth_variance(profile),
+        'detect': detect_cold,
+        'detect_cached': lambda: detector.detect(text, language),
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Tiempo (mínimo y mediana de `repeat` ejecuciones) y pico de memoria de una ejecución"""
+    fn()  # calentamiento
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'time_ms': round(min(times), 4),
+        'median_ms': round(statistics.median(times), 4),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+def scaling_exponents(results: Dict[str, Dict[str, Dict]]) -> Dict[str, Optional[float]]:
+    """Pendiente log-log tiempo/palabras por etapa (1.0 = lineal, 2.0 = cuadrático)"""
+    sizes = sorted(int(size) for size in results)
+    exponents: Dict[str, Optional[float]] = {}
+    if len(sizes) < 2:
+        return exponents
+    for stage in results[str(sizes[0])]:
+        xs, ys = [], []
+        for size in sizes:
+            value = results[str(size)][stage]['time_ms']
+            if value > 0:
+                xs.append(math.log(size))
+                ys.append(math.log(value))
+        exponents[stage] = round(float(np.polyfit(xs, ys, 1)[0]), 3) if len(xs) >= 2 else None
+    return exponents
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(args) -> Dict:
+    sizes = [int(s) for s in args.sizes.split(',')]
+    real_paragraphs = REAL_PARAGRAPHS
+    if args.corpus_file:
+        with open(args.corpus_file, encoding='utf-8') as f:
+            real_paragraphs = [p for p in f.read().split('\n\n') if p.strip()]
+
+    corpora = {
+        'synthetic': lambda n: synthetic_corpus(n),
+        'real': lambda n: real_corpus(n, real_paragraphs),
+    }
+    detector = AIDetector()
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'detector_version': AIDetector.DETECTOR_VERSION,
+            'language': args.language,
+            'repeat': args.repeat,
+            'sizes': sizes
+        },
+        'results': {},
+        'scaling': {}
+    }
+
+    for corpus_name, build in corpora.items():
+        report['results'][corpus_name] = {}
+        for size in sizes:
+            text = build(size)
+            # Menos repeticiones en tamaños grandes para acotar la duración
+            repeat = max(1, args.repeat if size <= 10000 else args.repeat // 3)
+            stages = stage_functions(detector, text, args.language)
+            report['results'][corpus_name][str(size)] = {
+                stage: measure(fn, repeat) for stage, fn in stages.items()
+            }
+            detect = report['results'][corpus_name][str(size)]['detect']
+            print(f"[Bench] {corpus_name:9s} {size:>7d} palabras  detect {detect['time_ms']:.2f} ms  "
+                  f"pico {detect['peak_kb']:.0f} KB")
+        report['scaling'][corpus_name] = scaling_exponents(report['results'][corpus_name])
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[Bench] Resultados guardados en {args.out}")
+    print_table(report)
+    return report
+
+
+def print_table(report: Dict):
+    for corpus_name, by_size in report['results'].items():
+        sizes = sorted(by_size, key=int)
+        print(f"\n{corpus_name} (ms)")
+        print(f"{'etapa':24s}" + "".join(f"{size:>12s}" for size in sizes) + f"{'escala':>9s}")
+        for stage in by_size[sizes[0]]:
+            row = "".join(f"{by_size[size][stage]['time_ms']:12.3f}" for size in sizes)
+            exponent = report['scaling'].get(corpus_name, {}).get(stage)
+            print(f"{stage:24s}{row}{(f'{exponent:9.2f}' if exponent is not None else '        -')}")
+
+
+def compare(args) -> int:
+    """Compara dos ejecuciones; devuelve 1 si alguna etapa empeora más del umbral"""
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+
+    regressions, improvements = [], []
+    for corpus_name, by_size in current['results'].items():
+        for size, stages in by_size.items():
+            base_stages = baseline['results'].get(corpus_name, {}).get(size)
+            if not base_stages:
+                continue
+            for stage, values in stages.items():
+                base = base_stages.get(stage)
+                if not base:
+                    continue
+                for field, floor in (('time_ms', args.min_ms), ('peak_kb', args.min_kb)):
+                    old, new = base[field], values[field]
+                    # Ignorar valores por debajo del ruido de medida
+                    if max(old, new) < floor or old <= 0:
+                        continue
+                    change = (new - old) / old
+                    entry = (corpus_name, size, stage, field, old, new, change)
+                    if change > args.threshold:
+                        regressions.append(entry)
+                    elif change < -args.threshold:
+                        improvements.append(entry)
+
+    for title, entries in (("Regresiones", regressions), ("Mejoras", improvements)):
+        print(f"\n{title} (umbral {args.threshold:.0%}): {len(entries)}")
+        for corpus_name, size, stage, field, old, new, change in entries:
+            print(f"  {corpus_name:9s} {size:>7s} {stage:24s} {field:8s} {old:12.3f} -> {new:12.3f}  ({change:+.1%})")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del detector de IA")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help="Ejecuta el barrido de tamaños")
+    run_parser.add_argument('--sizes', default=",".join(str(s) for s in DEFAULT_SIZES))
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--language', default='es')
+    run_parser.add_argument('--corpus-file', help="Corpus real propio (párrafos separados por línea en blanco)")
+    run_parser.add_argument('--out', help="Fichero JSON de salida")
+
+    compare_parser = sub.add_parser('compare', help="Compara dos ejecuciones JSON")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.15, help="Empeoramiento relativo tolerado")
+    compare_parser.add_argument('--min-ms', type=float, default=0.05, help="Ignorar tiempos menores (ruido)")
+    compare_parser.add_argument('--min-kb', type=float, default=16, help="Ignorar picos de memoria menores")
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
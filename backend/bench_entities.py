@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark adversarial del extractor de entidades
+
+Mide EntityExtractor.extract_and_freeze sobre entradas diseñadas para
+provocar backtracking (paréntesis sin cerrar, cadenas de dígitos,
+espacios...) y sobre texto aleatorio con los caracteres que usan los
+patrones (fuzzing con semilla), a varios tamaños. Reporta el tiempo, el
+exponente de escalado de cada familia y si alguna búsqueda agotó
+ENTITY_MATCH_TIMEOUT_MS. Sale con código 1 si alguna familia escala peor
+que --max-exponent o se interrumpe por tiempo.
+
+Uso:
+    python bench_entities.py
+    python bench_entities.py --sizes 1000,10000,100000 --fuzz-trials 200 --out entities.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from modules.entity_extractor import EntityExtractor
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# Familias de entradas adversariales: n -> texto de unos n caracteres
+ADVERSARIAL: Dict[str, Callable[[int], str]] = {
+    'open_paren_digits': lambda n: "(" + "1" * n,
+    'many_open_parens': lambda n: "(1234 " * (n // 6),
+    'nested_open_parens': lambda n: "(" * n,
+    'open_paren_words': lambda n: "(" + "palabra " * (n // 8),
+    'open_paren_et_al': lambda n: "(et al" * (n // 6),
+    'spaces_after_word': lambda n: "a" + " " * n + "x",
+    'long_digits_letter': lambda n: "1" * n + "a",
+    'digit_separators': lambda n: "1." * (n // 2) + "a",
+    'date_de_chain': lambda n: "12 de " * (n // 6),
+    'word_digit_chain': lambda n: "a 1 " * (n // 4),
+    'brackets': lambda n: "[1" * (n // 2),
+    'long_url': lambda n: "https://" + "a" * n,
+    'citation_dense': lambda n: "Según (García et al., 2019), el 85% [3] " * (n // 40),
+}
+
+# Alfabeto del fuzzing: los caracteres y fragmentos que aparecen en los patrones
+FUZZ_PIECES = list("()[]/-.,%: ") + ["1", "12", "2019", "de", "et al.", "et", "al", "http://", "doi:", "a", "\n"]
+
+
+def fuzz_text(size: int, rnd: random.Random) -> str:
+    """Texto aleatorio de unos `size` caracteres hecho de piezas del alfabeto"""
+    parts, length = [], 0
+    while length < size:
+        piece = rnd.choice(FUZZ_PIECES) * rnd.choice([1, 1, 1, 2, 8, 64])
+        parts.append(piece)
+        length += len(piece)
+    return "".join(parts)[:size]
+
+
+def measure(extractor: EntityExtractor, text: str, repeat: int) -> Dict:
+    """Mejor tiempo de `repeat` ejecuciones y si alguna agotó el tiempo máximo"""
+    best, timed_out, entities = math.inf, False, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        context = extractor.extract_and_freeze(text)
+        best = min(best, time.perf_counter() - start)
+        timed_out = timed_out or context.timed_out
+        entities = len(context.entities)
+    return {'time_ms': round(best * 1000, 3), 'timed_out': timed_out, 'entities': entities}
+
+
+def scaling_exponent(sizes: List[int], times: List[float]) -> Optional[float]:
+    """Pendiente log-log tiempo/tamaño (1.0 = lineal, 2.0 = cuadrático)"""
+    points = [(math.log(size), math.log(value)) for size, value in zip(sizes, times) if value > 0]
+    if len(points) < 2:
+        return None
+    xs, ys = zip(*points)
+    return round(float(np.polyfit(xs, ys, 1)[0]), 3)
+
+
+def run(args) -> int:
+    sizes = [int(s) for s in args.sizes.split(',')]
+    extractor = EntityExtractor()
+    report = {
+        'meta': {'sizes': sizes, 'repeat': args.repeat, 'match_timeout_s': extractor.match_timeout,
+                 'fuzz_trials': args.fuzz_trials, 'seed': args.seed},
+        'results': {},
+        'scaling': {}
+    }
+
+    failures = []
+    for family, build in ADVERSARIAL.items():
+        results = {str(size): measure(extractor, build(size), args.repeat) for size in sizes}
+        report['results'][family] = results
+        exponent = scaling_exponent(sizes, [results[str(size)]['time_ms'] for size in sizes])
+        report['scaling'][family] = exponent
+        row = "".join(f"{results[str(size)]['time_ms']:12.3f}" for size in sizes)
+        print(f"{family:22s}{row}{(f'{exponent:9.2f}' if exponent is not None else '        -')}")
+        # Por debajo de un milisegundo el exponente es ruido
+        slow = results[str(sizes[-1])]['time_ms'] >= args.min_ms
+        if any(result['timed_out'] for result in results.values()):
+            failures.append(f"{family}: tiempo agotado")
+        elif slow and exponent is not None and exponent > args.max_exponent:
+            failures.append(f"{family}: escala con exponente {exponent}")
+
+    # Fuzzing: el peor tiempo por carácter de muchas entradas aleatorias de cada tamaño
+    rnd = random.Random(args.seed)
+    worst = {}
+    for size in sizes:
+        trials = max(1, args.fuzz_trials * sizes[0] // size)
+        worst_us, timed_out = 0.0, False
+        for _ in range(trials):
+            result = measure(extractor, fuzz_text(size, rnd), 1)
+            worst_us = max(worst_us, result['time_ms'] * 1000 / size)
+            timed_out = timed_out or result['timed_out']
+        worst[str(size)] = {'trials': trials, 'worst_us_per_char': round(worst_us, 3), 'timed_out': timed_out}
+        print(f"[Fuzz] {size:>7d} caracteres  {trials:4d} entradas  peor {worst_us:.3f} µs/carácter"
+              f"{'  TIEMPO AGOTADO' if timed_out else ''}")
+        if timed_out:
+            failures.append(f"fuzz {size}: tiempo agotado")
+    report['results']['fuzz'] = worst
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[Bench] Resultados guardados en {args.out}")
+
+    for failure in failures:
+        print(f"[Bench] FALLO {failure}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adversarial del extractor de entidades")
+    parser.add_argument('--sizes', default=",".join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--fuzz-trials', type=int, default=100, help="Entradas aleatorias al tamaño menor")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--max-exponent', type=float, default=1.3, help="Escalado máximo tolerado")
+    parser.add_argument('--min-ms', type=float, default=1.0, help="Ignorar familias más rápidas (ruido)")
+    parser.add_argument('--out', help="Fichero JSON de salida")
+    args = parser.parse_args()
+
+    print(f"{'familia (ms)':22s}" + "".join(f"{size:>12s}" for size in args.sizes.split(',')) + f"{'escala':>9s}")
+    sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
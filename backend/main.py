@@ -1,19 +1,26 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, ValidationError
-from typing import Optional, List, Dict, Any, AsyncGenerator
+from typing import Optional, List, Dict, Any, AsyncGenerator, Literal, Tuple
 import os
 import asyncio
+import codecs
 import json
 import random
+from collections import Counter
 from dotenv import load_dotenv
 
-from modules.entity_extractor import EntityExtractor
+from modules.entity_extractor import EntityExtractor, FreezeContext
 from modules.text_rewriter import TextRewriter
 from modules.metrics_calculator import MetricsCalculator
 from modules.progress_manager import ProgressManager
 from modules.ai_detector import AIDetector
+from modules.cpu_executor import CPUExecutor
+from modules.live_detector import LiveDetectionSession
+from modules.live_metrics import LiveMetricsSession
+from modules.stream_detector import StreamingDetector, aiter_paragraphs, iter_paragraphs
+from modules.text_analysis import AnalysisCache
 
 # Load environment variables
 load_dotenv()
@@ -30,7 +37,9 @@ from starlette.datastructures import UploadFile
 
 @app.middleware("http")
 async def increase_body_size(request: Request, call_next):
-    request._body = await request.body()
+    # /api/detect/stream lee el cuerpo en streaming: no cargarlo entero aquí
+    if request.url.path != "/api/detect/stream":
+        request._body = await request.body()
     response = await call_next(request)
     return response
 
@@ -58,6 +67,23 @@ text_rewriter = TextRewriter()
 metrics_calculator = MetricsCalculator()
 progress_manager = ProgressManager()
 ai_detector = AIDetector()
+# Pool de procesos opcional para etapas CPU (CPU_POOL_ENABLED=true)
+cpu_executor = CPUExecutor()
+
+
+@app.on_event("startup")
+async def start_cpu_executor():
+    await cpu_executor.start()
+
+
+@app.on_event("shutdown")
+async def stop_cpu_executor():
+    cpu_executor.shutdown()
+
+
+@app.on_event("shutdown")
+async def close_calibrator():
+    await ai_detector.calibrator.close()
 
 class HumanizeRequest(BaseModel):
     text: str
@@ -69,6 +95,7 @@ class HumanizeRequest(BaseModel):
     voice: Optional[str] = "neutral"  # neutral | collective
     plan: Optional[str] = None  # free | basic | pro | ultra
     max_words: Optional[int] = None
+    diff_format: Literal["tokens", "runs"] = "tokens"
 
 
 class DiffItem(BaseModel):
@@ -97,11 +124,52 @@ class DetectResponse(BaseModel):
     analysis: str
 
 
+class DetectBatchRequest(BaseModel):
+    texts: List[str]
+    language: str = 'es'
+
+
+class DetectBatchResponse(BaseModel):
+    results: List[DetectResponse]
+
+
+MAX_DETECT_BATCH = 500
+# Caracteres totales por lote (suma de todos los textos)
+MAX_DETECT_BATCH_CHARS = int(os.getenv("MAX_DETECT_BATCH_CHARS", 2000000))
+
+# Espera sin cambios antes de re-detectar en el canal en vivo
+LIVE_DETECT_DEBOUNCE = float(os.getenv("LIVE_DETECT_DEBOUNCE_MS", 400)) / 1000
+
+# Detección en streaming: puntuación provisional cada N párrafos
+STREAM_DETECT_EVERY = max(1, int(os.getenv("STREAM_DETECT_EVERY", 50)))
+# Detección sobre el cuerpo en streaming: párrafo más largo que se acepta en memoria
+STREAM_DETECT_MAX_PARAGRAPH_CHARS = int(os.getenv("STREAM_DETECT_MAX_PARAGRAPH_CHARS", 1000000))
+
+# Métricas en vivo durante el streaming de la reescritura: intervalo mínimo entre actualizaciones
+LIVE_METRICS_INTERVAL = float(os.getenv("LIVE_METRICS_INTERVAL_MS", 250)) / 1000
+
+# Tiempo máximo que la detección espera a la calibración externa
+CALIBRATION_DEADLINE = float(os.getenv("DETECT_CALIBRATION_DEADLINE", 6))
+
+
+class DiffStats(BaseModel):
+    original_tokens: int
+    rewritten_tokens: int
+    equal_tokens: int
+    inserted_tokens: int
+    deleted_tokens: int
+    changed_hunks: int
+    similarity: float
+
+
 class HumanizeResponse(BaseModel):
     result: str
     diff: List[DiffItem]
     metrics: Metrics
     alerts: List[str]
+    diff_stats: Optional[DiffStats] = None
+    # Con diff_format="runs": (op, inicio, fin en el original, inicio, fin en el resultado)
+    diff_runs: Optional[List[Tuple[str, int, int, int, int]]] = None
 
 
 @app.get("/")
@@ -134,7 +202,7 @@ async def detect_ai(request: DetectRequest):
     Similar to GPT-Zero functionality.
     """
     try:
-        result = ai_detector.detect(request.text, request.language)
+        result = await cpu_executor.detect(ai_detector, request.text, request.language)
         
         return DetectResponse(
             is_ai=result['is_ai'],
@@ -148,6 +216,35 @@ async def detect_ai(request: DetectRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/detect/batch", response_model=DetectBatchResponse)
+async def detect_ai_batch(request: DetectBatchRequest):
+    """
+    Detect AI generation for many texts in one call.
+    Results are returned in the same order as the input texts.
+    """
+    if len(request.texts) > MAX_DETECT_BATCH:
+        raise HTTPException(status_code=413, detail=f"Supera el máximo por lote ({MAX_DETECT_BATCH} textos)")
+    if sum(len(text) for text in request.texts) > MAX_DETECT_BATCH_CHARS:
+        raise HTTPException(status_code=413, detail=f"Supera el máximo por lote ({MAX_DETECT_BATCH_CHARS} caracteres)")
+    
+    try:
+        results = await cpu_executor.detect_many(ai_detector, request.texts, request.language)
+        
+        return DetectBatchResponse(results=[
+            DetectResponse(
+                is_ai=result['is_ai'],
+                ai_probability=result['ai_probability'],
+                human_score=result['human_score'],
+                classification=result.get('classification') or ai_detector._get_classification(result['human_score']),
+                metrics=result['metrics'],
+                analysis=result['analysis']
+            )
+            for result in results
+        ])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/detect/start")
 async def start_detect(request: DetectRequest):
     """Inicia una tarea de detección con progreso SSE"""
@@ -160,6 +257,54 @@ async def start_detect(request: DetectRequest):
     return {"task_id": task_id}
 
 
+@app.post("/api/detect/stream/start")
+async def start_stream_detect(request: DetectRequest):
+    """
+    Inicia una detección párrafo a párrafo para documentos muy largos.
+    El progreso (con puntuaciones provisionales en phase="provisional")
+    se sigue por /api/detect/progress/{task_id}. El estado del detector
+    está acotado, pero el texto llega entero en el JSON; para no cargarlo
+    en memoria, enviarlo como cuerpo a /api/detect/stream.
+    """
+    if not request.text or not request.text.strip():
+        raise HTTPException(status_code=400, detail="El texto no puede estar vacío")
+    task_id = progress_manager.create_task()
+    asyncio.create_task(process_stream_detection(task_id, request))
+    return {"task_id": task_id}
+
+
+@app.post("/api/detect/stream")
+async def detect_stream_body(request: Request, language: str = 'es'):
+    """
+    Detección en streaming sobre el cuerpo de la petición (texto UTF-8).
+    Los párrafos se procesan según llegan los bloques del cuerpo: la
+    memoria queda acotada por el párrafo más largo, no por el documento.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    async def body_chunks():
+        async for block in request.stream():
+            yield decoder.decode(block)
+        yield decoder.decode(b'', final=True)
+
+    stream = StreamingDetector(ai_detector)
+    try:
+        async for paragraph in aiter_paragraphs(body_chunks(), STREAM_DETECT_MAX_PARAGRAPH_CHARS):
+            stream.feed(paragraph)
+            # Ceder el event loop entre párrafos
+            await asyncio.sleep(0)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="El cuerpo debe ser texto UTF-8")
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not stream.has_content:
+        raise HTTPException(status_code=400, detail="El texto no puede estar vacío")
+
+    result = stream.snapshot(language)
+    result.setdefault('classification', ai_detector._get_classification(result['human_score']))
+    return result
+
+
 @app.get("/api/detect/progress/{task_id}")
 async def detect_progress(task_id: str):
     """SSE para progreso de detección"""
@@ -195,13 +340,71 @@ async def detect_progress(task_id: str):
     )
 
 
+@app.get("/api/detect/cache")
+async def detect_cache_stats():
+    """Estadísticas de la caché de detección (tamaño, aciertos, fallos)"""
+    return ai_detector.cache.stats()
+
+
+@app.websocket("/api/detect/live")
+async def detect_live(websocket: WebSocket):
+    """
+    Canal de detección en vivo para el editor.
+    El cliente envía {"text", "language"} en cada cambio; tras
+    LIVE_DETECT_DEBOUNCE sin mensajes nuevos se detecta la última versión,
+    re-procesando solo los párrafos editados, y se responde con el resultado.
+    """
+    await websocket.accept()
+    session = LiveDetectionSession(ai_detector)
+    pending: Optional[Dict[str, Any]] = None
+    try:
+        while True:
+            try:
+                if pending is None:
+                    message = await websocket.receive_json()
+                else:
+                    message = await asyncio.wait_for(websocket.receive_json(), timeout=LIVE_DETECT_DEBOUNCE)
+            except asyncio.TimeoutError:
+                pass
+            except ValueError:
+                # JSON inválido: se descarta el mensaje y se conserva la edición pendiente
+                await websocket.send_json({"status": "error", "message": "Mensaje JSON inválido"})
+                continue
+            else:
+                error = _live_message_error(message)
+                if error:
+                    await websocket.send_json({"status": "error", "message": error})
+                else:
+                    pending = message
+                continue
+            text = pending.get("text") or ""
+            language = pending.get("language") or "es"
+            pending = None
+            result = session.update(text, language)
+            result.setdefault('classification', ai_detector._get_classification(result['human_score']))
+            await websocket.send_json(result)
+    except WebSocketDisconnect:
+        pass
+
+
+def _live_message_error(message: Any) -> Optional[str]:
+    """Motivo por el que un mensaje del canal en vivo no es válido (None si lo es)"""
+    if not isinstance(message, dict):
+        return "El mensaje debe ser un objeto {\"text\", \"language\"}"
+    for field in ("text", "language"):
+        if message.get(field) is not None and not isinstance(message[field], str):
+            return f"El campo '{field}' debe ser texto"
+    return None
+
+
 @app.post("/api/detect/detailed")
 async def detect_ai_detailed(request: DetectRequest):
     """
     Get a detailed AI detection report.
     """
     try:
-        report = ai_detector.get_detailed_report(request.text, request.language)
+        result = await cpu_executor.detect(ai_detector, request.text, request.language)
+        report = ai_detector.get_detailed_report(request.text, request.language, result)
         return {"report": report}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -321,6 +524,8 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
         # Extract and freeze entities
         frozen_entities = []
         processed_text = request.text
+        # Mapeo de placeholders propio de esta petición (el extractor es compartido)
+        freeze_context = FreezeContext([], request.text, {})
         runtime_alerts: List[str] = []
         
         if request.preserve_entities:
@@ -329,7 +534,8 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
                 "Extrayendo entidades académicas (números, fechas, citas)...",
                 step=5, total_steps=10, phase="entidades"
             )
-            frozen_entities, processed_text = entity_extractor.extract_and_freeze(request.text)
+            freeze_context = await cpu_executor.extract_and_freeze(entity_extractor, request.text)
+            frozen_entities, processed_text = freeze_context
             
             await progress_manager.update_progress(
                 task_id, "extracting", 18,
@@ -357,6 +563,8 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
         # Suavizado de progreso durante la llamada al modelo
         smoothing_stop_1 = asyncio.Event()
         smoothing_task_1: Optional[asyncio.Task] = None  # type: ignore
+        # Partes terminadas del primer pase (los callbacks de partes paralelas se solapan)
+        done_1 = 0
 
         async def smooth_progress(start: int, end: int, steps: int, label: str):
             # Incrementos suaves entre start→end en 'steps' con pequeñas demoras
@@ -377,36 +585,69 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
                 await asyncio.sleep(random.uniform(0.25, 0.6))
 
         # Callback de progreso por chunk (primer pase)
+        async def stop_smoothing_1():
+            smoothing_stop_1.set()
+            if smoothing_task_1 and not smoothing_task_1.done():
+                smoothing_task_1.cancel()
+                await asyncio.wait([smoothing_task_1])
+
         async def on_rewrite_progress_pass1(event: str, i: int, total: int):
-            nonlocal smoothing_task_1
+            nonlocal smoothing_task_1, done_1
             # En Standard simulamos 10 partes para que el usuario vea avance continuo
             virtual_total = 10 if not is_ultimate else total
             base_start = 30
             base_end = 50 if is_ultimate else 70
-            if event == "chunk_start":
+            label = "Pase 1/3" if is_ultimate else "Pase 1/1"
+
+            def boundary(done: int) -> int:
+                return base_start + int((base_end - base_start) * done / max(1, total))
+
+            def start_smoothing(done: int):
+                # Avance suave hasta la siguiente parte terminada (sin alcanzarla)
+                nonlocal smoothing_task_1
+                if smoothing_task_1 and not smoothing_task_1.done():
+                    smoothing_task_1.cancel()
                 smoothing_stop_1.clear()
-                label = "Pase 1/3: reescribiendo parte" if is_ultimate else "Pase 1/1: reescribiendo parte"
-                smoothing_task_1 = asyncio.create_task(
-                    smooth_progress(base_start, base_end - 1, virtual_total, label)
+                smoothing_task_1 = asyncio.create_task(smooth_progress(
+                    boundary(done), boundary(done + 1) - 1, max(1, virtual_total // max(1, total)),
+                    f"{label}: reescribiendo parte"
+                ))
+
+            # Las partes de un texto largo van en paralelo: i cuenta las iniciadas/terminadas
+            if event == "chunk_start":
+                if i == 1:
+                    start_smoothing(0)
+                return
+            done_1 = max(done_1, i)
+            await stop_smoothing_1()
+            if i < done_1:
+                # Otra parte terminó mientras tanto: su callback marca el avance
+                return
+            if i < total:
+                # chunk_done intermedio: fijar la fracción terminada y seguir suavizando
+                await progress_manager.update_progress(
+                    task_id,
+                    "rewriting",
+                    boundary(i),
+                    f"{label}: {i}/{total} partes completadas",
+                    step=7, total_steps=10, phase="reescritura"
                 )
+                if i == done_1:
+                    start_smoothing(i)
             else:
-                # chunk_done: detener suavizado y fijar al final del rango
-                smoothing_stop_1.set()
-                try:
-                    if smoothing_task_1:
-                        await asyncio.wait_for(smoothing_task_1, timeout=0.1)
-                except Exception:
-                    pass
                 await progress_manager.update_progress(
                     task_id,
                     "rewriting",
                     base_end,
-                    ("Pase 1/3: partes completadas" if is_ultimate else "Pase 1/1: partes completadas"),
+                    f"{label}: partes completadas",
                     step=7, total_steps=10, phase="reescritura"
                 )
 
-        # Evaluación previa con el detector para guiar al modelo
-        pre_eval = ai_detector.detect(processed_text, 'es')
+        # Análisis de texto compartido por reescritura, métricas y diff del job
+        analysis = AnalysisCache()
+        # Métricas y diff incrementales sobre el texto que va llegando
+        live_metrics = LiveMetricsSession(metrics_calculator, request.text, analysis)
+        live_metrics_at = 0.0
 
         # Contador de tokens en streaming
         produced_tokens = 0
@@ -414,7 +655,7 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
 
         partial_buffer = ""
         async def on_tokens(prod: int, est: int, chunk: str = ""):
-            nonlocal produced_tokens, estimated_tokens
+            nonlocal produced_tokens, estimated_tokens, live_metrics_at
             produced_tokens = prod
             estimated_tokens = max(est, estimated_tokens)
             prog = 24 + int( (70 - 24) * min(1.0, produced_tokens / max(1, estimated_tokens)) )
@@ -423,10 +664,17 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
                 partial = (partial_buffer + chunk)[-4000:]
             else:
                 partial = None
+            # El parcial es el texto completo generado hasta ahora (con placeholders)
+            live = None
+            now = asyncio.get_running_loop().time()
+            if chunk and now - live_metrics_at >= LIVE_METRICS_INTERVAL:
+                live_metrics_at = now
+                live_text = entity_extractor.restore_entities(chunk, freeze_context)
+                live = live_metrics.update(live_text)
             await progress_manager.update_progress(
                 task_id, "rewriting", prog,
                 f"Pase 1/1: generando ({produced_tokens}/{estimated_tokens} tokens)",
-                step=7, total_steps=10, phase="streaming", partial=partial
+                step=7, total_steps=10, phase="streaming", partial=partial, metrics=live
             )
 
         rewrite_result = await text_rewriter.rewrite(
@@ -434,11 +682,11 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
             budget=request.budget,
             respect_style=request.respect_style,
             style_sample=request.style_sample,
-            frozen_entities=frozen_entities,
+            frozen_entities=list(freeze_context.placeholders),
             voice=request.voice,
             progress_callback=on_rewrite_progress_pass1,
             token_callback=on_tokens,
-            detector_feedback=pre_eval.get('metrics', {})
+            analysis=analysis
         )
         # Robustez: asegurar que exista texto
         if not isinstance(rewrite_result, dict):
@@ -461,6 +709,9 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
             async def on_rewrite_progress_pass2(event: str, i: int, total: int):
                 # Mapear a 52% - 72%
                 base_start, base_end = 52, 72
+                # Partes en paralelo: el avance lo marcan las terminadas (i = cuántas)
+                if event == "chunk_start" and i > 1:
+                    return
                 frac = (i - 1) / total if event == "chunk_start" else i / total
                 percent = base_start + int((base_end - base_start) * frac)
                 await progress_manager.update_progress(
@@ -475,8 +726,9 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
                 budget=second_budget,
                 respect_style=request.respect_style,
                 style_sample=request.style_sample,
-                frozen_entities=frozen_entities,
-                progress_callback=on_rewrite_progress_pass2
+                frozen_entities=list(freeze_context.placeholders),
+                progress_callback=on_rewrite_progress_pass2,
+                analysis=analysis
             )
             
             # El resultado ya tiene los placeholders, no necesitamos restaurar aquí
@@ -492,7 +744,7 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
             )
             
             # Siempre restaurar las entidades antes de verificar
-            rewrite_result["rewritten"] = entity_extractor.restore_entities(rewrite_result["rewritten"])
+            rewrite_result["rewritten"] = entity_extractor.restore_entities(rewrite_result["rewritten"], freeze_context)
             
             await progress_manager.update_progress(
                 task_id, "verifying", 78,
@@ -502,11 +754,19 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
             
             # Then verify they were preserved (no interrumpir el flujo si falla)
             try:
-                entity_extractor.verify_entities_preserved(
+                positions = entity_extractor.verify_entities_preserved(
                     original_text=request.text,
                     rewritten_text=rewrite_result["rewritten"],
-                    frozen_entities=frozen_entities
+                    context=freeze_context
                 )
+                # La misma pasada da la multiplicidad: avisar si alguna entidad aparece menos veces
+                fewer = [
+                    f"{entity} ({len(positions[entity])}/{count})"
+                    for entity, count in Counter(frozen_entities).items()
+                    if len(positions[entity]) < count
+                ]
+                if fewer:
+                    runtime_alerts.append(f"⚠️ Entidades con menos apariciones que en el original: {', '.join(fewer)}")
             except ValueError as ve:
                 runtime_alerts.append(f"⚠️ Entidades no preservadas completamente: {str(ve)}")
         
@@ -522,11 +782,25 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
             step=9, total_steps=10, phase="métricas"
         )
         
+        # Si la reescritura llegó en streaming, métricas y diff ya están casi hechos:
+        # solo se procesa lo que cambió desde la última actualización en vivo
+        live_result = None
+        if live_metrics.updates:
+            try:
+                live_result = live_metrics.finish(rewrite_result["rewritten"], request.diff_format)
+            except Exception as e:
+                print(f"[LiveMetrics] Error al cerrar métricas en vivo: {e}")
+        
         try:
-            metrics = metrics_calculator.calculate(
-                original_text=request.text,
-                rewritten_text=rewrite_result["rewritten"]
-            )
+            if live_result is not None:
+                metrics = live_result[0]
+            else:
+                metrics = await cpu_executor.calculate_metrics(
+                    metrics_calculator,
+                    original_text=request.text,
+                    rewritten_text=rewrite_result["rewritten"],
+                    analysis=analysis
+                )
         except Exception as _:
             metrics = {
                 "change_ratio": 0.0,
@@ -548,17 +822,28 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
         )
         
         try:
-            diff = metrics_calculator.generate_diff(
-                original_text=request.text,
-                rewritten_text=rewrite_result["rewritten"]
-            )
+            if live_result is not None:
+                diff, diff_stats = live_result[1], live_result[2]
+            else:
+                diff, diff_stats = await cpu_executor.generate_diff_with_stats(
+                    metrics_calculator,
+                    original_text=request.text,
+                    rewritten_text=rewrite_result["rewritten"],
+                    diff_format=request.diff_format,
+                    analysis=analysis
+                )
         except Exception:
-            diff = []
+            diff, diff_stats = [], None
+        diff_runs = None
+        if request.diff_format == "runs":
+            diff, diff_runs = [], diff
         
         # Prepare alerts
         alerts = []
         if request.preserve_entities and frozen_entities:
             alerts.append(f"Se preservaron {len(frozen_entities)} entidades")
+        if freeze_context.timed_out:
+            alerts.append("⚠️ Búsqueda de entidades interrumpida por tiempo: solo se preservaron las encontradas")
         
         if not text_rewriter.is_api_available():
             alerts.append("⚠️ Modo demo - texto sin modificar")
@@ -570,6 +855,8 @@ async def process_humanization(task_id: str, request: HumanizeRequest):
         result = {
             "result": rewrite_result["rewritten"],
             "diff": diff,
+            "diff_runs": diff_runs,
+            "diff_stats": diff_stats,
             "metrics": metrics,
             "alerts": alerts
         }
@@ -618,7 +905,9 @@ async def get_result(task_id: str):
         result=result["result"],
         diff=result["diff"],
         metrics=Metrics(**result["metrics"]),
-        alerts=result["alerts"]
+        alerts=result["alerts"],
+        diff_stats=result.get("diff_stats"),
+        diff_runs=result.get("diff_runs")
     )
 
 
@@ -629,50 +918,29 @@ async def process_detection(task_id: str, request: DetectRequest):
         lang = request.language or 'es'
         await progress_manager.update_progress(task_id, "detecting", 5, "Iniciando análisis de IA...")
 
-        # Paso 1: tokenización/segmentación
-        await progress_manager.update_progress(task_id, "detecting", 15, "Tokenizando y segmentando oraciones...")
-        # (Informativo, el cálculo real viene luego)
-
-        # Paso 2: patrones y conectores
-        await progress_manager.update_progress(task_id, "detecting", 35, "Analizando conectores y patrones típicos de IA...")
-        pattern_score = ai_detector._calculate_pattern_score(text, lang)
-        conn = ai_detector._connector_metrics(text)
-
-        # Paso 3: métricas principales
-        await progress_manager.update_progress(task_id, "detecting", 55, "Calculando perplejidad, explosividad y diversidad léxica...")
-        perplexity = ai_detector._calculate_perplexity(text, lang)
-        burstiness = ai_detector._calculate_burstiness(text)
-        sentence_variation = ai_detector._calculate_sentence_variation(text)
-        vocabulary_diversity = ai_detector._calculate_vocabulary_diversity(text, lang)
-        readability = ai_detector._calculate_readability(text)
-        repetition_score = ai_detector._calculate_repetition_score(text)
-        clause_var = ai_detector._clause_depth_variance(text)
-
-        metrics = {
-            'perplexity': perplexity,
-            'burstiness': burstiness,
-            'sentence_variation': sentence_variation,
-            'vocabulary_diversity': vocabulary_diversity,
-            'pattern_score': pattern_score,
-            'readability': readability,
-            'repetition_score': repetition_score,
-            'connector_variety': conn['connector_variety'],
-            'connector_overuse': 100 - conn['connector_overuse'],
-            'clause_depth_variance': clause_var,
-        }
-
-        await progress_manager.update_progress(task_id, "detecting", 70, "Combinando métricas en un índice global...")
-        ai_prob = ai_detector._calculate_ai_probability(metrics)
-        human_score = round(100.0 - ai_prob, 2)
+        # Reutilizar el análisis si este mismo texto ya se detectó (p. ej. vía /api/detect)
+        detection = ai_detector.lookup_cached(text, lang)
+        if detection is not None:
+            await progress_manager.update_progress(task_id, "detecting", 70, "Análisis previo encontrado, reutilizando métricas...")
+        else:
+            # Perfil y métricas en una sola etapa (en el pool de procesos si el texto es largo)
+            await progress_manager.update_progress(
+                task_id, "detecting", 15,
+                "Tokenizando y calculando conectores, perplejidad, explosividad y diversidad léxica..."
+            )
+            detection = await cpu_executor.detect(ai_detector, text, lang)
+            await progress_manager.update_progress(task_id, "detecting", 82, "Generando análisis e interpretación...")
 
-        await progress_manager.update_progress(task_id, "detecting", 82, "Generando análisis e interpretación...")
-        analysis = ai_detector._generate_analysis(metrics, ai_prob)
-        classification = ai_detector._get_classification(human_score)
+        metrics = detection['metrics']
+        ai_prob = detection['ai_probability']
+        human_score = detection['human_score']
+        analysis = detection['analysis']
+        classification = detection.get('classification') or ai_detector._get_classification(human_score)
 
         # Paso 4: calibración opcional con DeepSeek
         await progress_manager.update_progress(task_id, "detecting", 90, "Calibrando con modelo externo (opcional)...")
         try:
-            calibrated = await ai_detector.calibrate_with_deepseek(text, ai_prob, metrics)  # type: ignore
+            calibrated = await ai_detector.calibrate_with_deepseek(text, ai_prob, metrics, deadline=CALIBRATION_DEADLINE)
         except Exception:
             calibrated = None
         if calibrated is not None:
@@ -697,6 +965,42 @@ async def process_detection(task_id: str, request: DetectRequest):
         await progress_manager.complete_task(task_id, success=False, error=error_msg)
 
 
+async def process_stream_detection(task_id: str, request: DetectRequest):
+    """Detección párrafo a párrafo con memoria acotada y resultados provisionales"""
+    try:
+        text = request.text
+        lang = request.language or 'es'
+        await progress_manager.update_progress(task_id, "detecting", 5, "Iniciando análisis en streaming...")
+
+        stream = StreamingDetector(ai_detector)
+        consumed = 0
+        for paragraph in iter_paragraphs(text):
+            stream.feed(paragraph)
+            consumed += len(paragraph) + 2
+            if stream.paragraphs % STREAM_DETECT_EVERY == 0:
+                provisional = stream.snapshot(lang)
+                provisional.setdefault('classification', ai_detector._get_classification(provisional['human_score']))
+                progress = 5 + int(85 * min(consumed, len(text)) / len(text))
+                await progress_manager.update_progress(
+                    task_id, "detecting", progress,
+                    f"Puntuación provisional tras {stream.paragraphs} párrafos",
+                    phase="provisional",
+                    partial=json.dumps(provisional, ensure_ascii=False)
+                )
+            # Ceder el event loop entre párrafos
+            await asyncio.sleep(0)
+
+        await progress_manager.update_progress(task_id, "detecting", 95, "Generando análisis e interpretación...")
+        result = stream.snapshot(lang)
+        result.setdefault('classification', ai_detector._get_classification(result['human_score']))
+
+        progress_manager.tasks[task_id]["result"] = result
+        await progress_manager.complete_task(task_id, success=True)
+    except Exception as e:
+        error_msg = f"Error: {str(e)}"
+        await progress_manager.complete_task(task_id, success=False, error=error_msg)
+
+
 @app.post("/api/humanize", response_model=HumanizeResponse)
 async def humanize_text(request: HumanizeRequest):
     # Detectar si es nivel Ultimate para doble procesamiento
@@ -727,12 +1031,18 @@ async def humanize_text(request: HumanizeRequest):
         # Extract and freeze entities if preserve_entities is True
         frozen_entities = []
         processed_text = request.text
+        # Mapeo de placeholders propio de esta petición (el extractor es compartido)
+        freeze_context = FreezeContext([], request.text, {})
         
         if request.preserve_entities:
             print("[HUMANIZADOR] Extrayendo y preservando entidades académicas...")
-            frozen_entities, processed_text = entity_extractor.extract_and_freeze(request.text)
+            freeze_context = await cpu_executor.extract_and_freeze(entity_extractor, request.text)
+            frozen_entities, processed_text = freeze_context
             print(f"[HUMANIZADOR] {len(frozen_entities)} entidades preservadas")
         
+        # Análisis de texto compartido por reescritura, métricas y diff de la petición
+        analysis = AnalysisCache()
+
         # First rewrite pass
         print("[HUMANIZADOR] Enviando texto a DeepSeek para humanización...")
         rewrite_result = await text_rewriter.rewrite(
@@ -740,8 +1050,9 @@ async def humanize_text(request: HumanizeRequest):
             budget=request.budget,
             respect_style=request.respect_style,
             style_sample=request.style_sample,
-            frozen_entities=frozen_entities,
-            voice=request.voice
+            frozen_entities=list(freeze_context.placeholders),
+            voice=request.voice,
+            analysis=analysis
         )
         print("[HUMANIZADOR] Primer pase de humanización completado")
         
@@ -759,7 +1070,8 @@ async def humanize_text(request: HumanizeRequest):
                 budget=second_budget,
                 respect_style=request.respect_style,
                 style_sample=request.style_sample,
-                frozen_entities=frozen_entities
+                frozen_entities=list(freeze_context.placeholders),
+                analysis=analysis
             )
             
             # Tercer pase de pulido final
@@ -772,7 +1084,8 @@ async def humanize_text(request: HumanizeRequest):
                 budget=third_budget,
                 respect_style=request.respect_style,
                 style_sample=request.style_sample,
-                frozen_entities=frozen_entities
+                frozen_entities=list(freeze_context.placeholders),
+                analysis=analysis
             )
             
             # El resultado ya tiene los placeholders, no necesitamos restaurar aquí
@@ -783,34 +1096,44 @@ async def humanize_text(request: HumanizeRequest):
         # Restore entities before verification
         if request.preserve_entities:
             # First restore entities in the rewritten text
-            rewrite_result["rewritten"] = entity_extractor.restore_entities(rewrite_result["rewritten"])
+            rewrite_result["rewritten"] = entity_extractor.restore_entities(rewrite_result["rewritten"], freeze_context)
             
             # Then verify they were preserved
             entity_extractor.verify_entities_preserved(
                 original_text=request.text,
                 rewritten_text=rewrite_result["rewritten"],
-                frozen_entities=frozen_entities
+                context=freeze_context
             )
         
         # Calculate metrics
         print("[HUMANIZADOR] Calculando métricas de humanización...")
-        metrics = metrics_calculator.calculate(
+        metrics = await cpu_executor.calculate_metrics(
+            metrics_calculator,
             original_text=request.text,
-            rewritten_text=rewrite_result["rewritten"]
+            rewritten_text=rewrite_result["rewritten"],
+            analysis=analysis
         )
         
         # Generate diff
         print("[HUMANIZADOR] Generando diferencias visuales...")
-        diff = metrics_calculator.generate_diff(
+        diff, diff_stats = await cpu_executor.generate_diff_with_stats(
+            metrics_calculator,
             original_text=request.text,
-            rewritten_text=rewrite_result["rewritten"]
+            rewritten_text=rewrite_result["rewritten"],
+            diff_format=request.diff_format,
+            analysis=analysis
         )
+        diff_runs = None
+        if request.diff_format == "runs":
+            diff, diff_runs = [], diff
         print(f"[HUMANIZADOR] Proceso completado - Ratio de cambio: {metrics['change_ratio']:.2%}")
         
         # Generate alerts
         alerts = []
         if request.preserve_entities and frozen_entities:
             alerts.append(f"Se preservaron {len(frozen_entities)} entidades (cifras, fechas, citas)")
+        if freeze_context.timed_out:
+            alerts.append("⚠️ Búsqueda de entidades interrumpida por tiempo: solo se preservaron las encontradas")
         
         if not text_rewriter.is_api_available():
             alerts.append("⚠️ Sin API key válida - modo demo (texto sin modificar)")
@@ -822,7 +1145,9 @@ async def humanize_text(request: HumanizeRequest):
             result=rewrite_result["rewritten"],
             diff=diff,
             metrics=Metrics(**metrics),
-            alerts=alerts
+            alerts=alerts,
+            diff_stats=diff_stats,
+            diff_runs=diff_runs
         )
     
     except ValueError as e:
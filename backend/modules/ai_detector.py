@@ -10,6 +10,229 @@ from typing import Dict, List, Tuple, Optional
 import os
 from collections import Counter
 import statistics
+from bisect import bisect_right
+
+from modules.result_cache import LRUCache, content_key
+from modules.ngram_lm import NGramLanguageModel
+from modules.calibrator import DeepSeekCalibrator
+from modules.text_analysis import AnalysisCache, AnalyzedText, analyze, get_lexicon
+
+
+class TextProfile:
+    """
+    Tokenized view of a text shared by all detector metrics.
+    Built once per text: every metric reads words, sentences and
+    frequencies from here instead of re-tokenizing on its own.
+
+    Metrics only read the aggregate statistics (counts, frequency tables,
+    sentence lengths, n-grams), so profiles of consecutive paragraphs can be
+    combined with TextProfile.merged() into the profile of the whole text.
+    """
+
+    SENTENCE_PATTERN = re.compile(r'[^.!?]+')
+    CLAUSE_BOUNDARY_PATTERN = re.compile(r'(?<=[\.\.\?\!])\s+')
+    CLAUSE_MARKER_PATTERN = re.compile(r'[,:;]|\b(?:que|y|pero|aunque|sin embargo|no obstante)\b')
+    PARAGRAPH_SEPARATOR = '\n\n'
+
+    def __init__(self, text: str, analyzed: Optional[AnalyzedText] = None):
+        if analyzed is None:
+            analyzed = AnalyzedText(text)
+        self.text = text
+        self.lower = analyzed.lower
+
+        # Palabras (\w+) en minúsculas, alternadas con los separadores que las
+        # rodean: [palabra, separador, palabra, ...]
+        self.word_segments: List[str] = analyzed.word_segments
+        self.words: List[str] = analyzed.words_lower
+        self.word_count = len(self.words)
+        self.word_freq: Counter = Counter(self.words)
+        # Conteo de patrones/conectores y (log-prob, tokens) del modelo de
+        # n-gramas: los rellena AIDetector bajo demanda
+        self.phrase_counts: Optional[Counter] = None
+        self.lm_stats: Optional[Tuple[float, int]] = None
+
+        # Tokens separados por espacios (forma original y en minúsculas)
+        self.tokens: List[str] = text.split()
+        self.tokens_lower: List[str] = self.lower.split()
+        self.token_count = len(self.tokens)
+        self.token_chars = sum(len(t) for t in self.tokens)
+        words = self.tokens_lower
+        self.bigram_counts: Counter = Counter(zip(words, words[1:]))
+        self.trigram_counts: Counter = Counter(zip(words, words[1:], words[2:]))
+        self.head_tokens: List[str] = words[:2]
+        self.tail_tokens: List[str] = words[-2:]
+
+        # Oraciones delimitadas por [.!?], con su posición en el texto
+        self.sentences: List[str] = []
+        self.sentence_spans: List[Tuple[int, int]] = []
+        self.sentence_lengths: List[int] = []
+        self.sentence_first_words: List[str] = []
+        # Fragmentos abiertos en los bordes (sin [.!?] que los separe del texto
+        # vecino): al unir párrafos se funden con la oración contigua
+        self.has_sentence_end = any(mark in text for mark in '.!?')
+        self.opens_with_fragment = False
+        self.ends_with_fragment = False
+        for match in self.SENTENCE_PATTERN.finditer(text):
+            raw = match.group()
+            sentence = raw.strip()
+            if not sentence:
+                continue
+            start = match.start() + (len(raw) - len(raw.lstrip()))
+            sentence_words = sentence.split()
+            self.sentences.append(sentence)
+            self.sentence_spans.append((start, start + len(sentence)))
+            self.sentence_lengths.append(len(sentence_words))
+            self.sentence_first_words.append(sentence_words[0].lower())
+            if match.start() == 0:
+                self.opens_with_fragment = True
+            if match.end() == len(text):
+                self.ends_with_fragment = True
+
+        # Cláusulas por oración (oraciones cortadas tras puntuación + espacio)
+        stripped = self.lower.strip()
+        boundaries = [m.end() for m in self.CLAUSE_BOUNDARY_PATTERN.finditer(stripped)]
+        self.clause_counts: List[int] = [1] * (len(boundaries) + 1)
+        for marker in self.CLAUSE_MARKER_PATTERN.finditer(stripped):
+            self.clause_counts[bisect_right(boundaries, marker.start())] += 1
+        self.is_blank = not stripped
+        self.ends_clause = stripped.endswith(('.', '?', '!'))
+
+    @classmethod
+    def merged(cls, profiles: List['TextProfile']) -> 'TextProfile':
+        """
+        Combine the profiles of consecutive paragraphs into the profile of
+        PARAGRAPH_SEPARATOR.join(paragraphs), without re-tokenizing them.
+
+        The merged profile carries the same aggregate statistics a profile
+        of the joined text would have; its token and sentence lists
+        (words, tokens, sentences, spans...) are left as None, so it can be
+        scored but not merged again.
+        """
+        merged = cls.__new__(cls)
+        merged.text = cls.PARAGRAPH_SEPARATOR.join(p.text for p in profiles)
+        merged.lower = merged.text.lower()
+        merged.word_segments = merged.words = None
+        merged.tokens = merged.tokens_lower = None
+        merged.sentences = merged.sentence_spans = None
+
+        merged.word_count = sum(p.word_count for p in profiles)
+        merged.token_count = sum(p.token_count for p in profiles)
+        merged.token_chars = sum(p.token_chars for p in profiles)
+        merged.word_freq = Counter()
+        merged.bigram_counts = Counter()
+        merged.trigram_counts = Counter()
+        merged.phrase_counts = Counter()
+        # El modelo de n-gramas corta el contexto en cada párrafo: la suma es exacta
+        if profiles and all(p.lm_stats is not None for p in profiles):
+            merged.lm_stats = (sum(p.lm_stats[0] for p in profiles), sum(p.lm_stats[1] for p in profiles))
+        else:
+            merged.lm_stats = None
+        for p in profiles:
+            merged.word_freq.update(p.word_freq)
+            merged.bigram_counts.update(p.bigram_counts)
+            merged.trigram_counts.update(p.trigram_counts)
+            if p.phrase_counts is None:
+                merged.phrase_counts = None
+            elif merged.phrase_counts is not None:
+                # Las frases no cruzan párrafos (exigen un solo espacio entre palabras)
+                merged.phrase_counts.update(p.phrase_counts)
+
+        # N-gramas que cruzan el límite entre párrafos
+        tail: List[str] = []
+        for p in profiles:
+            window = tail + p.head_tokens
+            cut = len(tail)
+            for i in range(max(cut - 1, 0), min(cut, len(window) - 1)):
+                merged.bigram_counts[tuple(window[i:i + 2])] += 1
+            for i in range(max(cut - 2, 0), min(cut, len(window) - 2)):
+                merged.trigram_counts[tuple(window[i:i + 3])] += 1
+            tail = (tail + p.tail_tokens)[-2:]
+
+        # Oraciones: el fragmento abierto al final de un párrafo continúa en el siguiente
+        merged.sentence_lengths = []
+        merged.sentence_first_words = []
+        carry: Optional[Tuple[int, str]] = None
+
+        def join(head: Optional[Tuple[int, str]], rest: Optional[Tuple[int, str]]):
+            if head is None or rest is None:
+                return head or rest
+            return (head[0] + rest[0], head[1])
+
+        for p in profiles:
+            sentences = list(zip(p.sentence_lengths, p.sentence_first_words))
+            if not p.has_sentence_end:
+                carry = join(carry, sentences[0] if sentences else None)
+                continue
+            head = sentences.pop(0) if p.opens_with_fragment else None
+            tail_sentence = sentences.pop() if p.ends_with_fragment else None
+            closed = join(carry, head)
+            if closed is not None:
+                sentences.insert(0, closed)
+            for length, first_word in sentences:
+                merged.sentence_lengths.append(length)
+                merged.sentence_first_words.append(first_word)
+            carry = tail_sentence
+        if carry is not None:
+            merged.sentence_lengths.append(carry[0])
+            merged.sentence_first_words.append(carry[1])
+
+        # Cláusulas: un párrafo sin puntuación final continúa la última oración
+        merged.clause_counts = []
+        previous: Optional['TextProfile'] = None
+        for p in profiles:
+            if p.is_blank:
+                continue
+            if previous is not None and not previous.ends_clause:
+                merged.clause_counts[-1] += p.clause_counts[0] - 1
+                merged.clause_counts.extend(p.clause_counts[1:])
+            else:
+                merged.clause_counts.extend(p.clause_counts)
+            previous = p
+        if not merged.clause_counts:
+            merged.clause_counts = [1]
+        return merged
+
+
+class PhraseMatcher:
+    """
+    Multi-phrase matcher backed by a word trie.
+    Finds every registered phrase (overlapping ones included) in a single
+    pass over a text's words, with word-boundary semantics. The cost per
+    word is one dict lookup, independent of how many phrases are registered.
+    """
+
+    def __init__(self, phrases: List[str]):
+        # Cada nodo es un dict palabra -> nodo; la clave None marca fin de frase
+        self.root: Dict[str, Dict] = {}
+        for phrase in phrases:
+            node = self.root
+            for word in phrase.split(' '):
+                node = node.setdefault(word, {})
+            node[None] = phrase
+
+    def scan(self, word_segments: List[str]) -> Counter:
+        """
+        Count phrase occurrences in a TextProfile.word_segments list.
+        Words of a phrase must be separated by exactly one space, and
+        occurrences of the same phrase never overlap (like re.findall).
+        """
+        counts: Counter = Counter()
+        last_end: Dict[str, int] = {}
+        root = self.root
+        n = len(word_segments)
+        for i in range(0, n, 2):
+            node = root.get(word_segments[i])
+            j = i
+            while node is not None:
+                phrase = node.get(None)
+                if phrase is not None and i >= last_end.get(phrase, 0):
+                    counts[phrase] += 1
+                    last_end[phrase] = j + 1
+                if j + 2 >= n or word_segments[j + 1] != ' ':
+                    break
+                j += 2
+                node = node.get(word_segments[j])
+        return counts
 
 
 class AIDetector:
@@ -18,112 +241,250 @@ class AIDetector:
     Analyzes perplexity, burstiness, sentence patterns, and vocabulary distribution.
     """
     
+    # Weight for each metric (sum to 1.0); order defines the metric matrix columns
+    METRIC_WEIGHTS = {
+        'perplexity': 0.22,        # Important
+        'burstiness': 0.18,        # Very important  
+        'sentence_variation': 0.13,
+        'vocabulary_diversity': 0.13,
+        'pattern_score': 0.10,
+        'readability': 0.08,
+        'repetition_score': 0.06,
+        'connector_variety': 0.05,     # Nuevo
+        'connector_overuse': 0.03,     # Nuevo (ya invertido)
+        'clause_depth_variance': 0.02  # Nuevo
+    }
+    
+    # Incrementar al cambiar métricas, pesos o umbrales (invalida la caché)
+    DETECTOR_VERSION = "1.1"
+    
     def __init__(self):
-        # Conectores típicos de IA (detectados por GPT-Zero)
-        self.AI_CONNECTORS = {
-            "además", "por lo tanto", "en conclusión", "sin embargo", 
-            "no obstante", "por consiguiente", "en resumen", "asimismo", 
-            "en consecuencia", "del mismo modo", "en este sentido",
-            "es importante destacar", "cabe mencionar", "es necesario señalar",
-            "en primer lugar", "en segundo lugar", "finalmente"
-        }
+        # Caché de resultados por contenido: (texto normalizado, idioma, versión)
+        self.cache = LRUCache(
+            max_entries=int(os.getenv("DETECT_CACHE_SIZE", 512)),
+            ttl_seconds=float(os.getenv("DETECT_CACHE_TTL", 3600))
+        )
         
-        # Conectores humanos naturales
-        self.HUMAN_CONNECTORS = {
-            "bueno", "mira", "la verdad es que", "resulta que",
-            "eso sí", "ahora", "lo que pasa es que", "total que",
-            "al final", "o sea", "vamos que", "en fin",
-            "por cierto", "a todo esto", "el caso es que", "claro"
-        }
+        self._weights_vector = np.array(list(self.METRIC_WEIGHTS.values()), dtype=np.float64)
+        self._metric_columns = {name: i for i, name in enumerate(self.METRIC_WEIGHTS)}
         
-        # Common AI patterns and phrases to detect
+        # Conectores típicos de IA y conectores humanos naturales (registro compartido)
+        self.AI_CONNECTORS = get_lexicon('connectors_ai_es')
+        self.HUMAN_CONNECTORS = get_lexicon('connectors_human_es')
+        
+        # Common AI patterns and phrases to detect (matched on word boundaries)
         self.ai_patterns = {
             'transitional': [
-                r'\bfurthermore\b', r'\bmoreover\b', r'\badditionally\b',
-                r'\bhowever\b', r'\bnonetheless\b', r'\bnevertheless\b',
-                r'\bin conclusion\b', r'\bto summarize\b', r'\bin summary\b'
+                'furthermore', 'moreover', 'additionally',
+                'however', 'nonetheless', 'nevertheless',
+                'in conclusion', 'to summarize', 'in summary'
             ],
             'hedging': [
-                r'\bit is important to note\b', r'\bit should be noted\b',
-                r'\bone could argue\b', r'\bit can be said\b',
-                r'\bit is worth mentioning\b', r'\binterestingly\b'
+                'it is important to note', 'it should be noted',
+                'one could argue', 'it can be said',
+                'it is worth mentioning', 'interestingly'
             ],
             'formal': [
-                r'\bfundamental\b', r'\bcrucial\b', r'\bsignificant\b',
-                r'\bsubstantial\b', r'\bcomprehensive\b', r'\bextensive\b',
-                r'\bdiverse\b', r'\bvarious\b', r'\bnumerous\b'
+                'fundamental', 'crucial', 'significant',
+                'substantial', 'comprehensive', 'extensive',
+                'diverse', 'various', 'numerous'
             ]
         }
         
         # Spanish AI patterns
         self.spanish_ai_patterns = {
             'transitional': [
-                r'\bademás\b', r'\basimismo\b', r'\bpor otro lado\b',
-                r'\bsin embargo\b', r'\bno obstante\b', r'\ben consecuencia\b',
-                r'\ben resumen\b', r'\ben conclusión\b', r'\bpor lo tanto\b'
+                'además', 'asimismo', 'por otro lado',
+                'sin embargo', 'no obstante', 'en consecuencia',
+                'en resumen', 'en conclusión', 'por lo tanto'
             ],
             'hedging': [
-                r'\bes importante señalar\b', r'\bcabe mencionar\b',
-                r'\bes necesario destacar\b', r'\bresulta relevante\b',
-                r'\bconviene subrayar\b', r'\bes preciso indicar\b'
+                'es importante señalar', 'cabe mencionar',
+                'es necesario destacar', 'resulta relevante',
+                'conviene subrayar', 'es preciso indicar'
             ],
             'formal': [
-                r'\bfundamental\b', r'\bcrucial\b', r'\bmediante\b',
-                r'\bdiversos\b', r'\bmúltiples\b', r'\bsignificativo\b',
-                r'\bsubstancial\b', r'\bamplio\b', r'\bextenso\b'
+                'fundamental', 'crucial', 'mediante',
+                'diversos', 'múltiples', 'significativo',
+                'substancial', 'amplio', 'extenso'
             ]
         }
         
+        # Extended AI connector phrases used by the pattern score (very typical of AI)
+        self.ai_connector_phrases = [
+            'además', 'por lo tanto', 'sin embargo', 
+            'en conclusión', 'por otro lado', 'en primer lugar',
+            'en segundo lugar', 'en resumen', 'finalmente',
+            'asimismo', 'de igual manera', 'en consecuencia',
+            'por consiguiente', 'no obstante', 'en efecto'
+        ]
+        
+        # Human-like connector phrases (less formal, more natural)
+        self.human_connector_phrases = [
+            'ahora bien', 'eso sí', 'la cosa es que',
+            'lo cierto es que', 'vale la pena', 'curiosamente',
+            'de hecho', 'por cierto', 'a propósito',
+            'entre otras cosas', 'en cualquier caso', 'visto así',
+            'mirándolo bien', 'a fin de cuentas', 'dicho esto'
+        ]
+        
+        # Calibración remota opcional (cliente único, limitada y cacheada)
+        self.calibrator = DeepSeekCalibrator()
+        
+        # Modelo de trigramas local (NGRAM_LM_PATH); se mapea en memoria al primer uso
+        self.language_model = NGramLanguageModel()
+        
+        # Matcher único para patrones y conectores (una pasada lineal sobre las palabras)
+        self.phrase_matcher = PhraseMatcher(
+            [p for patterns in self.ai_patterns.values() for p in patterns] +
+            [p for patterns in self.spanish_ai_patterns.values() for p in patterns] +
+            self.ai_connector_phrases +
+            self.human_connector_phrases +
+            list(self.AI_CONNECTORS | self.HUMAN_CONNECTORS)
+        )
+        
         # Stopwords for different languages
-        self.spanish_stopwords = {
-            'el', 'la', 'de', 'que', 'y', 'a', 'en', 'un', 'ser', 'se',
-            'no', 'haber', 'por', 'con', 'su', 'para', 'como', 'estar',
-            'tener', 'le', 'lo', 'todo', 'pero', 'más', 'hacer', 'o',
-            'poder', 'decir', 'este', 'ir', 'otro', 'ese', 'si', 'me',
-            'ya', 'ver', 'porque', 'dar', 'cuando', 'muy', 'sin', 'vez',
-            'mucho', 'saber', 'qué', 'sobre', 'mi', 'alguno', 'mismo',
-            'yo', 'también', 'hasta', 'año', 'dos', 'querer', 'entre'
-        }
+        self.spanish_stopwords = get_lexicon('stopwords_es_frequent')
+    
+    def build_profile(self, text: str, analysis: Optional[AnalysisCache] = None) -> TextProfile:
+        """
+        Tokenize a text once so it can be shared across metrics (and, with
+        a job's AnalysisCache, with the metrics calculator and the rewriter).
+        """
+        return TextProfile(text, analyze(text, analysis))
     
-    def detect(self, text: str, language: str = 'es') -> Dict:
+    def profile_paragraph(self, paragraph: str) -> TextProfile:
+        """
+        Profile a paragraph with everything merged or streamed documents
+        need precomputed (phrase counts, language model statistics).
+        """
+        profile = self.build_profile(paragraph)
+        self._phrase_counts(profile)
+        self._lm_stats(profile)
+        return profile
+
+    def detect(self, text: str, language: str = 'es', profile: Optional[TextProfile] = None) -> Dict:
         """
         Main detection method that analyzes text for AI patterns.
         
         Args:
             text: Text to analyze
             language: Language code ('es' for Spanish, 'en' for English)
+            profile: Optional precomputed TextProfile of the same text
             
         Returns:
             Dictionary with detection results and metrics
         """
         if not text or len(text.strip()) < 50:
-            return {
-                'is_ai': False,
-                'ai_probability': 0.0,
-                'human_score': 100.0,
-                'metrics': {},
-                'analysis': 'Text too short for reliable analysis'
-            }
+            return self._short_text_result()
+        
+        cached = self.lookup_cached(text, language)
+        if cached is not None:
+            return cached
+        
+        if profile is None:
+            profile = self.build_profile(text)
         
         # Calculate all metrics
+        metrics = self._calculate_metrics(profile, language)
+        
+        # Calculate overall AI probability
+        ai_probability = self._calculate_ai_probability(metrics)
+        
+        result = self._build_result(metrics, ai_probability)
+        self.store_cached(text, language, result)
+        return result
+    
+    def detect_many(self, texts: List[str], language: str = 'es') -> List[Dict]:
+        """
+        Detect AI patterns in a batch of texts.
+        Metrics are computed per text, then the AI probability of the whole
+        batch is scored at once over an N×10 NumPy matrix.
+        
+        Args:
+            texts: Texts to analyze
+            language: Language code shared by all texts
+            
+        Returns:
+            List of detection results, in the same order as texts
+        """
+        results: List[Optional[Dict]] = [None] * len(texts)
+        scored_indices: List[int] = []
+        scored_metrics: List[Dict] = []
+        
+        for i, text in enumerate(texts):
+            if not text or len(text.strip()) < 50:
+                results[i] = self._short_text_result()
+                continue
+            cached = self.lookup_cached(text, language)
+            if cached is not None:
+                results[i] = cached
+                continue
+            scored_indices.append(i)
+            scored_metrics.append(self._calculate_metrics(self.build_profile(text), language))
+        
+        if scored_metrics:
+            matrix = np.array(
+                [[metrics.get(name, 50) for name in self.METRIC_WEIGHTS] for metrics in scored_metrics],
+                dtype=np.float64
+            )
+            probabilities = self._ai_probability_matrix(matrix).tolist()
+            for i, metrics, ai_probability in zip(scored_indices, scored_metrics, probabilities):
+                results[i] = self._build_result(metrics, ai_probability)
+                self.store_cached(texts[i], language, results[i])
+        
+        return results
+    
+    def cache_key(self, text: str, language: str) -> str:
+        """
+        Content hash of (normalized text, language, detector version).
+        Normalization only drops differences no metric depends on
+        (surrounding whitespace and CRLF line endings).
+        """
+        normalized = text.strip().replace('\r\n', '\n')
+        return content_key(normalized, language, self.DETECTOR_VERSION, self.language_model.fingerprint)
+    
+    def lookup_cached(self, text: str, language: str) -> Optional[Dict]:
+        """
+        Return a copy of a cached detection result, or None on a miss.
+        """
+        cached = self.cache.get(self.cache_key(text, language))
+        if cached is None:
+            return None
+        return {**cached, 'metrics': dict(cached['metrics'])}
+    
+    def store_cached(self, text: str, language: str, result: Dict):
+        """
+        Cache a detection result for later lookups of the same content.
+        """
+        self.cache.put(self.cache_key(text, language), {**result, 'metrics': dict(result['metrics'])})
+    
+    def _calculate_metrics(self, profile: TextProfile, language: str) -> Dict[str, float]:
+        """
+        Calculate every detector metric from a text profile.
+        """
         metrics = {
-            'perplexity': self._calculate_perplexity(text, language),
-            'burstiness': self._calculate_burstiness(text),
-            'sentence_variation': self._calculate_sentence_variation(text),
-            'vocabulary_diversity': self._calculate_vocabulary_diversity(text, language),
-            'pattern_score': self._calculate_pattern_score(text, language),
-            'readability': self._calculate_readability(text),
-            'repetition_score': self._calculate_repetition_score(text)
+            'perplexity': self._calculate_perplexity(profile, language),
+            'burstiness': self._calculate_burstiness(profile),
+            'sentence_variation': self._calculate_sentence_variation(profile),
+            'vocabulary_diversity': self._calculate_vocabulary_diversity(profile, language),
+            'pattern_score': self._calculate_pattern_score(profile, language),
+            'readability': self._calculate_readability(profile),
+            'repetition_score': self._calculate_repetition_score(profile)
         }
         
         # Añadir métricas de conectores y cláusulas
-        conn_metrics = self._connector_metrics(text)
+        conn_metrics = self._connector_metrics(profile)
         metrics['connector_variety'] = conn_metrics['connector_variety']
         metrics['connector_overuse'] = 100 - conn_metrics['connector_overuse']  # Invertido para que menor sea mejor
-        metrics['clause_depth_variance'] = self._clause_depth_variance(text)
+        metrics['clause_depth_variance'] = self._clause_depth_variance(profile)
         
-        # Calculate overall AI probability
-        ai_probability = self._calculate_ai_probability(metrics)
+        return metrics
+    
+    def _build_result(self, metrics: Dict[str, float], ai_probability: float) -> Dict:
+        """
+        Assemble the detection result for already scored metrics.
+        """
         human_score = 100.0 - ai_probability
         
         # Determine if text is AI-generated
@@ -141,18 +502,37 @@ class AIDetector:
             'classification': self._get_classification(human_score)
         }
     
-    def _calculate_perplexity(self, text: str, language: str) -> float:
+    def _short_text_result(self) -> Dict:
+        """
+        Result returned for texts too short to analyze.
+        """
+        return {
+            'is_ai': False,
+            'ai_probability': 0.0,
+            'human_score': 100.0,
+            'metrics': {},
+            'analysis': 'Text too short for reliable analysis'
+        }
+    
+    def _calculate_perplexity(self, profile: TextProfile, language: str) -> float:
         """
         Calculate perplexity score based on word predictability.
         Higher perplexity = more human-like
+        
+        Uses the local trigram model when one is configured for the language,
+        otherwise the unigram entropy of the text itself.
         """
-        words = re.findall(r'\b\w+\b', text.lower())
-        if len(words) < 2:
+        if language == self.language_model.language:
+            lm_stats = self._lm_stats(profile)
+            if lm_stats is not None and lm_stats[1] >= 2:
+                return self._lm_perplexity_score(lm_stats)
+        
+        total_words = profile.word_count
+        if total_words < 2:
             return 0.0
         
         # Calculate word frequency distribution
-        word_freq = Counter(words)
-        total_words = len(words)
+        word_freq = profile.word_freq
         
         # Calculate entropy
         entropy = 0.0
@@ -169,7 +549,30 @@ class AIDetector:
         
         return round(normalized, 2)
     
-    def _calculate_burstiness(self, text: str) -> float:
+    def _lm_stats(self, profile: TextProfile) -> Optional[Tuple[float, int]]:
+        """
+        Total log10 probability and scored token count under the local
+        language model, cached on the profile. None without a model.
+        """
+        if not self.language_model.available:
+            return None
+        if profile.lm_stats is None:
+            profile.lm_stats = self.language_model.score_text(profile.text)
+        return profile.lm_stats
+    
+    def _lm_perplexity_score(self, lm_stats: Tuple[float, int]) -> float:
+        """
+        Map the model's per-token perplexity to 0-100 on a log scale between
+        NGRAM_LM_PPL_LOW (predictable, AI-like) and NGRAM_LM_PPL_HIGH.
+        """
+        logprob, count = lm_stats
+        perplexity = 10 ** (-logprob / count)
+        low = float(os.getenv("NGRAM_LM_PPL_LOW", 50))
+        high = float(os.getenv("NGRAM_LM_PPL_HIGH", 1000))
+        normalized = (math.log(perplexity) - math.log(low)) / (math.log(high) - math.log(low)) * 100
+        return round(max(0.0, min(100.0, normalized)), 2)
+    
+    def _calculate_burstiness(self, profile: TextProfile) -> float:
         """
         Calculate burstiness (variation in sentence length).
         Higher burstiness = more human-like
@@ -177,21 +580,14 @@ class AIDetector:
         CRITICAL: AI tends to write sentences of similar lengths.
         Humans vary dramatically between very short and very long sentences.
         """
-        sentences = re.split(r'[.!?]+', text)
-        sentences = [s.strip() for s in sentences if s.strip()]
-        
-        if len(sentences) < 3:
+        if len(profile.sentence_lengths) < 3:
             return 50.0
         
         # Calculate sentence lengths
-        lengths = [len(s.split()) for s in sentences]
+        lengths = profile.sentence_lengths
         
-        # Analyze length patterns
-        very_short = sum(1 for l in lengths if l <= 5)  # <= 5 palabras
-        short = sum(1 for l in lengths if 6 <= l <= 10)
-        medium = sum(1 for l in lengths if 11 <= l <= 20)
-        long = sum(1 for l in lengths if 21 <= l <= 35)
-        very_long = sum(1 for l in lengths if l > 35)
+        # Analyze length patterns (very short, short, medium, long, very long)
+        length_bands = {self._length_band(l) for l in lengths}
         
         # Check for repetitive patterns (AI signature)
         consecutive_similar = 0
@@ -206,19 +602,36 @@ class AIDetector:
             
         std_dev = statistics.stdev(lengths) if len(lengths) > 1 else 0
         
+        return self._burstiness_score(len(lengths), mean_length, std_dev, len(length_bands), consecutive_similar)
+    
+    @staticmethod
+    def _length_band(length: int) -> int:
+        """
+        Sentence length band: very short (<= 5 words), short, medium, long, very long (> 35).
+        """
+        if length <= 5:
+            return 0
+        if length <= 10:
+            return 1
+        if length <= 20:
+            return 2
+        if length <= 35:
+            return 3
+        return 4
+    
+    def _burstiness_score(self, sentence_count: int, mean_length: float, std_dev: float,
+                          band_count: int, consecutive_similar: int) -> float:
+        """
+        Burstiness from sentence length statistics (shared with streaming detection).
+        """
         # Variance coefficient
         cv = (std_dev / mean_length) * 100 if mean_length > 0 else 0
         
         # Diversity score (presence of different lengths)
-        diversity_score = 0
-        if very_short > 0: diversity_score += 20
-        if short > 0: diversity_score += 20
-        if medium > 0: diversity_score += 20
-        if long > 0: diversity_score += 20
-        if very_long > 0: diversity_score += 20
+        diversity_score = 20 * band_count
         
         # Penalty for consecutive similar lengths (AI pattern)
-        similarity_penalty = (consecutive_similar / max(len(lengths) - 1, 1)) * 50
+        similarity_penalty = (consecutive_similar / max(sentence_count - 1, 1)) * 50
         
         # Final score combining all factors
         burstiness = (cv * 0.5) + (diversity_score * 0.3) - (similarity_penalty * 0.2)
@@ -228,46 +641,18 @@ class AIDetector:
         
         return round(normalized, 2)
     
-    def _calculate_sentence_variation(self, text: str) -> float:
+    def _calculate_sentence_variation(self, profile: TextProfile) -> float:
         """
         Calculate variation in sentence structure and length.
         """
-        sentences = re.split(r'[.!?]+', text)
-        sentences = [s.strip() for s in sentences if s.strip()]
-        
-        if len(sentences) < 2:
+        if len(profile.sentence_lengths) < 2:
             return 50.0
         
         # Analyze sentence patterns
-        patterns = []
-        for sentence in sentences:
-            words = sentence.split()
-            if not words:
-                continue
-                
-            # Classify sentence pattern
-            pattern = []
-            if len(words) < 5:
-                pattern.append('very_short')
-            elif len(words) < 10:
-                pattern.append('short')
-            elif len(words) < 20:
-                pattern.append('medium')
-            elif len(words) < 30:
-                pattern.append('long')
-            else:
-                pattern.append('very_long')
-            
-            # Check starting word
-            first_word = words[0].lower()
-            if first_word in ['the', 'a', 'an', 'el', 'la', 'un', 'una']:
-                pattern.append('article_start')
-            elif first_word in ['however', 'furthermore', 'moreover', 'además', 'sin embargo']:
-                pattern.append('transition_start')
-            elif first_word.endswith('ing') or first_word.endswith('ando') or first_word.endswith('iendo'):
-                pattern.append('gerund_start')
-            
-            patterns.append(tuple(pattern))
+        patterns = [
+            self._sentence_pattern(length, first_word)
+            for length, first_word in zip(profile.sentence_lengths, profile.sentence_first_words)
+        ]
         
         # Calculate pattern diversity
         unique_patterns = len(set(patterns))
@@ -277,21 +662,47 @@ class AIDetector:
         
         return round(diversity, 2)
     
-    def _calculate_vocabulary_diversity(self, text: str, language: str) -> float:
+    @staticmethod
+    def _sentence_pattern(length: int, first_word: str) -> Tuple[str, ...]:
         """
-        Calculate lexical diversity (unique words / total words).
+        Classify a sentence by its length and starting word.
         """
-        words = re.findall(r'\b\w+\b', text.lower())
+        pattern = []
+        if length < 5:
+            pattern.append('very_short')
+        elif length < 10:
+            pattern.append('short')
+        elif length < 20:
+            pattern.append('medium')
+        elif length < 30:
+            pattern.append('long')
+        else:
+            pattern.append('very_long')
+        
+        # Check starting word
+        if first_word in ['the', 'a', 'an', 'el', 'la', 'un', 'una']:
+            pattern.append('article_start')
+        elif first_word in ['however', 'furthermore', 'moreover', 'además', 'sin embargo']:
+            pattern.append('transition_start')
+        elif first_word.endswith('ing') or first_word.endswith('ando') or first_word.endswith('iendo'):
+            pattern.append('gerund_start')
         
-        # Remove stopwords
+        return tuple(pattern)
+    
+    def _calculate_vocabulary_diversity(self, profile: TextProfile, language: str) -> float:
+        """
+        Calculate lexical diversity (unique words / total words).
+        """
+        # Remove stopwords (counted over the frequency table)
         stopwords = self.spanish_stopwords if language == 'es' else set()
-        content_words = [w for w in words if w not in stopwords and len(w) > 2]
+        content_counts = [count for w, count in profile.word_freq.items()
+                          if w not in stopwords and len(w) > 2]
         
-        if not content_words:
+        if not content_counts:
             return 50.0
         
-        unique_words = len(set(content_words))
-        total_words = len(content_words)
+        unique_words = len(content_counts)
+        total_words = sum(content_counts)
         
         # Type-token ratio
         ttr = (unique_words / total_words) * 100
@@ -303,57 +714,33 @@ class AIDetector:
         
         return round(normalized, 2)
     
-    def _calculate_pattern_score(self, text: str, language: str) -> float:
+    def _calculate_pattern_score(self, profile: TextProfile, language: str) -> float:
         """
         Detect common AI patterns and phrases.
         Lower score = more AI-like
         
         ENHANCED: Detects typical AI connectors and formulaic expressions
         """
-        text_lower = text.lower()
         patterns = self.spanish_ai_patterns if language == 'es' else self.ai_patterns
         
-        # Extended AI connector patterns (very typical of AI)
-        ai_connectors = [
-            r'\bademás\b', r'\bpor lo tanto\b', r'\bsin embargo\b', 
-            r'\ben conclusión\b', r'\bpor otro lado\b', r'\ben primer lugar\b',
-            r'\ben segundo lugar\b', r'\ben resumen\b', r'\bfinalmente\b',
-            r'\basimismo\b', r'\bde igual manera\b', r'\ben consecuencia\b',
-            r'\bpor consiguiente\b', r'\bno obstante\b', r'\ben efecto\b'
-        ]
-        
-        # Human-like connectors (less formal, more natural)
-        human_connectors = [
-            r'\bahora bien\b', r'\beso sí\b', r'\bla cosa es que\b',
-            r'\blo cierto es que\b', r'\bvale la pena\b', r'\bcuriosamente\b',
-            r'\bde hecho\b', r'\bpor cierto\b', r'\ba propósito\b',
-            r'\bentre otras cosas\b', r'\ben cualquier caso\b', r'\bvisto así\b',
-            r'\bmirándolo bien\b', r'\ba fin de cuentas\b', r'\bdicho esto\b'
-        ]
-        
         total_patterns = 0
         pattern_counts = {}
-        ai_connector_count = 0
-        human_connector_count = 0
+        
+        phrase_counts = self._phrase_counts(profile)
         
         # Count standard AI patterns
         for category, pattern_list in patterns.items():
-            pattern_counts[category] = 0
-            for pattern in pattern_list:
-                matches = len(re.findall(pattern, text_lower))
-                pattern_counts[category] += matches
-                total_patterns += matches
+            pattern_counts[category] = sum(phrase_counts[pattern] for pattern in pattern_list)
+            total_patterns += pattern_counts[category]
         
         # Count AI connectors
-        for connector in ai_connectors:
-            ai_connector_count += len(re.findall(connector, text_lower))
+        ai_connector_count = sum(phrase_counts[c] for c in self.ai_connector_phrases)
         
         # Count human connectors
-        for connector in human_connectors:
-            human_connector_count += len(re.findall(connector, text_lower))
+        human_connector_count = sum(phrase_counts[c] for c in self.human_connector_phrases)
         
         # Calculate metrics
-        word_count = len(text.split())
+        word_count = profile.token_count
         if word_count == 0:
             return 50.0
         
@@ -373,23 +760,33 @@ class AIDetector:
         
         return round(human_score, 2)
     
-    def _calculate_readability(self, text: str) -> float:
+    def _phrase_counts(self, profile: TextProfile) -> Counter:
+        """
+        Count every AI pattern and connector in one pass, cached on the profile.
+        """
+        if profile.phrase_counts is None:
+            profile.phrase_counts = self.phrase_matcher.scan(profile.word_segments)
+        return profile.phrase_counts
+    
+    def _calculate_readability(self, profile: TextProfile) -> float:
         """
         Calculate readability complexity.
         AI text tends to be more uniformly readable.
         """
-        sentences = re.split(r'[.!?]+', text)
-        sentences = [s.strip() for s in sentences if s.strip()]
-        
-        if not sentences:
+        return self._readability_score(len(profile.sentence_lengths), profile.token_count, profile.token_chars)
+    
+    def _readability_score(self, sentence_count: int, word_count: int, word_chars: int) -> float:
+        """
+        Readability from sentence, word and character counts.
+        """
+        if not sentence_count:
             return 50.0
         
         # Calculate average sentence length
-        words = text.split()
-        avg_sentence_length = len(words) / len(sentences) if sentences else 0
+        avg_sentence_length = word_count / sentence_count
         
         # Calculate average word length
-        avg_word_length = sum(len(w) for w in words) / len(words) if words else 0
+        avg_word_length = word_chars / word_count if word_count else 0
         
         # Simple readability score (inverse of Flesch score concept)
         # More complex = more likely human in academic context
@@ -402,47 +799,48 @@ class AIDetector:
         
         return round(human_score, 2)
     
-    def _calculate_repetition_score(self, text: str) -> float:
+    def _calculate_repetition_score(self, profile: TextProfile) -> float:
         """
         Calculate phrase and structure repetition.
         AI tends to repeat structures more.
         """
-        # Extract 2-grams and 3-grams
-        words = text.lower().split()
-        
-        if len(words) < 10:
+        # 2-grams and 3-grams (token tuples) are counted in the profile
+        if profile.token_count < 10:
             return 50.0
         
-        bigrams = [' '.join(words[i:i+2]) for i in range(len(words)-1)]
-        trigrams = [' '.join(words[i:i+3]) for i in range(len(words)-2)]
-        
         # Count repetitions
-        bigram_counts = Counter(bigrams)
-        trigram_counts = Counter(trigrams)
+        repeated_bigrams = sum(1 for count in profile.bigram_counts.values() if count > 1)
+        repeated_trigrams = sum(1 for count in profile.trigram_counts.values() if count > 1)
         
-        # Calculate repetition rate
-        repeated_bigrams = sum(1 for count in bigram_counts.values() if count > 1)
-        repeated_trigrams = sum(1 for count in trigram_counts.values() if count > 1)
+        return self._repetition_score(profile.token_count, repeated_bigrams, repeated_trigrams)
+    
+    def _repetition_score(self, word_count: int, repeated_bigrams: int, repeated_trigrams: int) -> float:
+        """
+        Repetition score from the number of distinct repeated 2-grams and 3-grams.
+        """
+        if word_count < 10:
+            return 50.0
         
+        total_ngrams = (word_count - 1) + (word_count - 2)
+        
+        # Calculate repetition rate
         repetition_rate = ((repeated_bigrams + repeated_trigrams * 2) / 
-                          (len(bigrams) + len(trigrams))) * 100
+                          total_ngrams) * 100
         
         # Higher repetition = more AI-like
         human_score = max(0, 100 - (repetition_rate * 3))
         
         return round(human_score, 2)
     
-    def _connector_metrics(self, text: str) -> Dict[str, float]:
+    def _connector_metrics(self, profile: TextProfile) -> Dict[str, float]:
         """
         Analiza el uso de conectores para detectar patrones de IA.
         """
-        t = text.lower()
-        counts = {}
+        phrase_counts = self._phrase_counts(profile)
         
-        # Contar conectores de IA y humanos
+        # Contar conectores de IA y humanos (palabras completas, no subcadenas)
         all_connectors = self.AI_CONNECTORS | self.HUMAN_CONNECTORS
-        for connector in all_connectors:
-            counts[connector] = t.count(connector)
+        counts = {connector: phrase_counts[connector] for connector in all_connectors}
         
         total = sum(counts.values()) or 1
         
@@ -457,26 +855,14 @@ class AIDetector:
             "connector_variety": round(variety * 100, 2)
         }
     
-    def _clause_depth_variance(self, text: str) -> float:
+    def _clause_depth_variance(self, profile: TextProfile) -> float:
         """
         Calcula la varianza en la profundidad de cláusulas por oración.
         Mayor varianza = más humano.
         """
-        import statistics
-        
-        # Dividir por oraciones
-        sents = re.split(r'(?<=[\.\.\?\!])\s+', text.strip())
-        if not sents:
-            return 0.0
-        
-        clause_counts = []
-        for s in sents:
-            # Aproximar cláusulas por signos de puntuación y conjunciones
-            clauses = 1 + len(re.findall(
-                r'[,:;]|\b(que|y|pero|aunque|sin embargo|no obstante)\b', 
-                s.lower()
-            ))
-            clause_counts.append(clauses)
+        # Cláusulas aproximadas por signos de puntuación y conjunciones,
+        # ya contadas por oración en el perfil
+        clause_counts = profile.clause_counts
         
         # Calcular desviación estándar de cláusulas
         if len(clause_counts) > 1:
@@ -487,55 +873,41 @@ class AIDetector:
         """
         Calculate overall AI probability based on all metrics.
         """
-        # Weight for each metric (sum to 1.0)
-        weights = {
-            'perplexity': 0.22,        # Important
-            'burstiness': 0.18,        # Very important  
-            'sentence_variation': 0.13,
-            'vocabulary_diversity': 0.13,
-            'pattern_score': 0.10,
-            'readability': 0.08,
-            'repetition_score': 0.06,
-            'connector_variety': 0.05,     # Nuevo
-            'connector_overuse': 0.03,     # Nuevo (ya invertido)
-            'clause_depth_variance': 0.02  # Nuevo
-        }
-        
+        row = np.array([[metrics.get(name, 50) for name in self.METRIC_WEIGHTS]], dtype=np.float64)
+        return float(self._ai_probability_matrix(row)[0])
+    
+    def _ai_probability_matrix(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        Vectorized AI probability for an N×10 matrix of metrics
+        (columns in METRIC_WEIGHTS order). Returns one value per row.
+        """
         # Calculate weighted score (higher = more human)
-        human_score = sum(
-            metrics.get(metric, 50) * weight 
-            for metric, weight in weights.items()
-        )
+        human_score = matrix @ self._weights_vector
         
         # Convert to AI probability (inverse of human score)
         ai_probability = 100 - human_score
 
         # Heurísticas adicionales (más sensibles a firmas típicas de IA)
-        try:
-            burst = metrics.get('burstiness', 50)
-            perp = metrics.get('perplexity', 50)
-            patt = metrics.get('pattern_score', 50)
-            rep  = metrics.get('repetition_score', 50)
-            conn = metrics.get('connector_overuse', 50)  # ya invertido (bajo = sobreuso IA)
-            vocab= metrics.get('vocabulary_diversity', 50)
-
-            if burst < 45: ai_probability += 10
-            if perp  < 35: ai_probability += 10
-            if patt  < 45: ai_probability += 10
-            if rep   < 45: ai_probability += 8
-            if conn  < 40: ai_probability += 8
-            if vocab < 35: ai_probability += 6
-
-            # Firma combinada de IA: baja burstiness + patrones IA + repetición
-            if burst < 40 and patt < 45 and rep < 50:
-                ai_probability += 12
-        except Exception:
-            pass
+        column = self._metric_columns
+        burst = matrix[:, column['burstiness']]
+        perp = matrix[:, column['perplexity']]
+        patt = matrix[:, column['pattern_score']]
+        rep  = matrix[:, column['repetition_score']]
+        conn = matrix[:, column['connector_overuse']]  # ya invertido (bajo = sobreuso IA)
+        vocab= matrix[:, column['vocabulary_diversity']]
+
+        ai_probability += 10 * (burst < 45)
+        ai_probability += 10 * (perp  < 35)
+        ai_probability += 10 * (patt  < 45)
+        ai_probability += 8 * (rep   < 45)
+        ai_probability += 8 * (conn  < 40)
+        ai_probability += 6 * (vocab < 35)
+
+        # Firma combinada de IA: baja burstiness + patrones IA + repetición
+        ai_probability += 12 * ((burst < 40) & (patt < 45) & (rep < 50))
 
         # Suavizado leve para evitar extremos erráticos, manteniendo sensibilidad
-        ai_probability = max(0.0, min(100.0, ai_probability))
-        
-        return ai_probability
+        return np.clip(ai_probability, 0.0, 100.0)
     
     def _generate_analysis(self, metrics: Dict, ai_probability: float) -> str:
         """
@@ -605,11 +977,13 @@ class AIDetector:
         else:
             return "Muy Probablemente IA"
     
-    def get_detailed_report(self, text: str, language: str = 'es') -> str:
+    def get_detailed_report(self, text: str, language: str = 'es', result: Optional[Dict] = None) -> str:
         """
         Generate a detailed detection report.
+        `result` is an already computed detect(text, language) result.
         """
-        result = self.detect(text, language)
+        if result is None:
+            result = self.detect(text, language)
         
         report = f"""
 ╔══════════════════════════════════════════════════════════════╗
@@ -637,49 +1011,11 @@ class AIDetector:
 """
         return report
 
-    async def calibrate_with_deepseek(self, text: str, base_ai_probability: float, metrics: Dict) -> Optional[float]:
+    async def calibrate_with_deepseek(self, text: str, base_ai_probability: float, metrics: Dict,
+                                      deadline: Optional[float] = None) -> Optional[float]:
         """
-        Calibra opcionalmente la probabilidad IA usando DeepSeek (chat o reasoner) si hay API key.
-        Retorna una probabilidad IA (0-100) o None si no disponible.
+        Calibra opcionalmente la probabilidad IA usando DeepSeek (chat) si hay API key.
+        Retorna una probabilidad IA (0-100) o None si no disponible o si no
+        responde antes de `deadline` segundos.
         """
-        api_key = os.getenv("DEEPSEEK_API_KEY") or os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            return None
-        try:
-            from openai import AsyncOpenAI
-            client = AsyncOpenAI(
-                api_key=api_key,
-                base_url="https://api.deepseek.com" if os.getenv("DEEPSEEK_API_KEY") else None
-            )
-            system = (
-                "ROL: Eres un sistema de análisis de texto avanzado para evaluar la probabilidad de que un texto haya sido generado total o parcialmente por IA. "
-                "Devuelve SOLO un JSON con una clave 'ai_probability' (0–100 float). "
-                "Sigue estas pautas: combina observaciones lingüísticas (patrones, conectores, repetición) con métricas cuantitativas (perplejidad, burstiness, diversidad léxica). "
-                "Reconoce las limitaciones: tu salida es probabilística, no concluyente."
-            )
-            user = (
-                "INSTRUCCIONES:\n"
-                "1) Considera las métricas calculadas como señal cuantitativa.\n"
-                "2) Detecta conectores típicos de IA y estructuras formulaicas.\n"
-                "3) Penaliza longitudes de oración uniformes y repetición de n-gramas; recompensa diversidad y variación.\n"
-                "4) Ajusta la probabilidad cerca de BASE, moviéndola solo si hay evidencia clara.\n\n"
-                "METRICS=" + str({k: round(float(v), 3) for k, v in metrics.items()}) +
-                f"\nBASE={round(float(base_ai_probability), 2)}\n" +
-                "TEXTO (ES):\n" + text[:5000]
-            )
-            # Usar exclusivamente deepseek-chat
-            model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
-            resp = await client.chat.completions.create(
-                model=model,
-                messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
-                temperature=0.2,
-                max_tokens=500
-            )
-            import json as _json
-            content = resp.choices[0].message.content
-            data = _json.loads(content)
-            value = float(data.get("ai_probability"))
-            # Acotar 0-100
-            return max(0.0, min(100.0, value))
-        except Exception:
-            return None
+        return await self.calibrator.calibrate(text, base_ai_probability, metrics, deadline=deadline)
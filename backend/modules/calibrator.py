@@ -0,0 +1,144 @@
+"""
+DeepSeek Calibration
+Optional remote calibration of the detector's AI probability. One pooled
+client is shared by every request, concurrent calls are capped by a
+semaphore sized to the provider's rate limit, each call has a hard timeout
+and results are cached by (text hash, base probability).
+"""
+import asyncio
+import json
+import os
+from typing import Dict, Optional
+
+from modules.result_cache import LRUCache, content_key
+
+
+class DeepSeekCalibrator:
+    """Rate-limited, cached AI probability calibration with DeepSeek (chat)"""
+
+    def __init__(self,
+                 max_concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", 4))
+        if timeout is None:
+            timeout = float(os.getenv("DEEPSEEK_TIMEOUT", 20))
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+        self.cache = LRUCache(
+            max_entries=int(os.getenv("DEEPSEEK_CACHE_SIZE", 1024)),
+            ttl_seconds=float(os.getenv("DEEPSEEK_CACHE_TTL", 86400))
+        )
+        self.client = None
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Llamadas en curso por clave: peticiones iguales esperan la misma respuesta
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.timeouts = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(os.getenv("DEEPSEEK_API_KEY") or os.getenv("OPENAI_API_KEY"))
+
+    def cache_key(self, text: str, base_ai_probability: float) -> str:
+        return content_key(text, round(float(base_ai_probability), 2), self.model)
+
+    async def calibrate(self, text: str, base_ai_probability: float, metrics: Dict,
+                        deadline: Optional[float] = None) -> Optional[float]:
+        """
+        Calibrated AI probability (0-100), or None if calibration is not
+        available, fails, or does not finish before `deadline` seconds.
+        A call cut off by the deadline keeps running in the background
+        (up to the hard timeout) so its result lands in the cache.
+        """
+        if not self.enabled:
+            return None
+        key = self.cache_key(text, base_ai_probability)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._request(key, text, base_ai_probability, metrics))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=deadline)
+        except asyncio.TimeoutError:
+            print(f"[Calibrator] Plazo de {deadline}s agotado, se usa la puntuación local")
+            return None
+        except Exception:
+            return None
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def _get_client(self):
+        """Single AsyncOpenAI client (connection pool) reused by every call"""
+        if self.client is None:
+            from openai import AsyncOpenAI
+            self.client = AsyncOpenAI(
+                api_key=os.getenv("DEEPSEEK_API_KEY") or os.getenv("OPENAI_API_KEY"),
+                base_url="https://api.deepseek.com" if os.getenv("DEEPSEEK_API_KEY") else None,
+                timeout=self.timeout,
+                max_retries=0
+            )
+        return self.client
+
+    async def _request(self, key: str, text: str, base_ai_probability: float, metrics: Dict) -> Optional[float]:
+        try:
+            async with self.semaphore:
+                value = await asyncio.wait_for(
+                    self._complete(text, base_ai_probability, metrics),
+                    timeout=self.timeout
+                )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None
+        except Exception:
+            return None
+        if value is not None:
+            self.cache.put(key, value)
+        return value
+
+    async def _complete(self, text: str, base_ai_probability: float, metrics: Dict) -> Optional[float]:
+        system = (
+            "ROL: Eres un sistema de análisis de texto avanzado para evaluar la probabilidad de que un texto haya sido generado total o parcialmente por IA. "
+            "Devuelve SOLO un JSON con una clave 'ai_probability' (0–100 float). "
+            "Sigue estas pautas: combina observaciones lingüísticas (patrones, conectores, repetición) con métricas cuantitativas (perplejidad, burstiness, diversidad léxica). "
+            "Reconoce las limitaciones: tu salida es probabilística, no concluyente."
+        )
+        user = (
+            "INSTRUCCIONES:\n"
+            "1) Considera las métricas calculadas como señal cuantitativa.\n"
+            "2) Detecta conectores típicos de IA y estructuras formulaicas.\n"
+            "3) Penaliza longitudes de oración uniformes y repetición de n-gramas; recompensa diversidad y variación.\n"
+            "4) Ajusta la probabilidad cerca de BASE, moviéndola solo si hay evidencia clara.\n\n"
+            "METRICS=" + str({k: round(float(v), 3) for k, v in metrics.items()}) +
+            f"\nBASE={round(float(base_ai_probability), 2)}\n" +
+            "TEXTO (ES):\n" + text[:5000]
+        )
+        resp = await self._get_client().chat.completions.create(
+            model=self.model,
+            messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+            temperature=0.2,
+            max_tokens=500
+        )
+        content = resp.choices[0].message.content
+        data = json.loads(content)
+        value = float(data.get("ai_probability"))
+        # Acotar 0-100
+        return max(0.0, min(100.0, value))
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "max_concurrency": self.max_concurrency,
+            "timeout": self.timeout,
+            "inflight": len(self.inflight),
+            "timeouts": self.timeouts,
+            "cache": self.cache.stats()
+        }
@@ -0,0 +1,155 @@
+"""
+Text Chunking
+Splits long texts into chunks of at most max_chars for the rewriter. Cuts
+go at paragraph breaks or sentence ends, never inside parentheses or
+brackets (citations) or right after an abbreviation such as "et al.", and
+never through an entity placeholder. Each chunk carries the whitespace that
+preceded it, so join_chunks rebuilds the text exactly, and the frozen
+entities that occur in it, so its prompt only lists those.
+"""
+import re
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from modules.entity_extractor import LEGACY_PLACEHOLDER_PATTERN, PLACEHOLDER_PATTERN
+from modules.text_analysis import register_lexicon
+
+# Cortes posibles: espacios tras fin de oración y saltos de párrafo (línea en blanco)
+CUT_PATTERN = re.compile(r'(?<=[.!?])\s+|\n[ \t]*\n\s*')
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n[ \t]*\n')
+BRACKET_PATTERN = re.compile(r'[()\[\]]')
+ANY_PLACEHOLDER_PATTERN = re.compile(f'{PLACEHOLDER_PATTERN.pattern}|{LEGACY_PLACEHOLDER_PATTERN.pattern}')
+
+# Un paréntesis abierto hace más de estos caracteres se trata como suelto
+MAX_BRACKET_SPAN = 400
+
+# Abreviaturas tras las que un punto no termina la oración
+ABBREVIATIONS = register_lexicon('abbreviations_es', {
+    'al.', 'et.', 'p.', 'pp.', 'cf.', 'vol.', 'vols.', 'núm.', 'n.', 'ed.', 'eds.',
+    'coord.', 'comp.', 'trad.', 'cap.', 'fig.', 'tab.', 'op.', 'cit.', 'ibíd.', 'ibid.', 'id.',
+    'vs.', 'aprox.', 'sr.', 'sra.', 'dr.', 'dra.', 'prof.', 'ej.', 'p.ej.', 'i.e.', 'e.g.'
+})
+
+
+class TextChunk:
+    """One piece of a split text: its text, the separator before it and its frozen entities"""
+
+    __slots__ = ('text', 'separator', 'entities')
+
+    def __init__(self, text: str, separator: str = "", entities: Optional[List[str]] = None):
+        self.text = text
+        self.separator = separator
+        self.entities = entities if entities is not None else []
+
+    def __repr__(self):
+        return f"TextChunk({self.text[:30]!r}..., separator={self.separator!r}, entities={len(self.entities)})"
+
+
+def cut_points(text: str) -> List[Tuple[int, int, bool]]:
+    """
+    Whitespace spans (start, end, is_paragraph_break) where text may be
+    cut, in order: paragraph breaks, and sentence ends outside
+    parentheses/brackets that do not follow an abbreviation.
+    """
+    brackets = [(m.start(), m.group()) for m in BRACKET_PATTERN.finditer(text)]
+    next_bracket = 0
+    # Posiciones de los paréntesis/corchetes aún abiertos
+    open_brackets: List[int] = []
+    cuts = []
+    for match in CUT_PATTERN.finditer(text):
+        start, end = match.span()
+        while next_bracket < len(brackets) and brackets[next_bracket][0] < start:
+            position, char = brackets[next_bracket]
+            if char in '([':
+                open_brackets.append(position)
+            elif open_brackets:
+                open_brackets.pop()
+            next_bracket += 1
+
+        # Un párrafo nuevo cierra cualquier paréntesis pendiente
+        if PARAGRAPH_BREAK_PATTERN.search(text, start, end):
+            open_brackets.clear()
+            cuts.append((start, end, True))
+            continue
+        if open_brackets and start - open_brackets[-1] <= MAX_BRACKET_SPAN:
+            continue
+        open_brackets.clear()
+        # Última palabra antes del corte (las abreviaturas son cortas: basta mirar 16 caracteres)
+        low = max(0, start - 16)
+        space = max(text.rfind(' ', low, start), text.rfind('\n', low, start), text.rfind('\t', low, start))
+        if (space >= 0 or low == 0) and text[space + 1:start].lower().lstrip('([') in ABBREVIATIONS:
+            continue
+        cuts.append((start, end, False))
+    return cuts
+
+
+def split_chunks(text: str, max_chars: int, frozen_entities: Iterable[str] = ()) -> List[TextChunk]:
+    """
+    Split text into chunks of at most max_chars at the cut points (a piece
+    without any cut point can exceed it), preferring a paragraph break when
+    it leaves the chunk at least half full, and attach to each chunk the
+    frozen entities (placeholders) that occur in it, in order of appearance.
+    """
+    spans: List[Tuple[int, int, str]] = []  # (inicio, fin, separador previo)
+    start, separator = 0, ""
+    # Último corte y último salto de párrafo después de start
+    previous: Optional[Tuple[int, int, bool]] = None
+    paragraph: Optional[Tuple[int, int, bool]] = None
+
+    def cut_before(limit: int):
+        nonlocal start, separator, previous, paragraph
+        while limit - start > max_chars and previous is not None:
+            if paragraph is not None and paragraph[0] - start >= max_chars // 2:
+                chosen = paragraph
+            else:
+                chosen = previous
+            spans.append((start, chosen[0], separator))
+            separator, start = text[chosen[0]:chosen[1]], chosen[1]
+            if previous[0] < start:
+                previous = None
+            if paragraph is not None and paragraph[0] < start:
+                paragraph = None
+
+    if len(text) > max_chars:
+        for cut in cut_points(text):
+            cut_before(cut[0])
+            previous = cut
+            if cut[2]:
+                paragraph = cut
+        cut_before(len(text))
+    spans.append((start, len(text), separator))
+
+    return [TextChunk(text[a:b], sep, entities)
+            for (a, b, sep), entities in zip(spans, _entities_by_span(text, spans, frozen_entities))]
+
+
+def join_chunks(chunks: Sequence[TextChunk], texts: Optional[Sequence[str]] = None) -> str:
+    """Reassemble chunks in order (texts: rewritten text of each chunk, default the chunk's own)"""
+    if texts is None:
+        texts = [chunk.text for chunk in chunks]
+    return "".join(chunk.separator + chunk_text for chunk, chunk_text in zip(chunks, texts))
+
+
+def _entities_by_span(text: str, spans: List[Tuple[int, int, str]],
+                      frozen_entities: Iterable[str]) -> List[List[str]]:
+    """Frozen entities of each span: placeholders in one scan, other values by substring"""
+    frozen = list(dict.fromkeys(frozen_entities))
+    by_span: List[List[str]] = [[] for _ in spans]
+    if not frozen:
+        return by_span
+
+    placeholders = {entity for entity in frozen if ANY_PLACEHOLDER_PATTERN.fullmatch(entity)}
+    span_index = 0
+    for match in ANY_PLACEHOLDER_PATTERN.finditer(text):
+        if match.group() not in placeholders:
+            continue
+        while match.start() >= spans[span_index][1] and span_index + 1 < len(spans):
+            span_index += 1
+        by_span[span_index].append(match.group())
+
+    others = [entity for entity in frozen if entity not in placeholders]
+    for index, (start, end, _) in enumerate(spans):
+        if others:
+            chunk_text = text[start:end]
+            by_span[index].extend(entity for entity in others if entity in chunk_text)
+        by_span[index] = list(dict.fromkeys(by_span[index]))
+    return by_span
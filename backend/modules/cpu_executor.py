@@ -0,0 +1,251 @@
+"""
+CPU Executor for the text pipeline
+Offloads CPU-bound stages (detection, metrics, diff, entity freezing) to a
+warm process pool so long essays don't block the event loop.
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from modules.diff_engine import extend_diff, merge_diff_stats, shift_runs
+
+
+# Umbral por etapa (caracteres de entrada) a partir del cual se usa el pool
+DEFAULT_STAGE_THRESHOLDS = {
+    'detect': 20000,
+    'metrics': 20000,  # change_ratio usa EditDistanceEngine (bit-paralelo o aproximado)
+    'diff': 20000,
+    'freeze': 50000,
+}
+
+# Textos a partir de este tamaño viajan por memoria compartida en vez de pickle
+DEFAULT_SHM_MIN_CHARS = 65536
+
+
+class SharedText:
+    """Handle to a UTF-8 encoded text stored in a shared memory block"""
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+
+# --- Lado del worker -------------------------------------------------------
+
+_worker_modules: Dict[str, Any] = {}
+
+
+def _init_worker():
+    """Build the pipeline modules once per worker process (warm pool)"""
+    from modules.ai_detector import AIDetector
+    from modules.metrics_calculator import MetricsCalculator
+    from modules.entity_extractor import EntityExtractor
+
+    _worker_modules['ai_detector'] = AIDetector()
+    _worker_modules['metrics_calculator'] = MetricsCalculator()
+    _worker_modules['entity_extractor'] = EntityExtractor()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _read_shared_text(handle: SharedText) -> str:
+    shm = SharedMemory(name=handle.name)
+    try:
+        return bytes(shm.buf[:handle.size]).decode('utf-8')
+    finally:
+        shm.close()
+
+
+def _run_stage(stage: str, args: Tuple[Any, ...]) -> Any:
+    """Execute a pipeline stage inside a worker process"""
+    args = tuple(_read_shared_text(a) if isinstance(a, SharedText) else a for a in args)
+
+    if stage == 'detect':
+        return _worker_modules['ai_detector'].detect(*args)
+    if stage == 'detect_many':
+        return _worker_modules['ai_detector'].detect_many(*args)
+    if stage == 'metrics':
+        return _worker_modules['metrics_calculator'].calculate(*args)
+    if stage == 'diff':
+        return _worker_modules['metrics_calculator'].generate_diff_with_stats(*args)
+    if stage == 'diff_segment':
+        return _worker_modules['metrics_calculator'].segment_diff_with_stats(*args)
+    if stage == 'freeze':
+        return _worker_modules['entity_extractor'].extract_and_freeze(*args)
+    raise ValueError(f"Etapa desconocida: {stage}")
+
+
+# --- Lado del servidor -----------------------------------------------------
+
+class CPUExecutor:
+    """
+    Runs CPU-bound pipeline stages inline or in a warm ProcessPoolExecutor.
+
+    Opt-in via CPU_POOL_ENABLED. A stage is offloaded only when its input
+    reaches the stage threshold (CPU_OFFLOAD_MIN_CHARS_<STAGE>); smaller
+    inputs run inline, where the pool round trip would cost more than it saves.
+    """
+
+    def __init__(self,
+                 enabled: Optional[bool] = None,
+                 pool_size: Optional[int] = None,
+                 thresholds: Optional[Dict[str, int]] = None,
+                 shm_min_chars: Optional[int] = None):
+        if enabled is None:
+            enabled = os.getenv("CPU_POOL_ENABLED", "false").lower() == "true"
+        if pool_size is None:
+            pool_size = int(os.getenv("CPU_POOL_SIZE", min(4, os.cpu_count() or 1)))
+        if shm_min_chars is None:
+            shm_min_chars = int(os.getenv("CPU_POOL_SHM_MIN_CHARS", DEFAULT_SHM_MIN_CHARS))
+
+        self.enabled = enabled
+        self.pool_size = max(1, pool_size)
+        self.shm_min_chars = shm_min_chars
+        self.thresholds = {
+            stage: int(os.getenv(f"CPU_OFFLOAD_MIN_CHARS_{stage.upper()}", default))
+            for stage, default in DEFAULT_STAGE_THRESHOLDS.items()
+        }
+        if thresholds:
+            self.thresholds.update(thresholds)
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    async def start(self):
+        """Create the pool and spawn every worker up front, without blocking the event loop"""
+        if not self.enabled or self.pool is not None:
+            return
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.pool_size,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker
+        )
+        # Forzar el arranque de todos los workers ahora, no en la primera petición
+        await asyncio.gather(*(asyncio.wrap_future(self.pool.submit(_ping)) for _ in range(self.pool_size)))
+        print(f"[CPUExecutor] Pool activo ({self.pool_size} procesos)")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def should_offload(self, stage: str, *texts: str) -> bool:
+        """Whether a stage with these inputs goes to the pool"""
+        if self.pool is None:
+            return False
+        size = sum(len(t) for t in texts if isinstance(t, str))
+        return size >= self.thresholds.get(stage, DEFAULT_STAGE_THRESHOLDS[stage])
+
+    async def detect(self, detector, text: str, language: str = 'es') -> Dict:
+        if not self.should_offload('detect', text):
+            return detector.detect(text, language)
+        # La caché vive en este proceso: consultarla antes de ir al pool
+        cached = detector.lookup_cached(text, language)
+        if cached is not None:
+            return cached
+        result = await self._submit('detect', (text, language))
+        if result.get('metrics'):
+            detector.store_cached(text, language, result)
+        return result
+
+    async def detect_many(self, detector, texts: List[str], language: str = 'es') -> List[Dict]:
+        # Un lote nunca corre en el event loop: en el pool si es grande, si no en un hilo
+        if not self.should_offload('detect', *texts):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, detector.detect_many, texts, language)
+        results = await self._submit('detect_many', (list(texts), language))
+        for text, result in zip(texts, results):
+            if result.get('metrics'):
+                detector.store_cached(text, language, result)
+        return results
+
+    async def calculate_metrics(self, calculator, original_text: str, rewritten_text: str,
+                                analysis=None) -> Dict[str, float]:
+        # La caché de análisis del trabajo solo sirve en este proceso (no viaja al pool)
+        if not self.should_offload('metrics', original_text, rewritten_text):
+            return calculator.calculate(original_text, rewritten_text, analysis)
+        return await self._submit('metrics', (original_text, rewritten_text))
+
+    async def generate_diff(self, calculator, original_text: str, rewritten_text: str) -> List[Dict[str, str]]:
+        diff, _ = await self.generate_diff_with_stats(calculator, original_text, rewritten_text)
+        return diff
+
+    async def generate_diff_with_stats(self, calculator, original_text: str, rewritten_text: str,
+                                       diff_format: str = "tokens",
+                                       analysis=None) -> Tuple[List[Any], Dict[str, float]]:
+        if not self.should_offload('diff', original_text, rewritten_text):
+            return calculator.generate_diff_with_stats(original_text, rewritten_text, diff_format, analysis)
+        segments = calculator.paragraph_diff_segments(original_text, rewritten_text)
+        if segments is None:
+            return await self._submit('diff', (original_text, rewritten_text, diff_format))
+        diff: List[Any] = []
+        stats = []
+        async for chunk, chunk_stats in self.iter_diff(calculator, original_text, rewritten_text,
+                                                       diff_format, segments):
+            extend_diff(diff, chunk, diff_format)
+            stats.append(chunk_stats)
+        return diff, merge_diff_stats(stats)
+
+    async def iter_diff(self, calculator, original_text: str, rewritten_text: str,
+                        diff_format: str = "tokens",
+                        segments=None) -> AsyncIterator[Tuple[List[Any], Dict[str, float]]]:
+        """
+        Paragraph-aligned diff (MetricsCalculator.iter_paragraph_diff) with
+        the segments spread over the pool. Yields (diff, stats) per segment
+        in document order as soon as each one and its predecessors are
+        done; at most two segments per worker are in flight.
+        """
+        if segments is None:
+            segments = calculator.paragraph_diff_segments(original_text, rewritten_text) or \
+                [(0, len(original_text), 0, len(rewritten_text))]
+        if self.pool is None:
+            for item in calculator.iter_paragraph_diff(original_text, rewritten_text, diff_format, segments):
+                yield item
+            return
+
+        window = 2 * self.pool_size
+        pending: List[asyncio.Future] = []
+        next_segment = 0
+        try:
+            for a0, a1, b0, b1 in segments:
+                while len(pending) < window and next_segment < len(segments):
+                    s0, s1, t0, t1 = segments[next_segment]
+                    pending.append(asyncio.ensure_future(self._submit(
+                        'diff_segment', (original_text[s0:s1], rewritten_text[t0:t1], diff_format))))
+                    next_segment += 1
+                chunk, stats = await pending.pop(0)
+                if diff_format == "runs":
+                    chunk = shift_runs(chunk, a0, b0)
+                yield chunk, stats
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def extract_and_freeze(self, extractor, text: str):
+        # El FreezeContext viaja de vuelta con el mapeo de placeholders: el extractor no guarda estado
+        if not self.should_offload('freeze', text):
+            return extractor.extract_and_freeze(text)
+        return await self._submit('freeze', (text,))
+
+    async def _submit(self, stage: str, args: Tuple[Any, ...]) -> Any:
+        blocks: List[SharedMemory] = []
+        try:
+            packed = []
+            for arg in args:
+                if isinstance(arg, str) and len(arg) >= self.shm_min_chars:
+                    data = arg.encode('utf-8')
+                    shm = SharedMemory(create=True, size=max(1, len(data)))
+                    shm.buf[:len(data)] = data
+                    blocks.append(shm)
+                    packed.append(SharedText(shm.name, len(data)))
+                else:
+                    packed.append(arg)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, _run_stage, stage, tuple(packed))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
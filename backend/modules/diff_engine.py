@@ -0,0 +1,493 @@
+"""
+Diff Engine
+Token diff for generate_diff. Tokens are interned to integer IDs and
+aligned with a histogram diff (as in git/JGit): each region is split on
+the common run anchored at its least frequent shared token, recursively,
+and regions where every shared token is too frequent fall back to Myers'
+O(ND) algorithm. Repeated Spanish function words never become anchors,
+so they don't derail the alignment the way SequenceMatcher's autojunk does.
+"""
+import heapq
+import zlib
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from modules.text_analysis import TOKEN_PATTERN
+
+# Tokens que aparecen más veces en la región no se usan como ancla
+MAX_CHAIN_LENGTH = 64
+# Regiones sin ancla que necesitan más ediciones se marcan como reemplazo completo
+MAX_MYERS_EDITS = 128
+
+# Diff por párrafos: mismos párrafos que TextRewriter (text.split('\n\n'))
+PARAGRAPH_SEPARATOR = '\n\n'
+# Tamaño de la firma MinHash (bottom-k) de cada párrafo
+PARAGRAPH_SKETCH_SIZE = 32
+# Similitud mínima (Jaccard estimado) para emparejar dos párrafos
+PARAGRAPH_MIN_SIMILARITY = 0.2
+# Desviación máxima respecto a la diagonal al alinear párrafos
+PARAGRAPH_BAND = 8
+
+# Formatos de diff: un objeto por token o tramos de offsets
+DIFF_FORMATS = ('tokens', 'runs')
+
+Opcode = Tuple[str, int, int, int, int]
+# (op, inicio, fin en el original, inicio, fin en el reescrito)
+DiffRun = Tuple[str, int, int, int, int]
+# (inicio, fin) en el original y (inicio, fin) en el reescrito, en caracteres
+Segment = Tuple[int, int, int, int]
+
+
+def intern_tokens(original: Sequence[str], rewritten: Sequence[str]) -> Tuple[List[int], List[int]]:
+    """Map both token sequences to shared integer IDs"""
+    ids: Dict[str, int] = {}
+    a = [ids.setdefault(token, len(ids)) for token in original]
+    b = [ids.setdefault(token, len(ids)) for token in rewritten]
+    return a, b
+
+
+def matching_blocks(a: Sequence[int], b: Sequence[int]) -> List[Tuple[int, int, int]]:
+    """
+    Equal runs (i, j, length) between a and b, sorted and non-overlapping.
+    """
+    # Posiciones (ordenadas) de cada token en a; las regiones las acotan con bisect
+    positions: Dict[int, List[int]] = {}
+    for i, token in enumerate(a):
+        positions.setdefault(token, []).append(i)
+
+    # Primer corte (patience): tokens únicos en ambos textos, en orden creciente
+    blocks: List[Tuple[int, int, int]] = []
+    stack = []
+    i0 = j0 = 0
+    for i, j in _unique_anchors(a, b, positions):
+        blocks.append((i, j, 1))
+        stack.append((i0, i, j0, j))
+        i0, j0 = i + 1, j + 1
+    stack.append((i0, len(a), j0, len(b)))
+
+    while stack:
+        a0, a1, b0, b1 = stack.pop()
+
+        # Prefijo y sufijo comunes
+        start = 0
+        while a0 + start < a1 and b0 + start < b1 and a[a0 + start] == b[b0 + start]:
+            start += 1
+        if start:
+            blocks.append((a0, b0, start))
+            a0 += start
+            b0 += start
+        end = 0
+        while a0 < a1 - end and b0 < b1 - end and a[a1 - end - 1] == b[b1 - end - 1]:
+            end += 1
+        if end:
+            blocks.append((a1 - end, b1 - end, end))
+            a1 -= end
+            b1 -= end
+        if a0 == a1 or b0 == b1:
+            continue
+
+        anchor = _histogram_anchor(a, a0, a1, b, b0, b1, positions)
+        if anchor is not None:
+            i, j, length = anchor
+            blocks.append(anchor)
+            # La región izquierda se procesa antes (LIFO); el orden final se fija al ordenar
+            stack.append((i + length, a1, j + length, b1))
+            stack.append((a0, i, b0, j))
+        else:
+            blocks.extend(_myers_blocks(a, a0, a1, b, b0, b1))
+
+    blocks.sort()
+    return blocks
+
+
+def _unique_anchors(a: Sequence[int], b: Sequence[int],
+                    positions: Dict[int, List[int]]) -> List[Tuple[int, int]]:
+    """
+    Pairs (i, j) of tokens that occur exactly once in a and once in b,
+    reduced to their longest increasing subsequence (patience sorting).
+    """
+    b_counts: Dict[int, int] = {}
+    for token in b:
+        b_counts[token] = b_counts.get(token, 0) + 1
+    pairs = [(positions[token][0], j) for j, token in enumerate(b)
+             if b_counts[token] == 1 and len(positions.get(token, ())) == 1]
+    pairs.sort()
+
+    # Pilas de paciencia sobre j; back enlaza cada par con su predecesor
+    tails: List[int] = []
+    tail_index: List[int] = []
+    back = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        if pile:
+            back[index] = tail_index[pile - 1]
+        if pile == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[pile] = j
+            tail_index[pile] = index
+
+    anchors = []
+    index = tail_index[-1] if tail_index else -1
+    while index >= 0:
+        anchors.append(pairs[index])
+        index = back[index]
+    anchors.reverse()
+    return anchors
+
+
+def _histogram_anchor(a: Sequence[int], a0: int, a1: int,
+                      b: Sequence[int], b0: int, b1: int,
+                      positions: Dict[int, List[int]]):
+    """Longest common run through the least frequent token shared by both regions"""
+    full_range = a0 == 0 and a1 == len(a)
+    best = None
+    best_count = MAX_CHAIN_LENGTH
+    best_length = 0
+    j = b0
+    while j < b1:
+        occurrences = positions.get(b[j])
+        if occurrences is None:
+            j += 1
+            continue
+        if full_range:
+            lo, hi = 0, len(occurrences)
+        else:
+            lo = bisect_left(occurrences, a0)
+            hi = bisect_left(occurrences, a1, lo)
+        count = hi - lo
+        if count == 0 or count > best_count:
+            j += 1
+            continue
+        next_j = j + 1
+        for i in occurrences[lo:hi]:
+            # Extender la coincidencia hacia atrás y hacia delante dentro de la región
+            si, sj = i, j
+            while si > a0 and sj > b0 and a[si - 1] == b[sj - 1]:
+                si -= 1
+                sj -= 1
+            ei, ej = i + 1, j + 1
+            while ei < a1 and ej < b1 and a[ei] == b[ej]:
+                ei += 1
+                ej += 1
+            length = ei - si
+            if count < best_count or length > best_length:
+                best = (si, sj, length)
+                best_count = count
+                best_length = length
+            if ej > next_j:
+                next_j = ej
+        j = next_j
+    return best
+
+
+def _myers_blocks(a: Sequence[int], a0: int, a1: int,
+                  b: Sequence[int], b0: int, b1: int) -> List[Tuple[int, int, int]]:
+    """
+    Equal runs of a shortest edit script (Myers 1986) for a region, or no
+    runs at all (the whole region is a replace) if it needs more than
+    MAX_MYERS_EDITS insertions and deletions.
+    """
+    n, m = a1 - a0, b1 - b0
+    if abs(n - m) > MAX_MYERS_EDITS:
+        return []
+    max_d = min(n + m, MAX_MYERS_EDITS)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v[:])
+        done = False
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                done = True
+                break
+        if done:
+            break
+    else:
+        return []
+
+    # Recorrer la traza hacia atrás recogiendo las diagonales (snakes)
+    blocks = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        previous = trace[d]
+        k = x - y
+        if k == -d or (k != d and previous[offset + k - 1] < previous[offset + k + 1]):
+            prev_k = k + 1
+            mid_x = previous[offset + prev_k]
+        else:
+            prev_k = k - 1
+            mid_x = previous[offset + prev_k] + 1
+        mid_y = mid_x - k
+        if x > mid_x:
+            blocks.append((a0 + mid_x, b0 + mid_y, x - mid_x))
+        x = previous[offset + prev_k]
+        y = x - prev_k
+    if x > 0:
+        blocks.append((a0, b0, x))
+    return blocks
+
+
+def opcodes_from_blocks(blocks: List[Tuple[int, int, int]], len_a: int, len_b: int) -> List[Opcode]:
+    """difflib-style opcodes (equal/replace/delete/insert) from matching blocks"""
+    opcodes: List[Opcode] = []
+    i = j = 0
+    for bi, bj, length in blocks + [(len_a, len_b, 0)]:
+        if i < bi and j < bj:
+            opcodes.append(('replace', i, bi, j, bj))
+        elif i < bi:
+            opcodes.append(('delete', i, bi, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, bi, j, bj))
+        if length:
+            if opcodes and opcodes[-1][0] == 'equal':
+                _, ei, _, ej, _ = opcodes[-1]
+                opcodes[-1] = ('equal', ei, bi + length, ej, bj + length)
+            else:
+                opcodes.append(('equal', bi, bi + length, bj, bj + length))
+        i, j = bi + length, bj + length
+    return opcodes
+
+
+class TokenDiff:
+    """Opcodes between two token lists plus aggregate change statistics"""
+
+    def __init__(self, original: Sequence[str], rewritten: Sequence[str],
+                 token_ids: Optional[Tuple[List[int], List[int]]] = None,
+                 opcodes: Optional[List[Opcode]] = None):
+        self.original = original
+        self.rewritten = rewritten
+        if opcodes is not None:
+            # Opcodes ya calculados (p. ej. el diff incremental de LiveMetricsSession)
+            self.opcodes: List[Opcode] = opcodes
+            return
+        # IDs ya internados (vocabulario compartido de un AnalysisCache) o internado local
+        a, b = token_ids if token_ids is not None else intern_tokens(original, rewritten)
+        self.opcodes = opcodes_from_blocks(matching_blocks(a, b), len(a), len(b))
+
+    def items(self) -> List[Dict[str, str]]:
+        """One {"type", "token"} dict per token (replace = delete + insert)"""
+        diff = []
+        for tag, i1, i2, j1, j2 in self.opcodes:
+            if tag == 'equal':
+                diff.extend({"type": "equal", "token": token} for token in self.original[i1:i2])
+                continue
+            if tag in ('delete', 'replace'):
+                diff.extend({"type": "delete", "token": token} for token in self.original[i1:i2])
+            if tag in ('insert', 'replace'):
+                diff.extend({"type": "insert", "token": token} for token in self.rewritten[j1:j2])
+        return diff
+
+    def runs(self, original_offsets: Sequence[int], rewritten_offsets: Sequence[int]) -> List[DiffRun]:
+        """
+        Run-length diff: (op, a_start, a_end, b_start, b_end) character
+        ranges into the original (a) and rewritten (b) texts; delete runs
+        have an empty b range and insert runs an empty a range. offsets[k]
+        is where token k starts, plus the text length as a last entry; runs
+        reach up to the next token, so joining the a (b) ranges of all runs
+        in order rebuilds the original (rewritten) text exactly, whitespace
+        included.
+        """
+        def a_at(k: int) -> int:
+            return original_offsets[k] if k else 0
+
+        def b_at(k: int) -> int:
+            return rewritten_offsets[k] if k else 0
+
+        runs: List[DiffRun] = []
+        for tag, i1, i2, j1, j2 in self.opcodes:
+            if tag == 'equal':
+                runs.append(('equal', a_at(i1), a_at(i2), b_at(j1), b_at(j2)))
+                continue
+            if tag in ('delete', 'replace'):
+                runs.append(('delete', a_at(i1), a_at(i2), b_at(j1), b_at(j1)))
+            if tag in ('insert', 'replace'):
+                runs.append(('insert', a_at(i2), a_at(i2), b_at(j1), b_at(j2)))
+
+        # Un texto sin tokens (solo espacios) no tiene offsets de los que colgar: el
+        # último tramo llega hasta el final de ambos textos
+        a_len, b_len = original_offsets[-1], rewritten_offsets[-1]
+        if runs:
+            op, a1, _, b1, _ = runs[-1]
+            runs[-1] = (op, a1, a_len, b1, b_len)
+        elif a_len or b_len:
+            runs.append(('equal', 0, a_len, 0, b_len))
+        return runs
+
+    def stats(self) -> Dict[str, float]:
+        """Token counts per operation, number of changed hunks and similarity"""
+        equal = inserted = deleted = hunks = 0
+        for tag, i1, i2, j1, j2 in self.opcodes:
+            if tag == 'equal':
+                equal += i2 - i1
+                continue
+            hunks += 1
+            deleted += i2 - i1
+            inserted += j2 - j1
+        total = len(self.original) + len(self.rewritten)
+        return {
+            "original_tokens": len(self.original),
+            "rewritten_tokens": len(self.rewritten),
+            "equal_tokens": equal,
+            "inserted_tokens": inserted,
+            "deleted_tokens": deleted,
+            "changed_hunks": hunks,
+            "similarity": round(2 * equal / total, 4) if total else 1.0
+        }
+
+
+# --- Diff alineado por párrafos ---------------------------------------------
+
+def split_paragraphs(text: str) -> List[int]:
+    """
+    Start offsets of the paragraphs of text (as text.split('\\n\\n')),
+    plus len(text) as a last entry. Each paragraph runs up to the next
+    start, separator included.
+    """
+    starts = [0]
+    position = text.find(PARAGRAPH_SEPARATOR)
+    while position >= 0:
+        starts.append(position + len(PARAGRAPH_SEPARATOR))
+        position = text.find(PARAGRAPH_SEPARATOR, position + len(PARAGRAPH_SEPARATOR))
+    starts.append(len(text))
+    return starts
+
+
+def paragraph_sketch(paragraph: str) -> frozenset:
+    """MinHash signature (the k smallest word hashes) of a paragraph"""
+    # crc32 y no hash(): la alineación debe ser la misma en cualquier proceso
+    hashes = {zlib.crc32(token.encode('utf-8')) for token in set(TOKEN_PATTERN.findall(paragraph.lower()))}
+    return frozenset(heapq.nsmallest(PARAGRAPH_SKETCH_SIZE, hashes))
+
+
+def sketch_similarity(a: frozenset, b: frozenset) -> float:
+    """Jaccard similarity of two sketches (an estimate of the paragraphs' word overlap)"""
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+
+def align_paragraphs(a: Sequence[frozenset], b: Sequence[frozenset]) -> List[Tuple[int, int]]:
+    """
+    Monotone pairs (i, j) of similar paragraphs maximizing the total
+    similarity, by dynamic programming over a band around the diagonal.
+    """
+    n, m = len(a), len(b)
+    if not n or not m:
+        return []
+    band = PARAGRAPH_BAND + (max(n, m) + min(n, m) - 1) // min(n, m)
+
+    # score[(i, j)]: mejor alineación de a[:i] con b[:j] (solo celdas de la banda)
+    score: Dict[Tuple[int, int], float] = {}
+    move: Dict[Tuple[int, int], int] = {}
+    for i in range(n + 1):
+        center = i * m // n
+        for j in range(max(0, center - band), min(m, center + band) + 1):
+            if i == 0 and j == 0:
+                score[0, 0] = 0.0
+                continue
+            best, step = -1.0, 0
+            if (i - 1, j) in score:
+                best, step = score[i - 1, j], 1
+            if (i, j - 1) in score and score[i, j - 1] > best:
+                best, step = score[i, j - 1], 2
+            if (i - 1, j - 1) in score:
+                similarity = sketch_similarity(a[i - 1], b[j - 1])
+                if similarity >= PARAGRAPH_MIN_SIMILARITY and score[i - 1, j - 1] + similarity > best:
+                    best, step = score[i - 1, j - 1] + similarity, 3
+            if step:
+                score[i, j] = best
+                move[i, j] = step
+
+    pairs = []
+    i, j = n, m
+    if (i, j) not in move:
+        return pairs
+    while (i, j) != (0, 0):
+        step = move[i, j]
+        if step == 3:
+            pairs.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif step == 1:
+            i -= 1
+        else:
+            j -= 1
+    pairs.reverse()
+    return pairs
+
+
+def paragraph_segments(original: str, rewritten: str) -> List[Segment]:
+    """
+    Split both texts into aligned segments that can be diffed
+    independently: every pair of matched paragraphs, and every run of
+    unmatched paragraphs between two matches.
+    """
+    a_starts = split_paragraphs(original)
+    b_starts = split_paragraphs(rewritten)
+    a = [paragraph_sketch(original[a_starts[k]:a_starts[k + 1]]) for k in range(len(a_starts) - 1)]
+    b = [paragraph_sketch(rewritten[b_starts[k]:b_starts[k + 1]]) for k in range(len(b_starts) - 1)]
+
+    segments: List[Segment] = []
+    i = j = 0
+    for pi, pj in align_paragraphs(a, b) + [(len(a), len(b))]:
+        if pi > i or pj > j:
+            segments.append((a_starts[i], a_starts[pi], b_starts[j], b_starts[pj]))
+        if pi < len(a):
+            segments.append((a_starts[pi], a_starts[pi + 1], b_starts[pj], b_starts[pj + 1]))
+        i, j = pi + 1, pj + 1
+
+    # Un tramo del original sin tokens (solo espacios) no produciría runs que lo
+    # cubran: se une al tramo siguiente (o al anterior si es el último)
+    merged: List[Segment] = []
+    carry = None
+    for a0, a1, b0, b1 in segments:
+        if carry is not None:
+            a0, b0 = carry
+            carry = None
+        if a1 > a0 and not original[a0:a1].strip():
+            carry = (a0, b0)
+            continue
+        merged.append((a0, a1, b0, b1))
+    if carry is not None:
+        if merged:
+            a0, _, b0, _ = merged.pop()
+            carry = (a0, b0)
+        merged.append((carry[0], len(original), carry[1], len(rewritten)))
+    return merged
+
+
+def shift_runs(runs: Sequence[DiffRun], original_start: int, rewritten_start: int) -> List[DiffRun]:
+    """Runs of a segment diff moved to document offsets"""
+    return [(op, a1 + original_start, a2 + original_start, b1 + rewritten_start, b2 + rewritten_start)
+            for op, a1, a2, b1, b2 in runs]
+
+
+def extend_diff(diff: List[Any], chunk: Sequence[Any], diff_format: str = "tokens"):
+    """Append a segment's diff, joining equal runs that meet at the segment boundary"""
+    if diff_format == "runs" and diff and chunk:
+        op, a1, a2, b1, b2 = diff[-1]
+        if op == chunk[0][0] == 'equal' and (a2, b2) == (chunk[0][1], chunk[0][3]):
+            diff[-1] = ('equal', a1, chunk[0][2], b1, chunk[0][4])
+            chunk = chunk[1:]
+    diff.extend(chunk)
+
+
+def merge_diff_stats(stats: Sequence[Dict[str, float]]) -> Dict[str, float]:
+    """TokenDiff.stats() of a whole document from the stats of its segments"""
+    merged = {key: sum(s[key] for s in stats) for key in (
+        "original_tokens", "rewritten_tokens", "equal_tokens",
+        "inserted_tokens", "deleted_tokens", "changed_hunks")}
+    total = merged["original_tokens"] + merged["rewritten_tokens"]
+    merged["similarity"] = round(2 * merged["equal_tokens"] / total, 4) if total else 1.0
+    return merged
@@ -0,0 +1,206 @@
+"""
+Edit Distance Engine
+Character-level Levenshtein distance for change_ratio, with pluggable
+backends:
+
+- native: the C extension from python-Levenshtein, when importable
+- bitparallel: Myers/Hyyrö bit-vector algorithm on Python integers
+  (one pass over the longer text, O(n·m/64) word operations), with an
+  early cutoff once the distance is known to exceed a bound
+- dp: the classic O(n·m) dynamic program (reference implementation)
+
+Very long texts can use an approximate mode that aligns the texts on
+anchor substrings and adds up the distances of the aligned chunks. The
+result is an upper bound of the exact distance, reported together with
+a lower bound so the error is always known.
+"""
+import os
+from collections import Counter
+from typing import Callable, Optional, Tuple
+
+try:
+    import Levenshtein as _native_levenshtein
+except ImportError:  # python-Levenshtein es opcional
+    _native_levenshtein = None
+
+
+def dp_distance(s1: str, s2: str, max_distance: Optional[int] = None) -> int:
+    """Levenshtein distance by dynamic programming (row by row)"""
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+
+    if max_distance is not None and len(s1) - len(s2) > max_distance:
+        return max_distance + 1
+    if len(s2) == 0:
+        return len(s1)
+
+    previous_row = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            insertions = previous_row[j + 1] + 1
+            deletions = current_row[j] + 1
+            substitutions = previous_row[j] + (c1 != c2)
+            current_row.append(min(insertions, deletions, substitutions))
+        previous_row = current_row
+        if max_distance is not None and min(previous_row) > max_distance:
+            return max_distance + 1
+
+    if max_distance is not None and previous_row[-1] > max_distance:
+        return max_distance + 1
+    return previous_row[-1]
+
+
+def myers_distance(s1: str, s2: str, max_distance: Optional[int] = None) -> int:
+    """
+    Levenshtein distance with the bit-parallel algorithm of Myers (1999)
+    as adapted by Hyyrö (2001). Column j of the DP matrix is encoded as
+    vertical +1/-1 delta bit-vectors over the shorter string, so each
+    character of the longer string costs a constant number of big-integer
+    operations.
+
+    With max_distance, returns max_distance + 1 as soon as the distance is
+    known to exceed it (length difference outside the band, or the running
+    score too high to come back down in the remaining columns).
+    """
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    n, m = len(s1), len(s2)
+    if max_distance is not None and n - m > max_distance:
+        return max_distance + 1
+    if m == 0:
+        return n
+
+    # Máscara de aparición de cada carácter del patrón (el texto más corto)
+    peq = {}
+    for i, char in enumerate(s2):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    last_bit = 1 << (m - 1)
+    pv, mv = mask, 0
+    score = m
+    for j, char in enumerate(s1):
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last_bit:
+            score += 1
+        elif mh & last_bit:
+            score -= 1
+        # La primera fila de la DP crece 1 por columna: se desplaza un 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+        # Cada columna restante puede bajar la puntuación como mucho en 1
+        if max_distance is not None and score - (n - j - 1) > max_distance:
+            return max_distance + 1
+    return score
+
+
+def native_distance(s1: str, s2: str, max_distance: Optional[int] = None) -> int:
+    """Levenshtein distance from the python-Levenshtein C extension"""
+    if max_distance is None:
+        return _native_levenshtein.distance(s1, s2)
+    return _native_levenshtein.distance(s1, s2, score_cutoff=max_distance)
+
+
+def distance_lower_bound(s1: str, s2: str) -> int:
+    """
+    Cheap lower bound of the edit distance: the length difference, and half
+    the L1 distance between character histograms (a substitution changes
+    two histogram counts, an insertion or deletion changes one).
+    """
+    histogram = Counter(s1)
+    histogram.subtract(Counter(s2))
+    l1 = sum(abs(count) for count in histogram.values())
+    return max(abs(len(s1) - len(s2)), (l1 + 1) // 2)
+
+
+BACKENDS = {
+    'native': native_distance,
+    'bitparallel': myers_distance,
+    'dp': dp_distance,
+}
+
+
+class EditDistanceEngine:
+    """
+    Selects an edit distance backend and switches to the approximate mode
+    for texts of at least approx_min_chars characters.
+    """
+
+    def __init__(self,
+                 backend: Optional[str] = None,
+                 approx_min_chars: Optional[int] = None,
+                 chunk_chars: Optional[int] = None):
+        if backend is None:
+            backend = os.getenv("EDIT_DISTANCE_BACKEND", "auto")
+        if approx_min_chars is None:
+            approx_min_chars = int(os.getenv("EDIT_DISTANCE_APPROX_MIN_CHARS", 200000))
+        if chunk_chars is None:
+            chunk_chars = int(os.getenv("EDIT_DISTANCE_CHUNK_CHARS", 4000))
+
+        if backend == 'auto':
+            backend = 'native' if _native_levenshtein is not None else 'bitparallel'
+        if backend == 'native' and _native_levenshtein is None:
+            print("[EditDistance] python-Levenshtein no disponible, usando bitparallel")
+            backend = 'bitparallel'
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend de distancia desconocido: {backend}")
+
+        self.backend = backend
+        self.distance_fn: Callable[..., int] = BACKENDS[backend]
+        self.approx_min_chars = approx_min_chars
+        self.chunk_chars = max(64, chunk_chars)
+
+    def distance(self, s1: str, s2: str, max_distance: Optional[int] = None) -> int:
+        """Exact distance (or max_distance + 1 once it is exceeded)"""
+        return self.distance_fn(s1, s2, max_distance)
+
+    def approximate(self, s1: str, s2: str, anchor_chars: int = 24) -> Tuple[int, int]:
+        """
+        (upper_bound, lower_bound) of the edit distance for long texts.
+
+        s1 is cut every chunk_chars characters; each cut's following
+        anchor_chars characters are searched in s2 near the expected
+        position, and kept only if they occur once there. Matched cuts split both texts into aligned chunks whose
+        exact distances add up to a valid (not necessarily optimal) edit
+        script: an upper bound that equals the exact distance whenever the
+        anchors lie on an optimal alignment.
+        """
+        n, m = len(s1), len(s2)
+        cuts1, cuts2 = [0], [0]
+        window = self.chunk_chars // 2
+        position = self.chunk_chars
+        while position + anchor_chars <= n:
+            anchor = s1[position:position + anchor_chars]
+            # Posición esperada: avance proporcional desde el último corte alineado
+            expected = cuts2[-1] + round((position - cuts1[-1]) * m / n)
+            start = max(cuts2[-1], expected - window)
+            end = min(m, expected + window + anchor_chars)
+            found = s2.find(anchor, start, end)
+            # Solo anclas sin ambigüedad dentro de la ventana
+            if found >= 0 and s2.find(anchor, found + 1, end) < 0:
+                cuts1.append(position)
+                cuts2.append(found)
+            position += self.chunk_chars
+        cuts1.append(n)
+        cuts2.append(m)
+
+        upper = 0
+        for i in range(len(cuts1) - 1):
+            upper += self.distance_fn(s1[cuts1[i]:cuts1[i + 1]], s2[cuts2[i]:cuts2[i + 1]])
+        return upper, distance_lower_bound(s1, s2)
+
+    def change_distance(self, s1: str, s2: str) -> int:
+        """
+        Distance used for change ratios: exact below approx_min_chars,
+        otherwise the approximate upper bound (never under-reports changes).
+        """
+        if max(len(s1), len(s2)) >= self.approx_min_chars:
+            return self.approximate(s1, s2)[0]
+        return self.distance(s1, s2)
@@ -1,7 +1,157 @@
+import os
 import re
-from typing import List, Tuple, Dict
+from collections import deque
+from types import MappingProxyType
+from typing import Iterable, Iterator, List, Mapping, Dict, Union
 import uuid
 
+# Obligatorio (requirements.txt): re no admite timeout= y sin él la búsqueda no tiene tiempo máximo
+import regex as _regex
+
+from modules.text_analysis import register_lexicon
+
+
+# Placeholders generados por extract_and_freeze: [E<n>] (3-4 tokens del modelo frente a
+# los ~12 de __ENTITY_<n>_<8 hex>__, que aparecen en el prompt y otra vez en la respuesta)
+PLACEHOLDER_PATTERN = re.compile(r'\[E\d+\]')
+# Formato largo, solo si el texto original ya contiene algo parecido a [E<n>]
+LEGACY_PLACEHOLDER_PATTERN = re.compile(r'__ENTITY_\d+_[0-9a-f]{8}__')
+
+# Variantes que el modelo produce a veces: mayúsculas/minúsculas cambiadas,
+# espacios de más o guiones bajos perdidos (los corchetes se exigen: una
+# entidad como [12] queda como [[E0]])
+FUZZY_PLACEHOLDER_PATTERN = re.compile(r'\[\s*E\s*(\d+)\s*\]', re.IGNORECASE)
+FUZZY_LEGACY_PLACEHOLDER_PATTERN = re.compile(
+    r'(?<![^\W_])_*ENTITY[\s_]*(\d+)[\s_]*([0-9a-f]{8})_*', re.IGNORECASE
+)
+
+
+# Meses para las fechas "<mes> <día>, <año>" (en minúsculas; el patrón ignora mayúsculas)
+MONTH_NAMES = register_lexicon('month_names_es_en', {
+    'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto',
+    'septiembre', 'setiembre', 'octubre', 'noviembre', 'diciembre',
+    'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+    'september', 'october', 'november', 'december'
+})
+
+
+# Palabras y expresiones que nunca se congelan (se comparan tal cual y en minúsculas)
+COMMON_WORDS = register_lexicon('entity_common_words_es', {
+    'El', 'La', 'Los', 'Las', 'Un', 'Una', 'De', 'Del', 'Al', 'En', 'Con', 'Por', 'Para',
+    'Este', 'Esta', 'Estos', 'Estas', 'Ese', 'Esa', 'Esos', 'Esas', 'Aquel', 'Aquella',
+    'Que', 'Quien', 'Como', 'Cuando', 'Donde', 'Porque', 'Si', 'No', 'Muy', 'Más', 'Menos',
+    'Todo', 'Toda', 'Todos', 'Todas', 'Otro', 'Otra', 'Otros', 'Otras', 'Mismo', 'Misma',
+    'También', 'Solo', 'Sólo', 'Así', 'Aquí', 'Allí', 'Ahí', 'Ahora', 'Antes', 'Después',
+    'Durante', 'Mientras', 'Según', 'Sin', 'Sobre', 'Entre', 'Hacia', 'Hasta', 'Desde',
+    # Common words that might be capitalized at sentence start
+    'Texto', 'Prueba', 'Ejemplo', 'Caso', 'Resultado', 'Conclusión', 'Introducción',
+    'Desarrollo', 'Análisis', 'Estudio', 'Investigación', 'Método', 'Proceso', 'Sistema',
+    'Educación', 'Salud', 'Programas', 'Campaña', 'Información', 'Recursos', 'Acceso',
+    'Menstruación', 'Niñas', 'Familias', 'Gobiernos', 'Sociedad', 'Respeto', 'Igualdad'
+})
+
+COMMON_PHRASES = register_lexicon('entity_common_phrases_es', {
+    'texto de prueba', 'texto de ejemplo', 'por ejemplo',
+    'en conclusión', 'en resumen', 'por tanto', 'sin embargo',
+    'de igual manera', 'de este modo', 'en este sentido',
+    'según el estudio', 'de acuerdo con', 'por otra parte'
+})
+
+# Tipo de entidad (grupo del patrón combinado) -> clave de get_entity_stats
+ENTITY_STAT_KEYS = {'iso_dates': 'dates'}
+
+
+class FreezeContext:
+    """
+    Result of freezing one text: the frozen entities, the text with
+    placeholders, the placeholder -> entity map and the type of each entity
+    (the EntityExtractor.patterns key that matched it). Immutable, and owned by
+    the request that created it, so one EntityExtractor can serve many
+    concurrent jobs. Unpacks as (frozen_entities, processed_text).
+    """
+
+    __slots__ = ('entities', 'processed_text', 'placeholders', 'entity_types', 'timed_out')
+
+    def __init__(self, entities: Iterable[str], processed_text: str, placeholders: Mapping[str, str],
+                 entity_types: Iterable[str] = (), timed_out: bool = False):
+        object.__setattr__(self, 'entities', tuple(entities))
+        object.__setattr__(self, 'processed_text', processed_text)
+        object.__setattr__(self, 'placeholders', MappingProxyType(dict(placeholders)))
+        object.__setattr__(self, 'entity_types', tuple(entity_types))
+        # True si la búsqueda agotó ENTITY_MATCH_TIMEOUT_MS: solo se congeló lo encontrado hasta entonces
+        object.__setattr__(self, 'timed_out', timed_out)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FreezeContext es inmutable")
+
+    def __iter__(self) -> Iterator:
+        return iter((list(self.entities), self.processed_text))
+
+    def __reduce__(self):
+        # mappingproxy no se serializa: reconstruir desde un dict (pool de procesos)
+        return FreezeContext, (self.entities, self.processed_text, dict(self.placeholders),
+                               self.entity_types, self.timed_out)
+
+
+class EntityMatcher:
+    """
+    Aho-Corasick automaton over a set of literal entities: one scan of a
+    text finds every occurrence of every entity (overlapping ones too,
+    e.g. "2019" inside "(García, 2019)") in time linear in the text size
+    plus the number of matches.
+    """
+
+    def __init__(self, entities: Iterable[str]):
+        self.entities = list(dict.fromkeys(entity for entity in entities if entity))
+        # Trie: transiciones, enlace de fallo y entidades que terminan en cada estado
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[tuple] = [()]
+        for index, entity in enumerate(self.entities):
+            state = 0
+            for char in entity:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] += (index,)
+
+        # Enlaces de fallo en anchura (los estados de profundidad 1 vuelven a la raíz)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find_all(self, text: str) -> Dict[str, List[int]]:
+        """Start offsets of every occurrence of each entity in text (empty list if absent)"""
+        goto, fail, output = self.goto, self.fail, self.output
+        lengths = [len(entity) for entity in self.entities]
+        positions: List[List[int]] = [[] for _ in self.entities]
+        state = 0
+        for end, char in enumerate(text, 1):
+            while True:
+                next_state = goto[state].get(char)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            for index in output[state]:
+                positions[index].append(end - lengths[index])
+        return dict(zip(self.entities, positions))
+
 
 class EntityExtractor:
     """
@@ -18,14 +168,18 @@ class EntityExtractor:
             # Years: 4-digit years (1900-2099)
             'years': r'\b(?:19|20)\d{2}\b',
             
-            # Dates: various Spanish date formats
-            'dates': r'\b(?:\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{1,2}\s+de\s+\w+\s+de\s+\d{4}|\w+\s+\d{1,2},?\s+\d{4})\b',
+            # Dates: various Spanish date formats. "<mes> <día>, <año>" solo con un
+            # nombre de mes: con \w+ cada palabra seguida de dígitos era un intento
+            'dates': r'\b(?:\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{1,2}\s+de\s+\w+\s+de\s+\d{4}|'
+                     r'(?:' + '|'.join(sorted(MONTH_NAMES, key=len, reverse=True)) + r')\s+\d{1,2},?\s+\d{4})\b',
             
             # ISO dates
             'iso_dates': r'\b\d{4}-\d{2}-\d{2}\b',
             
-            # Citations: (Author, Year) or (Author et al., Year)
-            'citations': r'\([^)]*(?:\d{4}|et\s+al\.)[^)]*\)',
+            # Citations: (Author, Year) or (Author et al., Year). Sin paréntesis
+            # dentro y con la condición en un lookahead: cada "(" solo explora
+            # hasta el siguiente paréntesis, así que el coste es lineal
+            'citations': r'\((?=[^()]*?(?:\d{4}|et\s+al\.))[^()]*\)',
             
             # References like "1", "2", etc. in superscript context or between brackets
             'references': r'\b\[\d+\]\b|\b\(\d+\)\b',
@@ -37,12 +191,17 @@ class EntityExtractor:
             # 'proper_names': r'\b[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+(?:\s+[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)*\b',
         }
         
-        # Combined pattern for efficiency (exclude None values)
-        active_patterns = [pattern for pattern in self.patterns.values() if pattern is not None]
-        self.combined_pattern = '|'.join(f'({pattern})' for pattern in active_patterns)
-        self.entity_placeholders = {}
+        # Combined pattern for efficiency (exclude None values); one named group
+        # per entity type, so match.lastgroup tells which pattern matched
+        self.combined_pattern = '|'.join(
+            f'(?P<{name}>{pattern})' for name, pattern in self.patterns.items() if pattern is not None
+        )
+        self.combined_regex = _regex.compile(self.combined_pattern, _regex.IGNORECASE)
+        
+        # Tiempo máximo de una búsqueda completa
+        self.match_timeout = float(os.getenv("ENTITY_MATCH_TIMEOUT_MS", 2000)) / 1000
     
-    def extract_and_freeze(self, text: str) -> Tuple[List[str], str]:
+    def extract_and_freeze(self, text: str) -> FreezeContext:
         """
         Extract entities from text and replace them with placeholders.
         
@@ -50,82 +209,134 @@ class EntityExtractor:
             text: Original text
             
         Returns:
-            Tuple of (list of frozen entities, text with placeholders)
+            FreezeContext with the frozen entities, the text with placeholders
+            and the placeholder map (unpacks as (entities, processed_text))
         """
         frozen_entities = []
-        processed_text = text
-        self.entity_placeholders = {}
-        
-        # Find all entities
-        matches = list(re.finditer(self.combined_pattern, text, re.IGNORECASE))
-        
-        # Sort matches by position (descending) to replace from end to beginning
-        matches.sort(key=lambda x: x.start(), reverse=True)
+        entity_types = []
+        placeholders = {}
+        # Los placeholders compactos solo son únicos dentro del texto: si ya
+        # hay algo parecido a [E<n>] se usa el formato largo
+        legacy = FUZZY_PLACEHOLDER_PATTERN.search(text) is not None
         
-        for match in matches:
+        # Find all entities; numbered from the end of the text (entity 0 is the last one)
+        matches, timed_out = self._find_matches(text)
+        kept = []
+        for match in reversed(matches):
             entity = match.group().strip()
             
             # Skip if it's just a single common word or common phrase
-            if self._is_common_word(entity) or self._is_common_phrase(entity):
+            if entity in COMMON_WORDS or entity.lower() in COMMON_PHRASES:
                 continue
             
             # Generate unique placeholder
-            placeholder = f"__ENTITY_{len(frozen_entities)}_{uuid.uuid4().hex[:8]}__"
+            if legacy:
+                placeholder = f"__ENTITY_{len(frozen_entities)}_{uuid.uuid4().hex[:8]}__"
+            else:
+                placeholder = f"[E{len(frozen_entities)}]"
             
-            # Store the entity and its placeholder
+            # Store the entity, its type and its placeholder
             frozen_entities.append(entity)
-            self.entity_placeholders[placeholder] = entity
-            
-            # Replace in text
-            start, end = match.span()
-            processed_text = processed_text[:start] + placeholder + processed_text[end:]
+            entity_types.append(match.lastgroup)
+            placeholders[placeholder] = entity
+            kept.append((match.start(), match.end(), placeholder))
+        
+        # Assemble the text in one pass from the segments between entities
+        parts = []
+        position = 0
+        for start, end, placeholder in reversed(kept):
+            parts.append(text[position:start])
+            parts.append(placeholder)
+            position = end
+        parts.append(text[position:])
         
-        return frozen_entities, processed_text
+        return FreezeContext(frozen_entities, ''.join(parts), placeholders, entity_types, timed_out)
+    
+    def _find_matches(self, text: str) -> tuple:
+        """
+        Matches of the combined pattern within the time budget. Returns
+        (matches, timed_out); on timeout only the matches found so far.
+        """
+        matches = []
+        try:
+            for match in self.combined_regex.finditer(text, timeout=self.match_timeout):
+                matches.append(match)
+        except TimeoutError:
+            print(f"[EntityExtractor] Búsqueda de entidades interrumpida tras {self.match_timeout:.1f}s "
+                  f"({len(matches)} encontradas en {len(text)} caracteres)")
+            return matches, True
+        return matches, False
     
-    def restore_entities(self, text_with_placeholders: str) -> str:
+    def restore_entities(self, text_with_placeholders: str, context: FreezeContext) -> str:
         """
-        Restore original entities from placeholders.
+        Restore original entities from placeholders. Lightly corrupted
+        placeholders (changed case, extra spaces, dropped underscores) are
+        recovered in the same pass.
         
         Args:
             text_with_placeholders: Text containing entity placeholders
+            context: FreezeContext returned by extract_and_freeze
             
         Returns:
             Text with original entities restored
         """
-        restored_text = text_with_placeholders
+        placeholders = context.placeholders
+        if not placeholders:
+            return text_with_placeholders
         
-        for placeholder, entity in self.entity_placeholders.items():
-            restored_text = restored_text.replace(placeholder, entity)
+        # One scan for every placeholder (exact or not); unknown ones are left as they are
+        if next(iter(placeholders)).startswith('__'):
+            return FUZZY_LEGACY_PLACEHOLDER_PATTERN.sub(
+                lambda match: placeholders.get(
+                    f"__ENTITY_{int(match.group(1))}_{match.group(2).lower()}__", match.group()
+                ),
+                text_with_placeholders
+            )
+        return FUZZY_PLACEHOLDER_PATTERN.sub(
+            lambda match: placeholders.get(f"[E{int(match.group(1))}]", match.group()),
+            text_with_placeholders
+        )
+    
+    def locate_entities(self, text: str,
+                        context: Union[FreezeContext, List[str]]) -> Dict[str, List[int]]:
+        """
+        Find every frozen entity in text with a single scan.
         
-        return restored_text
+        Args:
+            text: Text to search
+            context: FreezeContext of the request (or the list of frozen entities)
+            
+        Returns:
+            Start offsets of each distinct entity in text; the multiplicity
+            is the length of its list (empty if the entity is missing)
+        """
+        frozen_entities = context.entities if isinstance(context, FreezeContext) else context
+        return EntityMatcher(frozen_entities).find_all(text)
     
-    def verify_entities_preserved(self, original_text: str, rewritten_text: str, frozen_entities: List[str]) -> bool:
+    def verify_entities_preserved(self, original_text: str, rewritten_text: str,
+                                  context: Union[FreezeContext, List[str]]) -> Dict[str, List[int]]:
         """
         Verify that all frozen entities are preserved in the rewritten text.
         
         Args:
             original_text: Original text
             rewritten_text: Rewritten text
-            frozen_entities: List of entities that should be preserved
+            context: FreezeContext of the request (or the list of frozen entities)
             
         Returns:
-            True if all entities are preserved
+            Positions of each entity in the rewritten text (see locate_entities)
             
         Raises:
             ValueError: If entities are not properly preserved
         """
-        missing_entities = []
-        
-        for entity in frozen_entities:
-            # Use regex to find exact matches (accounting for word boundaries)
-            pattern = re.escape(entity)
-            if not re.search(pattern, rewritten_text):
-                missing_entities.append(entity)
+        frozen_entities = context.entities if isinstance(context, FreezeContext) else context
+        positions = self.locate_entities(rewritten_text, frozen_entities)
+        missing_entities = [entity for entity in frozen_entities if entity and not positions[entity]]
         
         if missing_entities:
             raise ValueError(f"Las siguientes entidades no fueron preservadas: {missing_entities}")
         
-        return True
+        return positions
     
     def _is_common_word(self, word: str) -> bool:
         """
@@ -137,23 +348,7 @@ class EntityExtractor:
         Returns:
             True if it's a common word that can be modified
         """
-        # List of common Spanish words that might match proper name patterns
-        # but should not be preserved as entities
-        common_words = {
-            'El', 'La', 'Los', 'Las', 'Un', 'Una', 'De', 'Del', 'Al', 'En', 'Con', 'Por', 'Para',
-            'Este', 'Esta', 'Estos', 'Estas', 'Ese', 'Esa', 'Esos', 'Esas', 'Aquel', 'Aquella',
-            'Que', 'Quien', 'Como', 'Cuando', 'Donde', 'Porque', 'Si', 'No', 'Muy', 'Más', 'Menos',
-            'Todo', 'Toda', 'Todos', 'Todas', 'Otro', 'Otra', 'Otros', 'Otras', 'Mismo', 'Misma',
-            'También', 'Solo', 'Sólo', 'Así', 'Aquí', 'Allí', 'Ahí', 'Ahora', 'Antes', 'Después',
-            'Durante', 'Mientras', 'Según', 'Sin', 'Sobre', 'Entre', 'Hacia', 'Hasta', 'Desde',
-            # Common words that might be capitalized at sentence start
-            'Texto', 'Prueba', 'Ejemplo', 'Caso', 'Resultado', 'Conclusión', 'Introducción',
-            'Desarrollo', 'Análisis', 'Estudio', 'Investigación', 'Método', 'Proceso', 'Sistema',
-            'Educación', 'Salud', 'Programas', 'Campaña', 'Información', 'Recursos', 'Acceso',
-            'Menstruación', 'Niñas', 'Familias', 'Gobiernos', 'Sociedad', 'Respeto', 'Igualdad'
-        }
-        
-        return word in common_words
+        return word in COMMON_WORDS
     
     def _is_common_phrase(self, phrase: str) -> bool:
         """
@@ -165,22 +360,15 @@ class EntityExtractor:
         Returns:
             True if it's a common phrase that can be modified
         """
-        phrase_lower = phrase.lower()
-        common_phrases = {
-            'texto de prueba', 'texto de ejemplo', 'por ejemplo',
-            'en conclusión', 'en resumen', 'por tanto', 'sin embargo',
-            'de igual manera', 'de este modo', 'en este sentido',
-            'según el estudio', 'de acuerdo con', 'por otra parte'
-        }
-        
-        return phrase_lower in common_phrases
+        return phrase.lower() in COMMON_PHRASES
     
-    def get_entity_stats(self, frozen_entities: List[str]) -> Dict[str, int]:
+    def get_entity_stats(self, frozen_entities: Union[FreezeContext, List[str]]) -> Dict[str, int]:
         """
         Get statistics about the types of entities found.
         
         Args:
-            frozen_entities: List of extracted entities
+            frozen_entities: FreezeContext of the request (types recorded at
+                extraction) or a list of extracted entities (types guessed)
             
         Returns:
             Dictionary with counts of different entity types
@@ -193,9 +381,21 @@ class EntityExtractor:
             'references': 0,
             'urls': 0,
             'proper_names': 0,
-            'total': len(frozen_entities)
+            'total': 0
         }
         
+        if isinstance(frozen_entities, FreezeContext):
+            entity_types = frozen_entities.entity_types
+            frozen_entities = frozen_entities.entities
+            # Tipos anotados al extraer: no hace falta volver a probar cada patrón
+            if entity_types:
+                stats['total'] = len(frozen_entities)
+                for entity_type in entity_types:
+                    key = ENTITY_STAT_KEYS.get(entity_type, entity_type)
+                    stats[key] = stats.get(key, 0) + 1
+                return stats
+        stats['total'] = len(frozen_entities)
+        
         for entity in frozen_entities:
             # Check what type of entity it is
             if re.match(r'\b\d+(?:[.,]\d+)*%?\b', entity):
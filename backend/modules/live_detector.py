@@ -0,0 +1,66 @@
+"""
+Live Detection Session
+Incremental AI detection for a document that is being edited: the text is
+split into paragraphs, each paragraph is profiled once and cached by its
+content hash, and the document metrics are rebuilt by merging the cached
+paragraph profiles. A resubmission only re-tokenizes the edited paragraphs.
+"""
+from typing import Dict, List
+
+from modules.ai_detector import AIDetector, TextProfile
+from modules.result_cache import content_key
+
+
+class LiveDetectionSession:
+    """Per-client state of a live detection channel"""
+
+    def __init__(self, detector: AIDetector):
+        self.detector = detector
+        # hash del párrafo -> TextProfile (solo los párrafos del último envío)
+        self.paragraph_profiles: Dict[str, TextProfile] = {}
+        self.updates = 0
+
+    def update(self, text: str, language: str = 'es') -> Dict:
+        """
+        Detect AI patterns in the latest version of the document.
+
+        Returns the same result as AIDetector.detect(text, language), plus
+        'paragraphs' (paragraph count) and 'reprocessed' (paragraphs that
+        had to be profiled because they changed since the last update).
+        """
+        self.updates += 1
+        paragraphs = text.split(TextProfile.PARAGRAPH_SEPARATOR)
+        keys = [content_key(paragraph) for paragraph in paragraphs]
+
+        profiles: Dict[str, TextProfile] = {}
+        reprocessed = 0
+        for key, paragraph in zip(keys, paragraphs):
+            if key in profiles:
+                continue
+            profile = self.paragraph_profiles.get(key)
+            if profile is None:
+                profile = self.detector.profile_paragraph(paragraph)
+                reprocessed += 1
+            profiles[key] = profile
+        # Olvidar los párrafos que ya no están en el documento
+        self.paragraph_profiles = profiles
+
+        result = self._detect(text, language, [profiles[key] for key in keys])
+        result['paragraphs'] = len(paragraphs)
+        result['reprocessed'] = reprocessed
+        return result
+
+    def _detect(self, text: str, language: str, profiles: List[TextProfile]) -> Dict:
+        if not text or len(text.strip()) < 50:
+            return self.detector._short_text_result()
+
+        cached = self.detector.lookup_cached(text, language)
+        if cached is not None:
+            return cached
+
+        merged = TextProfile.merged(profiles)
+        metrics = self.detector._calculate_metrics(merged, language)
+        ai_probability = self.detector._calculate_ai_probability(metrics)
+        result = self.detector._build_result(metrics, ai_probability)
+        self.detector.store_cached(text, language, result)
+        return result
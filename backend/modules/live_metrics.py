@@ -0,0 +1,250 @@
+"""
+Live Metrics Session
+Incremental metrics and diff for a rewrite that is being streamed: each
+update only scans the text appended since the previous one. Word and
+token counts are settled up to the last whitespace and sentence counts up
+to the last sentence end, so only the unfinished word and sentence are
+re-scanned. The token diff keeps a frontier: opcodes up to the last long
+equal run are committed and later updates only diff what follows it,
+against a window of the original. If the uncommitted tail outgrows
+LIVE_DIFF_MAX_TAIL_TOKENS without any long equal run (a very free
+rewrite), its first half is committed as a replace, so the work per
+update stays bounded.
+
+finish() returns the same metrics as MetricsCalculator.calculate, and the
+diff reconstructs both texts like generate_diff (committed hunks are not
+revisited, so it can differ from a from-scratch diff in where the
+changes are placed).
+"""
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from modules.diff_engine import Opcode, TokenDiff, matching_blocks, opcodes_from_blocks
+from modules.metrics_calculator import MetricsCalculator
+from modules.text_analysis import SENTENCE_END_PATTERN, AnalysisCache, AnalyzedText
+
+# Una racha igual de al menos estos tokens fija la frontera del diff
+FRONTIER_MIN_RUN = 8
+
+
+class RunningCounts:
+    """Word and sentence counts of a text prefix (the fields the readability metrics read)"""
+
+    def __init__(self):
+        self.words: List[str] = []
+        self.word_chars = 0
+        self.long_words = 0
+        self.rare_words = 0
+        self.sentence_count = 0
+
+    def add_words(self, analyzed: AnalyzedText):
+        self.words.extend(analyzed.words)
+        self.word_chars += analyzed.word_chars
+        self.long_words += analyzed.long_words
+        self.rare_words += analyzed.rare_words
+
+    def plus(self, analyzed: AnalyzedText, sentences: int) -> "RunningCounts":
+        """Copy of these counts with a (not yet settled) tail added"""
+        total = RunningCounts()
+        total.words = self.words + analyzed.words
+        total.word_chars = self.word_chars + analyzed.word_chars
+        total.long_words = self.long_words + analyzed.long_words
+        total.rare_words = self.rare_words + analyzed.rare_words
+        total.sentence_count = self.sentence_count + sentences
+        return total
+
+
+def count_sentences(text: str) -> int:
+    """sentence_count of AnalyzedText for a piece of text"""
+    return sum(1 for sentence in SENTENCE_END_PATTERN.split(text)
+               if sentence and not sentence.isspace())
+
+
+class LiveMetricsSession:
+    """Metrics and diff of one original text against a growing rewritten text"""
+
+    def __init__(self, calculator: MetricsCalculator, original_text: str,
+                 analysis: Optional[AnalysisCache] = None):
+        self.calculator = calculator
+        self.original_text = original_text
+        self.analysis = analysis if analysis is not None else AnalysisCache()
+        self.original = self.analysis.get(original_text)
+        self.updates = 0
+        self.rescans = 0
+        # Tokens sin fijar tras la frontera antes de forzar un reemplazo
+        self.max_tail_tokens = max(2 * FRONTIER_MIN_RUN, int(os.getenv("LIVE_DIFF_MAX_TAIL_TOKENS", 2000)))
+        self._reset("")
+
+    def _reset(self, text: str):
+        self.text = text
+        # Hasta word_cut (tras el último espacio) palabras y tokens ya no cambian
+        self.word_cut = 0
+        self.counts = RunningCounts()
+        self.tokens: List[str] = []
+        self.token_ids: List[int] = []
+        self.token_offsets: List[int] = []
+        # Hasta sentence_cut (tras el último fin de oración seguido de espacio)
+        self.sentence_cut = 0
+        # Frontera del diff: opcodes fijados sobre original[:fi] y reescrito[:fj]
+        self.opcodes: List[Opcode] = []
+        self.frontier = (0, 0)
+        self.committed_distance = 0
+        self._tail: Optional[AnalyzedText] = None
+        self._tail_opcodes: Optional[List[Opcode]] = None
+
+    def append(self, chunk: str) -> Dict[str, float]:
+        """Add streamed text at the end and return the live metrics"""
+        return self.update(self.text + chunk)
+
+    def update(self, text: str) -> Dict[str, float]:
+        """
+        Move to the latest version of the rewritten text and return the
+        live metrics. Text appended to the previous version is scanned
+        incrementally; a version that changes already settled text (before
+        the last whitespace) is scanned again from the start.
+        """
+        self.updates += 1
+        if not text.startswith(self.text[:max(self.word_cut, self.sentence_cut)]):
+            self.rescans += 1
+            self._reset("")
+        self.text = text
+        self._tail = None
+        self._tail_opcodes = None
+
+        # Palabras y tokens: fijar hasta el último espacio
+        cut = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t'), text.rfind('\r')) + 1
+        if cut > self.word_cut:
+            settled = AnalyzedText(text[self.word_cut:cut], self.analysis.vocabulary)
+            self.counts.add_words(settled)
+            self.tokens.extend(settled.tokens)
+            self.token_ids.extend(settled.token_ids)
+            self.token_offsets.extend(self.word_cut + offset for offset in settled.token_offsets[:-1])
+            self.word_cut = cut
+
+        # Oraciones: fijar hasta el último fin de oración seguido de espacio
+        sentence_cut = self.sentence_cut
+        for match in SENTENCE_END_PATTERN.finditer(text, self.sentence_cut):
+            if match.end() > match.start() and text[match.end() - 1].isspace():
+                sentence_cut = match.end()
+        if sentence_cut > self.sentence_cut:
+            self.counts.sentence_count += count_sentences(text[self.sentence_cut:sentence_cut])
+            self.sentence_cut = sentence_cut
+
+        self._advance_frontier()
+        return self.metrics(final=False)
+
+    def metrics(self, final: bool = True) -> Dict[str, float]:
+        """
+        Metrics of the current text. final=True gives exactly
+        MetricsCalculator.calculate; while streaming, change_ratio only
+        covers the committed part of the diff.
+        """
+        counts = self.counts.plus(self._tail_text(), count_sentences(self.text[self.sentence_cut:]))
+        if final:
+            change_ratio = self.calculator._calculate_change_ratio(self.original_text, self.text)
+        else:
+            oi, rj = self._char_frontier()
+            longest = max(oi, rj)
+            change_ratio = self.committed_distance / longest if longest else 0.0
+        return {
+            "change_ratio": change_ratio,
+            "rare_words_ratio": self.calculator._calculate_rare_word_ratio(counts),
+            "avg_sentence_len": self.calculator._calculate_avg_sentence_length(counts),
+            "lix": self.calculator._calculate_lix(counts)
+        }
+
+    def compare(self) -> TokenDiff:
+        """Token diff of the original against the current text"""
+        tail = self._tail_text()
+        tokens = self.tokens + tail.tokens
+        opcodes = self.opcodes + self._diff_tail()
+        split = len(self.opcodes)
+        # Unir la última racha fijada con una racha igual al inicio de la cola
+        if 0 < split < len(opcodes) and opcodes[split - 1][0] == opcodes[split][0] == 'equal':
+            _, i1, _, j1, _ = opcodes[split - 1]
+            _, _, i2, _, j2 = opcodes[split]
+            opcodes[split - 1:split + 1] = [('equal', i1, i2, j1, j2)]
+        return TokenDiff(self.original.tokens, tokens, opcodes=opcodes)
+
+    def diff_with_stats(self, diff_format: str = "tokens") -> Tuple[List[Any], Dict[str, float]]:
+        """Same output as MetricsCalculator.generate_diff_with_stats for the current text"""
+        token_diff = self.compare()
+        if diff_format == "runs":
+            tail = self._tail_text()
+            offsets = self.token_offsets + [self.word_cut + offset for offset in tail.token_offsets]
+            diff = token_diff.runs(self.original.token_offsets, offsets)
+        else:
+            diff = token_diff.items()
+        return diff, token_diff.stats()
+
+    def finish(self, text: str, diff_format: str = "tokens") -> Tuple[Dict[str, float], List[Any], Dict[str, float]]:
+        """Final (metrics, diff, diff_stats) once the rewritten text is complete"""
+        self.update(text)
+        diff, diff_stats = self.diff_with_stats(diff_format)
+        return self.metrics(final=True), diff, diff_stats
+
+    def _tail_text(self) -> AnalyzedText:
+        if self._tail is None:
+            self._tail = AnalyzedText(self.text[self.word_cut:], self.analysis.vocabulary)
+        return self._tail
+
+    def _diff_tail(self) -> List[Opcode]:
+        """Opcodes after the frontier (everything not committed yet)"""
+        if self._tail_opcodes is None:
+            fi, fj = self.frontier
+            a = self.original.token_ids[fi:]
+            b = self.token_ids[fj:] + self._tail_text().token_ids
+            self._tail_opcodes = [
+                (tag, i1 + fi, i2 + fi, j1 + fj, j2 + fj)
+                for tag, i1, i2, j1, j2 in opcodes_from_blocks(matching_blocks(a, b), len(a), len(b))
+            ]
+        return self._tail_opcodes
+
+    def _advance_frontier(self):
+        """
+        Commit the opcodes up to the last long equal run inside the settled
+        tokens, or the first half of an overlong tail as a replace
+        """
+        fi, fj = self.frontier
+        settled = len(self.tokens)
+        b = self.token_ids[fj:settled]
+        if not b:
+            return
+        # Ventana del original: lo que puede alinearse con la cola fijada, con holgura
+        a = self.original.token_ids[fi:fi + len(b) + self.max_tail_tokens]
+        window = [
+            (tag, i1 + fi, i2 + fi, j1 + fj, j2 + fj)
+            for tag, i1, i2, j1, j2 in opcodes_from_blocks(matching_blocks(a, b), len(a), len(b))
+        ]
+        commit = 0
+        for index, (tag, i1, i2, j1, j2) in enumerate(window):
+            # La racha no toca el final (podría alargarse con los siguientes tokens)
+            if tag == 'equal' and i2 - i1 >= FRONTIER_MIN_RUN and j2 < settled:
+                commit = index + 1
+        if commit:
+            committed = window[:commit]
+        elif len(b) > self.max_tail_tokens:
+            # Sin rachas largas en toda la cola: fijar su primera mitad como reemplazo
+            half = len(b) // 2
+            consumed = min(half, len(self.original.token_ids) - fi)
+            committed = [('replace' if consumed else 'insert', fi, fi + consumed, fj, fj + half)]
+        else:
+            return
+
+        start_chars = self._char_frontier()
+        self.opcodes.extend(committed)
+        _, _, i2, _, j2 = committed[-1]
+        self.frontier = (i2, j2)
+        end_chars = self._char_frontier()
+        # Distancia de edición del tramo recién fijado (para change_ratio en vivo)
+        self.committed_distance += self.calculator.edit_distance.distance(
+            self.original_text[start_chars[0]:end_chars[0]],
+            self.text[start_chars[1]:end_chars[1]]
+        )
+        self._tail_opcodes = None
+
+    def _char_frontier(self) -> Tuple[int, int]:
+        """Character offsets of the diff frontier in the original and the rewritten text"""
+        fi, fj = self.frontier
+        return (self.original.token_offsets[fi] if fi else 0,
+                self.token_offsets[fj] if fj else 0)
@@ -1,26 +1,11 @@
-import re
-from typing import List, Dict, Any
-from difflib import SequenceMatcher
+import os
+from typing import Iterator, List, Dict, Any, Optional, Tuple
 
-# Simple Levenshtein distance implementation since the library has compatibility issues
-def levenshtein_distance(s1, s2):
-    if len(s1) < len(s2):
-        return levenshtein_distance(s2, s1)
-    
-    if len(s2) == 0:
-        return len(s1)
-    
-    previous_row = list(range(len(s2) + 1))
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
-    
-    return previous_row[-1]
+from modules.diff_engine import (
+    DIFF_FORMATS, DiffRun, Segment, TokenDiff, extend_diff, merge_diff_stats, paragraph_segments, shift_runs
+)
+from modules.edit_distance import EditDistanceEngine
+from modules.text_analysis import AnalysisCache, AnalyzedText, analyze, get_lexicon
 
 
 class MetricsCalculator:
@@ -30,102 +15,133 @@ class MetricsCalculator:
     """
     
     def __init__(self):
+        # Distancia de edición: backend nativo si está instalado, si no bit-paralelo
+        self.edit_distance = EditDistanceEngine()
+        
         # Spanish stopwords for rare word calculation
-        self.spanish_stopwords = {
-            'a', 'al', 'algo', 'algunas', 'algunos', 'ante', 'antes', 'como', 'con', 'contra', 'cual', 'cuando',
-            'de', 'del', 'desde', 'donde', 'durante', 'e', 'el', 'ella', 'ellas', 'ellos', 'en', 'entre', 'era',
-            'erais', 'eran', 'eras', 'eres', 'es', 'esa', 'esas', 'ese', 'eso', 'esos', 'esta', 'estaba',
-            'estabais', 'estaban', 'estabas', 'estad', 'estada', 'estadas', 'estado', 'estados', 'estamos',
-            'estando', 'estar', 'estaremos', 'estará', 'estarán', 'estarás', 'estaré', 'estaréis', 'estaría',
-            'estaríais', 'estaríamos', 'estarían', 'estarías', 'estas', 'este', 'estemos', 'esto', 'estos',
-            'estoy', 'estuve', 'estuviera', 'estuvierais', 'estuvieran', 'estuvieras', 'estuvieron', 'estuviese',
-            'estuvieseis', 'estuviesen', 'estuvieses', 'estuvimos', 'estuviste', 'estuvisteis', 'estuvo', 'está',
-            'estábamos', 'estáis', 'están', 'estás', 'esté', 'estéis', 'estén', 'estés', 'fue', 'fuera', 'fuerais',
-            'fueran', 'fueras', 'fueron', 'fuese', 'fueseis', 'fuesen', 'fueses', 'fui', 'fuimos', 'fuiste',
-            'fuisteis', 'ha', 'habida', 'habidas', 'habido', 'habidos', 'habiendo', 'habremos', 'habrá',
-            'habrán', 'habrás', 'habré', 'habréis', 'habría', 'habríais', 'habríamos', 'habrían', 'habrías',
-            'habéis', 'había', 'habíais', 'habíamos', 'habían', 'habías', 'han', 'has', 'hasta', 'hay', 'haya',
-            'hayamos', 'hayan', 'hayas', 'hayáis', 'he', 'hemos', 'hube', 'hubiera', 'hubierais', 'hubieran',
-            'hubieras', 'hubieron', 'hubiese', 'hubieseis', 'hubiesen', 'hubieses', 'hubimos', 'hubiste',
-            'hubisteis', 'hubo', 'la', 'las', 'le', 'les', 'lo', 'los', 'me', 'mi', 'mis', 'mucho', 'muchos',
-            'muy', 'más', 'mí', 'mía', 'mías', 'mío', 'míos', 'nada', 'ni', 'no', 'nos', 'nosotras', 'nosotros',
-            'nuestra', 'nuestras', 'nuestro', 'nuestros', 'o', 'os', 'otra', 'otras', 'otro', 'otros', 'para',
-            'pero', 'poco', 'por', 'porque', 'que', 'quien', 'se', 'sea', 'seamos', 'sean', 'seas', 'sentid',
-            'sentida', 'sentidas', 'sentido', 'sentidos', 'seremos', 'será', 'serán', 'serás', 'seré', 'seréis',
-            'sería', 'seríais', 'seríamos', 'serían', 'serías', 'seáis', 'sido', 'siendo', 'sin', 'sobre',
-            'sois', 'somos', 'son', 'soy', 'su', 'sus', 'suya', 'suyas', 'suyo', 'suyos', 'sí', 'también',
-            'tanto', 'te', 'tendremos', 'tendrá', 'tendrán', 'tendrás', 'tendré', 'tendréis', 'tendría',
-            'tendríais', 'tendríamos', 'tendrían', 'tendrías', 'tened', 'tenemos', 'tenga', 'tengamos', 'tengan',
-            'tengas', 'tengo', 'tengáis', 'tenida', 'tenidas', 'tenido', 'tenidos', 'teniendo', 'tenéis',
-            'tenía', 'teníais', 'teníamos', 'tenían', 'tenías', 'ti', 'tiene', 'tienen', 'tienes', 'todo',
-            'todos', 'tu', 'tus', 'tuve', 'tuviera', 'tuvierais', 'tuvieran', 'tuvieras', 'tuvieron', 'tuviese',
-            'tuvieseis', 'tuviesen', 'tuvieses', 'tuvimos', 'tuviste', 'tuvisteis', 'tuvo', 'tuya', 'tuyas',
-            'tuyo', 'tuyos', 'tú', 'un', 'una', 'uno', 'unos', 'vosotras', 'vosotros', 'vuestra', 'vuestras',
-            'vuestro', 'vuestros', 'y', 'ya', 'yo', 'él', 'éramos'
-        }
+        self.spanish_stopwords = get_lexicon('stopwords_es')
+        
+        # Documentos a partir de este tamaño se comparan párrafo a párrafo
+        self.paragraph_diff_min_chars = int(os.getenv("DIFF_PARAGRAPH_MIN_CHARS", 40000))
     
-    def calculate(self, original_text: str, rewritten_text: str) -> Dict[str, float]:
+    def calculate(self, original_text: str, rewritten_text: str,
+                  analysis: Optional[AnalysisCache] = None) -> Dict[str, float]:
         """
         Calculate comprehensive metrics comparing original and rewritten texts.
         
         Args:
             original_text: Original text
             rewritten_text: Rewritten text
+            analysis: Analysis cache of the current job (optional)
             
         Returns:
             Dictionary with calculated metrics
         """
+        analyzed = analyze(rewritten_text, analysis)
         return {
             "change_ratio": self._calculate_change_ratio(original_text, rewritten_text),
-            "rare_words_ratio": self._calculate_rare_word_ratio(rewritten_text),
-            "avg_sentence_len": self._calculate_avg_sentence_length(rewritten_text),
-            "lix": self._calculate_lix(rewritten_text)
+            "rare_words_ratio": self._calculate_rare_word_ratio(analyzed),
+            "avg_sentence_len": self._calculate_avg_sentence_length(analyzed),
+            "lix": self._calculate_lix(analyzed)
         }
     
-    def generate_diff(self, original_text: str, rewritten_text: str) -> List[Dict[str, str]]:
+    def generate_diff(self, original_text: str, rewritten_text: str,
+                      analysis: Optional[AnalysisCache] = None) -> List[Dict[str, str]]:
         """
         Generate a token-based diff between original and rewritten texts.
         
         Args:
             original_text: Original text
             rewritten_text: Rewritten text
+            analysis: Analysis cache of the current job (optional)
             
         Returns:
             List of diff items with type and token
         """
-        # Tokenize both texts
-        original_tokens = self._tokenize(original_text)
-        rewritten_tokens = self._tokenize(rewritten_text)
-        
-        # Use SequenceMatcher to find differences
-        matcher = SequenceMatcher(None, original_tokens, rewritten_tokens)
-        
-        diff = []
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-            if tag == 'equal':
-                # Unchanged tokens
-                for token in original_tokens[i1:i2]:
-                    diff.append({"type": "equal", "token": token})
-            elif tag == 'delete':
-                # Deleted tokens
-                for token in original_tokens[i1:i2]:
-                    diff.append({"type": "delete", "token": token})
-            elif tag == 'insert':
-                # Inserted tokens
-                for token in rewritten_tokens[j1:j2]:
-                    diff.append({"type": "insert", "token": token})
-            elif tag == 'replace':
-                # Replaced tokens - mark old as deleted and new as inserted
-                for token in original_tokens[i1:i2]:
-                    diff.append({"type": "delete", "token": token})
-                for token in rewritten_tokens[j1:j2]:
-                    diff.append({"type": "insert", "token": token})
-        
-        return diff
+        return self.generate_diff_with_stats(original_text, rewritten_text, analysis=analysis)[0]
+    
+    def generate_diff_runs(self, original_text: str, rewritten_text: str) -> List[DiffRun]:
+        """
+        Compact diff: (op, a_start, a_end, b_start, b_end) runs of character
+        offsets into the original and rewritten texts (see TokenDiff.runs).
+        """
+        return self.generate_diff_with_stats(original_text, rewritten_text, diff_format="runs")[0]
+    
+    def generate_diff_with_stats(self, original_text: str, rewritten_text: str,
+                                 diff_format: str = "tokens",
+                                 analysis: Optional[AnalysisCache] = None) -> Tuple[List[Any], Dict[str, float]]:
+        """
+        Diff in the requested format ("tokens": generate_diff items, "runs":
+        generate_diff_runs) plus aggregate change statistics
+        (equal/inserted/deleted tokens, changed hunks, similarity).
+        Documents of at least DIFF_PARAGRAPH_MIN_CHARS are diffed by
+        aligned paragraphs (see iter_paragraph_diff).
+        """
+        if diff_format not in DIFF_FORMATS:
+            raise ValueError(f"Formato de diff desconocido: {diff_format}")
+        segments = self.paragraph_diff_segments(original_text, rewritten_text)
+        if segments is not None:
+            diff: List[Any] = []
+            stats = []
+            for chunk, chunk_stats in self.iter_paragraph_diff(original_text, rewritten_text,
+                                                               diff_format, segments):
+                extend_diff(diff, chunk, diff_format)
+                stats.append(chunk_stats)
+            return diff, merge_diff_stats(stats)
+        return self.segment_diff_with_stats(original_text, rewritten_text, diff_format, analysis)
+    
+    def paragraph_diff_segments(self, original_text: str, rewritten_text: str) -> Optional[List[Segment]]:
+        """Aligned paragraph segments for long documents, or None to diff in one piece"""
+        if len(original_text) + len(rewritten_text) < self.paragraph_diff_min_chars:
+            return None
+        segments = paragraph_segments(original_text, rewritten_text)
+        return segments if len(segments) > 1 else None
+    
+    def iter_paragraph_diff(self, original_text: str, rewritten_text: str,
+                            diff_format: str = "tokens",
+                            segments: Optional[List[Segment]] = None) -> Iterator[Tuple[List[Any], Dict[str, float]]]:
+        """
+        Two-level diff: paragraphs are aligned by MinHash similarity and each
+        aligned segment is diffed on its own, so memory depends on the
+        segment size. Yields (diff, stats) per segment in document order,
+        with runs already in document offsets.
+        """
+        if segments is None:
+            segments = paragraph_segments(original_text, rewritten_text)
+        for a0, a1, b0, b1 in segments:
+            chunk, stats = self.segment_diff_with_stats(original_text[a0:a1], rewritten_text[b0:b1], diff_format)
+            if diff_format == "runs":
+                chunk = shift_runs(chunk, a0, b0)
+            yield chunk, stats
+    
+    def segment_diff_with_stats(self, original_text: str, rewritten_text: str,
+                                diff_format: str = "tokens",
+                                analysis: Optional[AnalysisCache] = None) -> Tuple[List[Any], Dict[str, float]]:
+        """generate_diff_with_stats in one piece (a whole text or one paragraph segment)"""
+        if analysis is None:
+            analysis = AnalysisCache()
+        token_diff = self.compare(original_text, rewritten_text, analysis)
+        if diff_format == "runs":
+            diff = token_diff.runs(analysis.get(original_text).token_offsets,
+                                   analysis.get(rewritten_text).token_offsets)
+        else:
+            diff = token_diff.items()
+        return diff, token_diff.stats()
+    
+    def compare(self, original_text: str, rewritten_text: str,
+                analysis: Optional[AnalysisCache] = None) -> TokenDiff:
+        """Token-level diff (interned histogram diff) between both texts"""
+        if analysis is None:
+            analysis = AnalysisCache()
+        original = analysis.get(original_text)
+        rewritten = analysis.get(rewritten_text)
+        return TokenDiff(original.tokens, rewritten.tokens,
+                         token_ids=(original.token_ids, rewritten.token_ids))
     
     def _calculate_change_ratio(self, original: str, rewritten: str) -> float:
         """
         Calculate the ratio of changed characters using Levenshtein distance.
+        Very long texts use the engine's approximate mode (an upper bound).
         
         Args:
             original: Original text
@@ -138,80 +154,60 @@ class MetricsCalculator:
             return 1.0 if rewritten else 0.0
         
         # Use Levenshtein distance for accurate change calculation
-        distance = levenshtein_distance(original, rewritten)
+        distance = self.edit_distance.change_distance(original, rewritten)
         max_length = max(len(original), len(rewritten))
         
         return distance / max_length if max_length > 0 else 0.0
     
-    def _calculate_rare_word_ratio(self, text: str) -> float:
+    def _calculate_rare_word_ratio(self, analyzed: AnalyzedText) -> float:
         """
         Calculate the ratio of rare words in the text.
         A word is considered rare if it's longer than 12 characters and not a stopword.
         
         Args:
-            text: Text to analyze
+            analyzed: Analysis of the text
             
         Returns:
             Ratio of rare words (0.0 to 1.0)
         """
-        words = self._extract_words(text)
-        if not words:
+        if not analyzed.words:
             return 0.0
         
-        rare_words = 0
-        for word in words:
-            word_lower = word.lower()
-            # Consider rare if longer than 12 chars and not a common stopword
-            if len(word) > 12 and word_lower not in self.spanish_stopwords:
-                rare_words += 1
-        
-        return rare_words / len(words)
+        return analyzed.rare_words / len(analyzed.words)
     
-    def _calculate_avg_sentence_length(self, text: str) -> float:
+    def _calculate_avg_sentence_length(self, analyzed: AnalyzedText) -> float:
         """
         Calculate the average sentence length in words.
         
         Args:
-            text: Text to analyze
+            analyzed: Analysis of the text
             
         Returns:
             Average sentence length
         """
-        sentences = self._split_sentences(text)
-        if not sentences:
+        if not analyzed.sentence_count:
             return 0.0
         
-        total_words = 0
-        for sentence in sentences:
-            words = self._extract_words(sentence)
-            total_words += len(words)
-        
-        return total_words / len(sentences)
+        return len(analyzed.words) / analyzed.sentence_count
     
-    def _calculate_lix(self, text: str) -> float:
+    def _calculate_lix(self, analyzed: AnalyzedText) -> float:
         """
         Calculate LIX (Readability Index) approximation for Spanish.
         LIX = (words/sentences) + (long_words * 100 / words)
         Long words are defined as words with more than 6 characters.
         
         Args:
-            text: Text to analyze
+            analyzed: Analysis of the text
             
         Returns:
             LIX score
         """
-        sentences = self._split_sentences(text)
-        words = self._extract_words(text)
-        
-        if not sentences or not words:
+        if not analyzed.sentence_count or not analyzed.words:
             return 0.0
         
-        # Count long words (more than 6 characters)
-        long_words = sum(1 for word in words if len(word) > 6)
-        
         # Calculate LIX
-        avg_sentence_length = len(words) / len(sentences)
-        long_word_percentage = (long_words * 100) / len(words)
+        avg_sentence_length = len(analyzed.words) / analyzed.sentence_count
+        long_word_percentage = (analyzed.long_words * 100) / len(analyzed.words)
         
         return avg_sentence_length + long_word_percentage
     
@@ -225,74 +221,27 @@ class MetricsCalculator:
         Returns:
             List of tokens
         """
-        # Split on whitespace and keep punctuation as separate tokens
-        tokens = []
-        current_token = ""
-        
-        for char in text:
-            if char.isalnum() or char in "áéíóúñüÁÉÍÓÚÑÜ":
-                current_token += char
-            else:
-                if current_token:
-                    tokens.append(current_token)
-                    current_token = ""
-                if not char.isspace():
-                    tokens.append(char)
-        
-        if current_token:
-            tokens.append(current_token)
-        
-        return tokens
-    
-    def _extract_words(self, text: str) -> List[str]:
-        """
-        Extract only words (no punctuation) from text.
-        
-        Args:
-            text: Text to process
-            
-        Returns:
-            List of words
-        """
-        return re.findall(r'\b[a-záéíóúñüA-ZÁÉÍÓÚÑÜ]+\b', text)
-    
-    def _split_sentences(self, text: str) -> List[str]:
-        """
-        Split text into sentences using Spanish sentence boundaries.
-        
-        Args:
-            text: Text to split
-            
-        Returns:
-            List of sentences
-        """
-        # Spanish sentence endings
-        sentence_pattern = r'[.!?]+(?:\s|$)'
-        sentences = re.split(sentence_pattern, text)
-        
-        # Filter out empty sentences
-        sentences = [s.strip() for s in sentences if s.strip()]
-        
-        return sentences
+        return AnalyzedText(text).tokens
     
-    def get_text_stats(self, text: str) -> Dict[str, Any]:
+    def get_text_stats(self, text: str, analysis: Optional[AnalysisCache] = None) -> Dict[str, Any]:
         """
         Get basic statistics about a text.
         
         Args:
             text: Text to analyze
+            analysis: Analysis cache of the current job (optional)
             
         Returns:
             Dictionary with text statistics
         """
-        words = self._extract_words(text)
-        sentences = self._split_sentences(text)
+        analyzed = analyze(text, analysis)
+        words = analyzed.words
         
         return {
             "char_count": len(text),
             "word_count": len(words),
-            "sentence_count": len(sentences),
-            "avg_word_length": sum(len(word) for word in words) / len(words) if words else 0,
+            "sentence_count": analyzed.sentence_count,
+            "avg_word_length": analyzed.word_chars / len(words) if words else 0,
             "longest_word": max(words, key=len) if words else "",
             "shortest_word": min(words, key=len) if words else ""
         }
@@ -0,0 +1,256 @@
+"""
+N-gram Language Model
+Local Spanish trigram model with stupid backoff, used by AIDetector to
+compute a real per-token perplexity without calling a remote model.
+
+The model lives on disk as sorted NumPy arrays of hashed n-grams and their
+log10 probabilities (one pair of .npy files per order plus meta.json).
+The arrays are memory-mapped on first use, so every worker process shares
+the same pages through the OS cache instead of loading its own copy.
+
+Build a model from a plain-text corpus (one or more files):
+
+    python -m modules.ngram_lm corpus.txt [more.txt ...] --out models/es_trigram
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+ORDER = 3
+BOS = '<s>'
+BACKOFF = 0.4  # Penalización por nivel de backoff (Brants et al., 2007)
+
+_WORD_PATTERN = re.compile(r'\w+')
+_SENTENCE_PATTERN = re.compile(r'[^.!?]+')
+_PARAGRAPH_SEPARATOR = '\n\n'
+
+# Constantes de mezcla para combinar hashes de tokens en hashes de n-gramas
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX = np.uint64(0xBF58476D1CE4E5B9)
+
+
+def token_hash(token: str) -> int:
+    """Stable 64-bit hash of a token (same value in every process)"""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def combine_hashes(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Order-sensitive combination of two uint64 hash arrays"""
+    with np.errstate(over='ignore'):
+        mixed = (left ^ (right + _GOLDEN + (left << np.uint64(6)) + (left >> np.uint64(2)))) * _MIX
+    return mixed ^ (mixed >> np.uint64(31))
+
+
+def iter_sentences(text: str) -> Iterator[List[str]]:
+    """
+    Lowercased word sequences of each sentence. Paragraph breaks always
+    end a sentence, so a text scores as the sum of its paragraphs.
+    """
+    for paragraph in text.split(_PARAGRAPH_SEPARATOR):
+        for sentence in _SENTENCE_PATTERN.findall(paragraph.lower()):
+            words = _WORD_PATTERN.findall(sentence)
+            if words:
+                yield words
+
+
+class NGramLanguageModel:
+    """
+    Trigram model with stupid backoff over memory-mapped hash tables.
+    Nothing is read from disk until the first lookup.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            path = os.getenv("NGRAM_LM_PATH", "")
+        self.path = path
+        self.meta: Optional[Dict] = None
+        self.keys: List[np.ndarray] = []
+        self.logprobs: List[np.ndarray] = []
+        self._hash_cache: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+        meta_path = os.path.join(path, 'meta.json') if path else ''
+        if meta_path and os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                self.meta = json.load(f)
+
+    @property
+    def available(self) -> bool:
+        return self.meta is not None
+
+    @property
+    def language(self) -> Optional[str]:
+        return self.meta.get('language') if self.meta else None
+
+    @property
+    def fingerprint(self) -> str:
+        """Identifies the model in detection cache keys"""
+        return self.meta.get('fingerprint', '') if self.meta else ''
+
+    def load(self):
+        """Memory-map the n-gram tables (idempotent, thread-safe)"""
+        if self._loaded or not self.available:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for order in range(1, self.meta['order'] + 1):
+                self.keys.append(np.load(os.path.join(self.path, f'{order}gram_keys.npy'), mmap_mode='r'))
+                self.logprobs.append(np.load(os.path.join(self.path, f'{order}gram_logprobs.npy'), mmap_mode='r'))
+            self._loaded = True
+            print(f"[NGramLM] Modelo cargado desde {self.path} ({self.meta['ngrams']} n-gramas)")
+
+    def score_text(self, text: str) -> Tuple[float, int]:
+        """
+        Total log10 probability of the text's words and how many were scored.
+        Lookups for all sentences are batched into one vectorized pass.
+        """
+        self.load()
+        contexts2: List[int] = []
+        contexts1: List[int] = []
+        words: List[int] = []
+        bos = self._hash(BOS)
+        for sentence in iter_sentences(text):
+            previous2, previous1 = bos, bos
+            for word in sentence:
+                current = self._hash(word)
+                contexts2.append(previous2)
+                contexts1.append(previous1)
+                words.append(current)
+                previous2, previous1 = previous1, current
+        if not words:
+            return 0.0, 0
+        return float(self.logprob_array(
+            np.array(contexts2, dtype=np.uint64),
+            np.array(contexts1, dtype=np.uint64),
+            np.array(words, dtype=np.uint64)
+        ).sum()), len(words)
+
+    def perplexity(self, text: str) -> Optional[float]:
+        """Per-token perplexity of a text, or None if it has no words"""
+        logprob, count = self.score_text(text)
+        if count == 0:
+            return None
+        return 10 ** (-logprob / count)
+
+    def logprob_array(self, contexts2: np.ndarray, contexts1: np.ndarray, words: np.ndarray) -> np.ndarray:
+        """log10 P(w | u, v) with stupid backoff, for aligned arrays of u, v, w hashes"""
+        bigram_keys = combine_hashes(contexts1, words)
+        trigram_keys = combine_hashes(combine_hashes(contexts2, contexts1), words)
+        found1, logp1 = self._lookup(0, words)
+        found2, logp2 = self._lookup(1, bigram_keys)
+        found3, logp3 = self._lookup(2, trigram_keys)
+
+        backoff = math.log10(BACKOFF)
+        unigram = np.where(found1, logp1, self.meta['oov_logprob'])
+        bigram = np.where(found2, logp2, backoff + unigram)
+        return np.where(found3, logp3, backoff + bigram)
+
+    def _lookup(self, order_index: int, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        keys = self.keys[order_index]
+        if len(keys) == 0:
+            return np.zeros(len(queries), dtype=bool), np.zeros(len(queries), dtype=np.float32)
+        positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        return keys[positions] == queries, self.logprobs[order_index][positions]
+
+    def _hash(self, token: str) -> int:
+        value = self._hash_cache.get(token)
+        if value is None:
+            if len(self._hash_cache) > 200000:
+                self._hash_cache.clear()
+            value = self._hash_cache[token] = token_hash(token)
+        return value
+
+
+def build_model(texts: Iterable[str], out_dir: str, language: str = 'es', min_count: int = 1) -> Dict:
+    """
+    Count uni/bi/trigrams over a corpus and write the hashed tables to out_dir.
+    N-grams seen fewer than min_count times are pruned (except unigrams).
+    """
+    counts = [Counter() for _ in range(ORDER)]
+    for text in texts:
+        for sentence in iter_sentences(text):
+            padded = [BOS] * (ORDER - 1) + sentence
+            for i in range(ORDER - 1, len(padded)):
+                for order in range(1, ORDER + 1):
+                    counts[order - 1][tuple(padded[i - order + 1:i + 1])] += 1
+
+    total = sum(counts[0].values())
+    if total == 0:
+        raise ValueError("El corpus no contiene palabras")
+
+    # Totales por contexto: P(w | ctx) = c(ctx, w) / c(ctx, ·)
+    context_totals = [Counter() for _ in range(ORDER)]
+    for order in range(2, ORDER + 1):
+        for ngram, count in counts[order - 1].items():
+            context_totals[order - 1][ngram[:-1]] += count
+
+    os.makedirs(out_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    ngram_total = 0
+    for order in range(1, ORDER + 1):
+        table = counts[order - 1]
+        if order > 1 and min_count > 1:
+            table = {ngram: count for ngram, count in table.items() if count >= min_count}
+        ngrams = list(table)
+        hashes = [np.array([token_hash(ngram[i]) for ngram in ngrams], dtype=np.uint64) for i in range(order)]
+        keys = hashes[0] if ngrams else np.array([], dtype=np.uint64)
+        for i in range(1, order):
+            keys = combine_hashes(keys, hashes[i])
+        if order == 1:
+            logprobs = [math.log10(table[ngram] / total) for ngram in ngrams]
+        else:
+            totals = context_totals[order - 1]
+            logprobs = [math.log10(table[ngram] / totals[ngram[:-1]]) for ngram in ngrams]
+
+        ordering = np.argsort(keys, kind='stable')
+        keys = np.ascontiguousarray(keys[ordering])
+        logprobs = np.asarray(logprobs, dtype=np.float32)[ordering] if ngrams else np.array([], dtype=np.float32)
+        np.save(os.path.join(out_dir, f'{order}gram_keys.npy'), keys)
+        np.save(os.path.join(out_dir, f'{order}gram_logprobs.npy'), logprobs)
+        digest.update(keys.tobytes())
+        digest.update(logprobs.tobytes())
+        ngram_total += len(keys)
+
+    meta = {
+        'language': language,
+        'order': ORDER,
+        'tokens': total,
+        'vocabulary': len(counts[0]),
+        'ngrams': ngram_total,
+        'backoff': BACKOFF,
+        # Palabras fuera de vocabulario: masa de una aparición suavizada
+        'oov_logprob': math.log10(1 / (total + len(counts[0]))),
+        'fingerprint': digest.hexdigest()[:16]
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def _read_files(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            yield f.read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Construye el modelo de trigramas para la perplejidad local")
+    parser.add_argument('corpus', nargs='+', help="Ficheros de texto plano (UTF-8)")
+    parser.add_argument('--out', required=True, help="Directorio de salida (NGRAM_LM_PATH)")
+    parser.add_argument('--language', default='es')
+    parser.add_argument('--min-count', type=int, default=1)
+    args = parser.parse_args()
+
+    meta = build_model(_read_files(args.corpus), args.out, args.language, args.min_count)
+    print(f"[NGramLM] {meta['ngrams']} n-gramas, vocabulario {meta['vocabulary']} -> {args.out}")
@@ -33,7 +33,7 @@ class ProgressManager:
         
         return task_id
     
-    async def update_progress(self, task_id: str, status: str, progress: int, message: str, step: int = None, total_steps: int = None, phase: str = None, partial: str = None):
+    async def update_progress(self, task_id: str, status: str, progress: int, message: str, step: int = None, total_steps: int = None, phase: str = None, partial: str = None, metrics: Optional[Dict] = None):
         """Update task progress and notify listeners"""
         if task_id not in self.tasks:
             return
@@ -53,6 +53,7 @@ class ProgressManager:
             "total_steps": total_steps,
             "phase": phase,
             "partial": partial,
+            "metrics": metrics,
             "updated_at": datetime.now().isoformat()
         })
         
@@ -67,6 +68,7 @@ class ProgressManager:
                 "total_steps": total_steps,
                 "phase": phase,
                 "partial": partial,
+                "metrics": metrics,
                 "timestamp": datetime.now().isoformat()
             }
             
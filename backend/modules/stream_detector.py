@@ -0,0 +1,356 @@
+"""
+Streaming AI Detection
+Constant-memory detection for very large documents (theses, books): the
+text is consumed paragraph by paragraph and folded into running
+accumulators, so no full word, sentence or n-gram list is ever built.
+Provisional scores can be emitted every N paragraphs.
+"""
+import math
+import os
+from collections import Counter
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from modules.ai_detector import AIDetector, TextProfile
+
+
+class ParagraphSplitter:
+    """
+    Incremental paragraph splitter: feed() text chunks and get back the
+    paragraphs they complete; close() returns the last one. Only the
+    unfinished paragraph is buffered; with max_chars, a paragraph longer
+    than that raises ValueError instead of growing the buffer.
+    """
+
+    def __init__(self, max_chars: Optional[int] = None):
+        self.buffer = ''
+        self.max_chars = max_chars
+
+    def feed(self, chunk: str) -> List[str]:
+        separator = TextProfile.PARAGRAPH_SEPARATOR
+        # Un separador puede empezar al final del búfer anterior
+        search_from = max(0, len(self.buffer) - len(separator) + 1)
+        self.buffer += chunk
+        paragraphs = []
+        start = 0
+        while True:
+            end = self.buffer.find(separator, max(start, search_from))
+            if end < 0:
+                break
+            paragraphs.append(self.buffer[start:end])
+            start = end + len(separator)
+        self.buffer = self.buffer[start:]
+        if self.max_chars is not None and len(self.buffer) > self.max_chars:
+            raise ValueError(f"Párrafo de más de {self.max_chars} caracteres")
+        return paragraphs
+
+    def close(self) -> str:
+        last, self.buffer = self.buffer, ''
+        return last
+
+
+def iter_paragraphs(chunks) -> Iterator[str]:
+    """
+    Yield the paragraphs of a text given as a string or as an iterable of
+    chunks (file lines, upload blocks...). Paragraphs are the same ones
+    text.split('\\n\\n') would return, even if a separator spans two chunks.
+    """
+    if isinstance(chunks, str):
+        chunks = (chunks,)
+    splitter = ParagraphSplitter()
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield splitter.close()
+
+
+async def aiter_paragraphs(chunks: AsyncIterable[str], max_chars: Optional[int] = None) -> AsyncIterator[str]:
+    """iter_paragraphs for an async stream of text chunks (e.g. a request body)"""
+    splitter = ParagraphSplitter(max_chars)
+    async for chunk in chunks:
+        for paragraph in splitter.feed(chunk):
+            yield paragraph
+    yield splitter.close()
+
+
+class RunningStats:
+    """Welford's online mean/variance"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def push(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def with_value(self, value: float) -> 'RunningStats':
+        """Copy of these stats with one more value pushed"""
+        stats = RunningStats()
+        stats.count, stats.mean, stats.m2 = self.count, self.mean, self.m2
+        stats.push(value)
+        return stats
+
+    def stdev(self) -> float:
+        """Sample standard deviation (like statistics.stdev)"""
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def pstdev(self) -> float:
+        """Population standard deviation (like statistics.pstdev)"""
+        return math.sqrt(self.m2 / self.count) if self.count > 0 else 0.0
+
+
+class NGramSketch:
+    """
+    Fixed-size sketch counting how many distinct n-grams occur more than once.
+    Two Bloom filters (seen / already repeated) replace the exact n-gram
+    Counter; collisions can only overcount repeats, with a false positive
+    rate that stays negligible while the n-grams are far fewer than the bits.
+    """
+
+    HASHES = 3
+
+    def __init__(self, bits: int = 1 << 22):
+        # Potencia de dos para reducir posiciones con una máscara
+        self.bits = 1 << max(10, int(bits - 1).bit_length())
+        self.mask = np.uint64(self.bits - 1)
+        self.seen = np.zeros(self.bits // 8, dtype=np.uint8)
+        self.repeated_bits = np.zeros(self.bits // 8, dtype=np.uint8)
+        self.repeated = 0
+
+    def add(self, counts: Counter):
+        """Fold a batch of n-gram counts (e.g. one paragraph) into the sketch"""
+        if not counts:
+            return
+        hashes = np.fromiter((hash(ngram) for ngram in counts), dtype=np.int64, count=len(counts)).view(np.uint64)
+        multiplicity = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+
+        # Doble hashing: posición_i = h1 + i*h2 (mod bits)
+        step = (hashes >> np.uint64(32)) | np.uint64(1)
+        positions = np.stack([(hashes + np.uint64(i) * step) & self.mask for i in range(self.HASHES)])
+
+        seen = self._test(self.seen, positions)
+        already_repeated = self._test(self.repeated_bits, positions)
+        newly_repeated = (seen | (multiplicity > 1)) & ~already_repeated
+        self.repeated += int(newly_repeated.sum())
+
+        self._set(self.seen, positions)
+        self._set(self.repeated_bits, positions[:, newly_repeated])
+
+    @staticmethod
+    def _test(filter_bits: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        present = (filter_bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return present.all(axis=0).astype(bool)
+
+    @staticmethod
+    def _set(filter_bits: np.ndarray, positions: np.ndarray):
+        positions = positions.ravel()
+        np.bitwise_or.at(filter_bits, positions >> np.uint64(3),
+                         (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+
+
+class StreamingDetector:
+    """
+    Paragraph-at-a-time AIDetector.
+
+    Keeps mergeable Counters for words and AI phrases, Welford statistics
+    for sentence lengths and clause depth, and NGramSketch filters for
+    repetition. Memory is bounded by the vocabulary plus the fixed sketch
+    size, regardless of the document length. Scores match AIDetector.detect
+    on the joined text except for the repetition score, which is estimated.
+    """
+
+    def __init__(self, detector: AIDetector, sketch_bits: Optional[int] = None):
+        if sketch_bits is None:
+            sketch_bits = int(os.getenv("STREAM_DETECT_SKETCH_BITS", 1 << 22))
+        self.detector = detector
+        self.paragraphs = 0
+
+        # Atributos leídos por las métricas de AIDetector (vista tipo TextProfile)
+        self.word_count = 0
+        self.word_freq: Counter = Counter()
+        self.token_count = 0
+        self.token_chars = 0
+        self.phrase_counts: Counter = Counter()
+        self.lm_stats: Optional[Tuple[float, int]] = (0.0, 0) if detector.language_model.available else None
+
+        # Longitud del texto unido y espacios en sus extremos (regla de < 50 caracteres)
+        self.length = 0
+        self.leading_space = 0
+        self.trailing_space = 0
+        self.has_content = False
+
+        # Repetición: últimos tokens para n-gramas que cruzan párrafos
+        self.bigrams = NGramSketch(sketch_bits)
+        self.trigrams = NGramSketch(sketch_bits)
+        self.tail_tokens: List[str] = []
+
+        # Oraciones cerradas + fragmento abierto que puede seguir en el próximo párrafo
+        self.sentence_stats = RunningStats()
+        self.length_bands: Set[int] = set()
+        self.sentence_patterns: Set[Tuple[str, ...]] = set()
+        self.consecutive_similar = 0
+        self.last_length: Optional[int] = None
+        self.open_sentence: Optional[Tuple[int, str]] = None
+
+        # Cláusulas: la última oración queda abierta hasta ver el siguiente párrafo
+        self.clause_stats = RunningStats()
+        self.open_clauses: Optional[int] = None
+        self.ends_clause = True
+
+    def feed(self, paragraph: str):
+        """Fold one paragraph into the running statistics"""
+        separator = len(TextProfile.PARAGRAPH_SEPARATOR) if self.paragraphs else 0
+        self.paragraphs += 1
+        profile = self.detector.profile_paragraph(paragraph)
+
+        self.length += separator + len(paragraph)
+        if profile.is_blank:
+            self.trailing_space += separator + len(paragraph)
+            if not self.has_content:
+                self.leading_space += separator + len(paragraph)
+        else:
+            self.trailing_space = len(paragraph) - len(paragraph.rstrip())
+            if not self.has_content:
+                self.leading_space += separator + len(paragraph) - len(paragraph.lstrip())
+                self.has_content = True
+
+        self.word_count += profile.word_count
+        self.word_freq.update(profile.word_freq)
+        self.token_count += profile.token_count
+        self.token_chars += profile.token_chars
+        self.phrase_counts.update(profile.phrase_counts)
+        if self.lm_stats is not None:
+            self.lm_stats = (self.lm_stats[0] + profile.lm_stats[0], self.lm_stats[1] + profile.lm_stats[1])
+
+        self._feed_ngrams(profile)
+        self._feed_sentences(profile)
+        self._feed_clauses(profile)
+
+    def snapshot(self, language: str = 'es') -> Dict:
+        """Detection result for everything fed so far (provisional or final)"""
+        detector = self.detector
+        if not self.has_content or self.length - self.leading_space - self.trailing_space < 50:
+            result = detector._short_text_result()
+            result['paragraphs'] = self.paragraphs
+            return result
+
+        # Cerrar (en una copia) la oración y la cláusula aún abiertas
+        sentence_stats, bands, patterns = self.sentence_stats, self.length_bands, self.sentence_patterns
+        consecutive_similar = self.consecutive_similar
+        if self.open_sentence is not None:
+            length, first_word = self.open_sentence
+            sentence_stats = sentence_stats.with_value(length)
+            bands = bands | {detector._length_band(length)}
+            patterns = patterns | {detector._sentence_pattern(length, first_word)}
+            if self.last_length is not None and abs(length - self.last_length) <= 3:
+                consecutive_similar += 1
+        clause_stats = self.clause_stats
+        if self.open_clauses is not None:
+            clause_stats = clause_stats.with_value(self.open_clauses)
+
+        sentence_count = sentence_stats.count
+        if sentence_count < 3 or sentence_stats.mean == 0:
+            burstiness = 50.0
+        else:
+            burstiness = detector._burstiness_score(
+                sentence_count, sentence_stats.mean, sentence_stats.stdev(), len(bands), consecutive_similar
+            )
+        if sentence_count < 2:
+            sentence_variation = 50.0
+        else:
+            sentence_variation = round((len(patterns) / sentence_count) * 100, 2)
+
+        metrics = {
+            'perplexity': detector._calculate_perplexity(self, language),
+            'burstiness': burstiness,
+            'sentence_variation': sentence_variation,
+            'vocabulary_diversity': detector._calculate_vocabulary_diversity(self, language),
+            'pattern_score': detector._calculate_pattern_score(self, language),
+            'readability': detector._readability_score(sentence_count, self.token_count, self.token_chars),
+            'repetition_score': detector._repetition_score(self.token_count, self.bigrams.repeated, self.trigrams.repeated)
+        }
+        conn_metrics = detector._connector_metrics(self)
+        metrics['connector_variety'] = conn_metrics['connector_variety']
+        metrics['connector_overuse'] = 100 - conn_metrics['connector_overuse']
+        metrics['clause_depth_variance'] = round(clause_stats.pstdev(), 2) if clause_stats.count > 1 else 0.0
+
+        result = detector._build_result(metrics, detector._calculate_ai_probability(metrics))
+        result['paragraphs'] = self.paragraphs
+        return result
+
+    def detect_stream(self,
+                      paragraphs: Iterable[str],
+                      language: str = 'es',
+                      every: int = 50,
+                      on_provisional: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        Consume paragraphs (e.g. from iter_paragraphs) and return the final
+        result, calling on_provisional with a provisional result every
+        `every` paragraphs.
+        """
+        for paragraph in paragraphs:
+            self.feed(paragraph)
+            if on_provisional is not None and every > 0 and self.paragraphs % every == 0:
+                on_provisional(self.snapshot(language))
+        return self.snapshot(language)
+
+    def _feed_ngrams(self, profile: TextProfile):
+        # Los contadores del perfil son temporales: se amplían con los n-gramas de la unión
+        window = self.tail_tokens + profile.head_tokens
+        cut = len(self.tail_tokens)
+        for i in range(max(cut - 1, 0), min(cut, len(window) - 1)):
+            profile.bigram_counts[tuple(window[i:i + 2])] += 1
+        for i in range(max(cut - 2, 0), min(cut, len(window) - 2)):
+            profile.trigram_counts[tuple(window[i:i + 3])] += 1
+        self.tail_tokens = (self.tail_tokens + profile.tail_tokens)[-2:]
+        self.bigrams.add(profile.bigram_counts)
+        self.trigrams.add(profile.trigram_counts)
+
+    def _feed_sentences(self, profile: TextProfile):
+        sentences = list(zip(profile.sentence_lengths, profile.sentence_first_words))
+        if not profile.has_sentence_end:
+            if sentences:
+                self.open_sentence = self._join_sentence(self.open_sentence, sentences[0])
+            return
+        head = sentences.pop(0) if profile.opens_with_fragment else None
+        tail = sentences.pop() if profile.ends_with_fragment else None
+        closed = self._join_sentence(self.open_sentence, head)
+        if closed is not None:
+            sentences.insert(0, closed)
+        for length, first_word in sentences:
+            self._push_sentence(length, first_word)
+        self.open_sentence = tail
+
+    @staticmethod
+    def _join_sentence(head: Optional[Tuple[int, str]], rest: Optional[Tuple[int, str]]) -> Optional[Tuple[int, str]]:
+        if head is None or rest is None:
+            return head or rest
+        return (head[0] + rest[0], head[1])
+
+    def _push_sentence(self, length: int, first_word: str):
+        self.sentence_stats.push(length)
+        self.length_bands.add(self.detector._length_band(length))
+        self.sentence_patterns.add(self.detector._sentence_pattern(length, first_word))
+        if self.last_length is not None and abs(length - self.last_length) <= 3:
+            self.consecutive_similar += 1
+        self.last_length = length
+
+    def _feed_clauses(self, profile: TextProfile):
+        if profile.is_blank:
+            return
+        counts = profile.clause_counts
+        if self.open_clauses is None:
+            self.open_clauses = counts[0]
+        elif not self.ends_clause:
+            self.open_clauses += counts[0] - 1
+        else:
+            self.clause_stats.push(self.open_clauses)
+            self.open_clauses = counts[0]
+        for count in counts[1:]:
+            self.clause_stats.push(self.open_clauses)
+            self.open_clauses = count
+        self.ends_clause = profile.ends_clause
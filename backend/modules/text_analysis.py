@@ -0,0 +1,268 @@
+"""
+Text Analysis
+Tokenization and lexicons shared by the detector, the metrics calculator
+and the rewriter. A text is analyzed once into an AnalyzedText whose
+views (lowercase form, word lists, diff tokens with their offsets and
+interned IDs, sentences) are computed on first use; an AnalysisCache
+created for one job hands the same AnalyzedText to every module that
+looks at the same string.
+"""
+import re
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+# --- Léxicos ---------------------------------------------------------------
+
+LEXICONS: Dict[str, FrozenSet[str]] = {}
+
+
+def register_lexicon(name: str, words: Iterable[str]) -> FrozenSet[str]:
+    """Register (or replace) a named word/phrase set"""
+    LEXICONS[name] = frozenset(words)
+    return LEXICONS[name]
+
+
+def get_lexicon(name: str) -> FrozenSet[str]:
+    try:
+        return LEXICONS[name]
+    except KeyError:
+        raise KeyError(f"Léxico desconocido: {name}") from None
+
+
+# Stopwords completas (métricas: palabras raras)
+register_lexicon('stopwords_es', {
+    'a', 'al', 'algo', 'algunas', 'algunos', 'ante', 'antes', 'como', 'con', 'contra', 'cual', 'cuando',
+    'de', 'del', 'desde', 'donde', 'durante', 'e', 'el', 'ella', 'ellas', 'ellos', 'en', 'entre', 'era',
+    'erais', 'eran', 'eras', 'eres', 'es', 'esa', 'esas', 'ese', 'eso', 'esos', 'esta', 'estaba',
+    'estabais', 'estaban', 'estabas', 'estad', 'estada', 'estadas', 'estado', 'estados', 'estamos',
+    'estando', 'estar', 'estaremos', 'estará', 'estarán', 'estarás', 'estaré', 'estaréis', 'estaría',
+    'estaríais', 'estaríamos', 'estarían', 'estarías', 'estas', 'este', 'estemos', 'esto', 'estos',
+    'estoy', 'estuve', 'estuviera', 'estuvierais', 'estuvieran', 'estuvieras', 'estuvieron', 'estuviese',
+    'estuvieseis', 'estuviesen', 'estuvieses', 'estuvimos', 'estuviste', 'estuvisteis', 'estuvo', 'está',
+    'estábamos', 'estáis', 'están', 'estás', 'esté', 'estéis', 'estén', 'estés', 'fue', 'fuera', 'fuerais',
+    'fueran', 'fueras', 'fueron', 'fuese', 'fueseis', 'fuesen', 'fueses', 'fui', 'fuimos', 'fuiste',
+    'fuisteis', 'ha', 'habida', 'habidas', 'habido', 'habidos', 'habiendo', 'habremos', 'habrá',
+    'habrán', 'habrás', 'habré', 'habréis', 'habría', 'habríais', 'habríamos', 'habrían', 'habrías',
+    'habéis', 'había', 'habíais', 'habíamos', 'habían', 'habías', 'han', 'has', 'hasta', 'hay', 'haya',
+    'hayamos', 'hayan', 'hayas', 'hayáis', 'he', 'hemos', 'hube', 'hubiera', 'hubierais', 'hubieran',
+    'hubieras', 'hubieron', 'hubiese', 'hubieseis', 'hubiesen', 'hubieses', 'hubimos', 'hubiste',
+    'hubisteis', 'hubo', 'la', 'las', 'le', 'les', 'lo', 'los', 'me', 'mi', 'mis', 'mucho', 'muchos',
+    'muy', 'más', 'mí', 'mía', 'mías', 'mío', 'míos', 'nada', 'ni', 'no', 'nos', 'nosotras', 'nosotros',
+    'nuestra', 'nuestras', 'nuestro', 'nuestros', 'o', 'os', 'otra', 'otras', 'otro', 'otros', 'para',
+    'pero', 'poco', 'por', 'porque', 'que', 'quien', 'se', 'sea', 'seamos', 'sean', 'seas', 'sentid',
+    'sentida', 'sentidas', 'sentido', 'sentidos', 'seremos', 'será', 'serán', 'serás', 'seré', 'seréis',
+    'sería', 'seríais', 'seríamos', 'serían', 'serías', 'seáis', 'sido', 'siendo', 'sin', 'sobre',
+    'sois', 'somos', 'son', 'soy', 'su', 'sus', 'suya', 'suyas', 'suyo', 'suyos', 'sí', 'también',
+    'tanto', 'te', 'tendremos', 'tendrá', 'tendrán', 'tendrás', 'tendré', 'tendréis', 'tendría',
+    'tendríais', 'tendríamos', 'tendrían', 'tendrías', 'tened', 'tenemos', 'tenga', 'tengamos', 'tengan',
+    'tengas', 'tengo', 'tengáis', 'tenida', 'tenidas', 'tenido', 'tenidos', 'teniendo', 'tenéis',
+    'tenía', 'teníais', 'teníamos', 'tenían', 'tenías', 'ti', 'tiene', 'tienen', 'tienes', 'todo',
+    'todos', 'tu', 'tus', 'tuve', 'tuviera', 'tuvierais', 'tuvieran', 'tuvieras', 'tuvieron', 'tuviese',
+    'tuvieseis', 'tuviesen', 'tuvieses', 'tuvimos', 'tuviste', 'tuvisteis', 'tuvo', 'tuya', 'tuyas',
+    'tuyo', 'tuyos', 'tú', 'un', 'una', 'uno', 'unos', 'vosotras', 'vosotros', 'vuestra', 'vuestras',
+    'vuestro', 'vuestros', 'y', 'ya', 'yo', 'él', 'éramos'
+})
+
+# Palabras vacías más frecuentes (detector: diversidad de vocabulario)
+register_lexicon('stopwords_es_frequent', {
+    'el', 'la', 'de', 'que', 'y', 'a', 'en', 'un', 'ser', 'se',
+    'no', 'haber', 'por', 'con', 'su', 'para', 'como', 'estar',
+    'tener', 'le', 'lo', 'todo', 'pero', 'más', 'hacer', 'o',
+    'poder', 'decir', 'este', 'ir', 'otro', 'ese', 'si', 'me',
+    'ya', 'ver', 'porque', 'dar', 'cuando', 'muy', 'sin', 'vez',
+    'mucho', 'saber', 'qué', 'sobre', 'mi', 'alguno', 'mismo',
+    'yo', 'también', 'hasta', 'año', 'dos', 'querer', 'entre'
+})
+
+# Conectores típicos de IA (detectados por GPT-Zero)
+register_lexicon('connectors_ai_es', {
+    "además", "por lo tanto", "en conclusión", "sin embargo",
+    "no obstante", "por consiguiente", "en resumen", "asimismo",
+    "en consecuencia", "del mismo modo", "en este sentido",
+    "es importante destacar", "cabe mencionar", "es necesario señalar",
+    "en primer lugar", "en segundo lugar", "finalmente"
+})
+
+# Conectores humanos naturales
+register_lexicon('connectors_human_es', {
+    "bueno", "mira", "la verdad es que", "resulta que",
+    "eso sí", "ahora", "lo que pasa es que", "total que",
+    "al final", "o sea", "vamos que", "en fin",
+    "por cierto", "a todo esto", "el caso es que", "claro"
+})
+
+
+# --- Texto analizado --------------------------------------------------------
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+|\S')
+WORD_PATTERN = re.compile(r'\b[a-záéíóúñüA-ZÁÉÍÓÚÑÜ]+\b')
+WORD_SPLIT_PATTERN = re.compile(r'(\W+)')
+SENTENCE_END_PATTERN = re.compile(r'[.!?]+(?:\s|$)')
+SENTENCE_BREAK_PATTERN = re.compile(r'(?<=[\.!?])\s+')
+
+
+class AnalyzedText:
+    """
+    Lazily computed views of one text:
+
+    - lower, word_segments (lowercase \\w+ words alternating with their
+      separators) and words_lower
+    - tokens / token_offsets / token_ids: diff tokens (letter/digit runs and
+      every punctuation mark on its own), where they start, and their IDs
+      in the owning cache's vocabulary
+    - words: letter-only words with long (> 6) and rare (> 12, not a
+      stopword) counts, and sentence_count (sentences ended by [.!?]+ and
+      whitespace), as used by the readability metrics
+    - sentence_spans / sentences: sentences cut after [.!?] + whitespace
+    """
+
+    def __init__(self, text: str, vocabulary: Optional[Dict[str, int]] = None):
+        self.text = text
+        self.vocabulary = vocabulary if vocabulary is not None else {}
+        self._lower: Optional[str] = None
+        self._word_segments: Optional[List[str]] = None
+        self._words_lower: Optional[List[str]] = None
+        self._tokens: Optional[List[str]] = None
+        self._token_offsets: Optional[List[int]] = None
+        self._token_ids: Optional[List[int]] = None
+        self._words: Optional[List[str]] = None
+        self._word_counts: Tuple[int, int, int] = (0, 0, 0)
+        self._sentence_count: Optional[int] = None
+        self._sentence_spans: Optional[List[Tuple[int, int]]] = None
+
+    @property
+    def lower(self) -> str:
+        if self._lower is None:
+            self._lower = self.text.lower()
+        return self._lower
+
+    @property
+    def word_segments(self) -> List[str]:
+        if self._word_segments is None:
+            self._word_segments = WORD_SPLIT_PATTERN.split(self.lower)
+        return self._word_segments
+
+    @property
+    def words_lower(self) -> List[str]:
+        if self._words_lower is None:
+            self._words_lower = [w for w in self.word_segments[0::2] if w]
+        return self._words_lower
+
+    @property
+    def tokens(self) -> List[str]:
+        if self._tokens is None:
+            self._tokens = TOKEN_PATTERN.findall(self.text)
+        return self._tokens
+
+    @property
+    def token_offsets(self) -> List[int]:
+        """Start offset of every token, plus the text length"""
+        if self._token_offsets is None:
+            self._token_offsets = [match.start() for match in TOKEN_PATTERN.finditer(self.text)]
+            self._token_offsets.append(len(self.text))
+        return self._token_offsets
+
+    @property
+    def token_ids(self) -> List[int]:
+        if self._token_ids is None:
+            ids = self.vocabulary
+            self._token_ids = [ids.setdefault(token, len(ids)) for token in self.tokens]
+        return self._token_ids
+
+    @property
+    def words(self) -> List[str]:
+        if self._words is None:
+            self._words = WORD_PATTERN.findall(self.text)
+            lengths = [len(word) for word in self._words]
+            stopwords = get_lexicon('stopwords_es')
+            self._word_counts = (
+                sum(lengths),
+                sum(1 for length in lengths if length > 6),
+                sum(1 for word in self._words if len(word) > 12 and word.lower() not in stopwords)
+            )
+        return self._words
+
+    @property
+    def word_chars(self) -> int:
+        self.words
+        return self._word_counts[0]
+
+    @property
+    def long_words(self) -> int:
+        self.words
+        return self._word_counts[1]
+
+    @property
+    def rare_words(self) -> int:
+        self.words
+        return self._word_counts[2]
+
+    @property
+    def sentence_count(self) -> int:
+        if self._sentence_count is None:
+            self._sentence_count = sum(
+                1 for sentence in SENTENCE_END_PATTERN.split(self.text)
+                if sentence and not sentence.isspace()
+            )
+        return self._sentence_count
+
+    @property
+    def sentence_spans(self) -> List[Tuple[int, int]]:
+        if self._sentence_spans is None:
+            text = self.text
+            pieces = []
+            position = 0
+            for match in SENTENCE_BREAK_PATTERN.finditer(text):
+                pieces.append((position, match.start()))
+                position = match.end()
+            pieces.append((position, len(text)))
+
+            # Recortar espacios en los bordes y descartar trozos vacíos
+            self._sentence_spans = []
+            for start, end in pieces:
+                piece = text[start:end]
+                stripped = piece.strip()
+                if stripped:
+                    start += len(piece) - len(piece.lstrip())
+                    self._sentence_spans.append((start, start + len(stripped)))
+        return self._sentence_spans
+
+    @property
+    def sentences(self) -> List[str]:
+        return [self.text[start:end] for start, end in self.sentence_spans]
+
+
+class AnalysisCache:
+    """
+    Small LRU of AnalyzedText objects for one job (a humanize request, a
+    detection): every module asking for the same string gets the same
+    analysis, and all of them share one token vocabulary so token IDs are
+    comparable across texts.
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max(1, max_entries)
+        self.entries: "OrderedDict[str, AnalyzedText]" = OrderedDict()
+        self.vocabulary: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str) -> AnalyzedText:
+        analyzed = self.entries.get(text)
+        if analyzed is not None:
+            self.hits += 1
+            self.entries.move_to_end(text)
+            return analyzed
+        self.misses += 1
+        analyzed = AnalyzedText(text, self.vocabulary)
+        self.entries[text] = analyzed
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return analyzed
+
+
+def analyze(text: str, cache: Optional[AnalysisCache] = None) -> AnalyzedText:
+    """AnalyzedText for text, from the job cache when there is one"""
+    if cache is None:
+        return AnalyzedText(text)
+    return cache.get(text)
@@ -6,6 +6,9 @@ import re
 import random
 import asyncio
 
+from modules.chunking import TextChunk, join_chunks, split_chunks
+from modules.text_analysis import AnalysisCache, analyze
+
 
 class TextRewriter:
     """
@@ -35,6 +38,8 @@ class TextRewriter:
                 self.client = None
                 print("[API] No hay API key válida - modo demo activado")
         
+        # Partes de un texto largo que se reescriben a la vez
+        self.chunk_concurrency = max(1, int(os.getenv("REWRITE_CHUNK_CONCURRENCY", 4)))
         
         # Prompt cognitivo (CEREZOS v2.1) más cercano a firma humana real
         self.system_prompt = """CEREZOS: REESCRITOR CON ESTILO DE PENSAMIENTO REAL (v2.1, anti-GPTZero v7+)
@@ -58,7 +63,7 @@ FORMATO DE SALIDA (JSON)
 }
 
 REGLAS
-• Preserva FROZEN_ENTITIES, números y citas tal como están.
+• Copia literalmente los marcadores de FROZEN_ENTITIES (p. ej. [E3]); preserva números y citas tal como están.
 • Si VOICE=collective, evita "tú" y usa marcadores colectivos cuando aporten.
 • No enmascares comillas ni puntuación natural.
 • Evita conectores formulaicos y sobrecohesión.
@@ -158,7 +163,8 @@ REGLAS
                       *,
                       include_titles: bool = False,
                       progress_callback: Optional[Callable[[str, int, int], Awaitable[None]]] = None,
-                      token_callback: Optional[Callable[[int, int, int, str], Awaitable[None]]] = None) -> Dict[str, Any]:
+                      token_callback: Optional[Callable[[int, int, int, str], Awaitable[None]]] = None,
+                      analysis: Optional[AnalysisCache] = None) -> Dict[str, Any]:
         """
         Rewrite text to make it more human-like while respecting constraints.
         
@@ -167,11 +173,19 @@ REGLAS
             budget: Maximum proportion of tokens that can be changed (0.0-1.0)
             respect_style: Whether to respect the style sample
             style_sample: Optional style sample to match
-            frozen_entities: List of entities that must be preserved
+            frozen_entities: Placeholders (FreezeContext.placeholders) that must be preserved
+            progress_callback: Receives ("chunk_start", started, total) and
+                ("chunk_done", finished, total); long texts rewrite their
+                chunks concurrently, so these are running counts, not chunk
+                positions
+            analysis: Analysis cache of the current job; the original is
+                tokenized once for every change-ratio check
             
         Returns:
             Dictionary with rewritten text, change ratio, and notes
         """
+        if analysis is None:
+            analysis = AnalysisCache()
         if not self.client:
             # Modo heurístico local (sin API) para evitar 0% cambios
             rewritten = await self._heuristic_humanize(
@@ -179,7 +193,8 @@ REGLAS
                 budget=budget,
                 frozen_entities=frozen_entities or [],
                 progress_callback=progress_callback,
-                voice=voice
+                voice=voice,
+                analysis=analysis
             )
             return rewritten
         
@@ -195,115 +210,55 @@ REGLAS
             if len(text) > MAX_CHARS:
                 print(f"[DeepSeek] Texto largo detectado ({len(text)} chars), procesando por partes...")
                 
-                # Dividir por párrafos
-                paragraphs = text.split('\n\n')
-                if len(paragraphs) == 1:
-                    # Si no hay párrafos, dividir por puntos
-                    sentences = text.split('. ')
-                    # Reagrupar en chunks de tamaño apropiado
-                    chunks = []
-                    current_chunk = ""
-                    for sentence in sentences:
-                        if len(current_chunk) + len(sentence) < MAX_CHARS:
-                            current_chunk += sentence + ". "
-                        else:
-                            if current_chunk:
-                                chunks.append(current_chunk.strip())
-                            current_chunk = sentence + ". "
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                else:
-                    chunks = paragraphs
+                # Dividir por párrafos y oraciones sin cortar citas ni abreviaturas;
+                # cada parte lleva solo sus entidades congeladas
+                chunks = split_chunks(text, MAX_CHARS, frozen_entities or [])
                 
-                # Procesar cada chunk
+                # Procesar los chunks en paralelo (REWRITE_CHUNK_CONCURRENCY a la vez)
                 rewritten_chunks = []
                 total_changes = 0
                 total_tokens = 0
                 
-                for i, chunk in enumerate(chunks):
-                    if not chunk.strip():
+                results = await self._rewrite_chunks(
+                    chunks,
+                    voice=voice,
+                    include_titles=include_titles,
+                    temperature=0.7,
+                    max_tokens=2000,
+                    progress_callback=progress_callback
+                )
+                for chunk, chunk_result in zip(chunks, results):
+                    if chunk_result is None:
+                        rewritten_chunks.append(chunk.text)
                         continue
+                    rewritten_chunks.append(chunk_result.get("rewritten", chunk.text))
                     
-                    if progress_callback:
-                        await progress_callback("chunk_start", i + 1, len(chunks))
-                    
-                    print(f"[DeepSeek] Procesando parte {i+1}/{len(chunks)}...")
-                    
-                    chunk_prompt = self._build_user_prompt(
-                        text=chunk,
-                        budget=effective_budget,
-                        respect_style=respect_style,
-                        style_sample=style_sample,
-                        frozen_entities=frozen_entities or [],
-                        voice=voice,
-                        detector_feedback=detector_feedback
-                    )
-                    
-                    # Usar exclusivamente deepseek-chat
-                    response = await self.client.chat.completions.create(
-                        model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
-                        messages=[
-                            {"role": "system", "content": self.system_prompt},
-                            {"role": "user", "content": chunk_prompt},
-                        ],
-                        temperature=0.7,
-                        max_tokens=self._clamp_max_tokens(2000),
-                    )
-                    
-                    try:
-                        chunk_result = json.loads(response.choices[0].message.content)
-                        rewritten_chunks.append(chunk_result.get("rewritten", chunk))
-                        
-                        # Acumular métricas
-                        chunk_tokens = len(chunk.split())
-                        chunk_changes = chunk_result.get("changed_tokens_ratio", 0) * chunk_tokens
-                        total_tokens += chunk_tokens
-                        total_changes += chunk_changes
-                        
-                    except (json.JSONDecodeError, KeyError):
-                        print(f"[DeepSeek] Error en chunk {i+1}, usando texto original")
-                        rewritten_chunks.append(chunk)
-                    
-                    if progress_callback:
-                        await progress_callback("chunk_done", i + 1, len(chunks))
+                    # Acumular métricas
+                    chunk_tokens = len(chunk.text.split())
+                    chunk_changes = chunk_result.get("changed_tokens_ratio", 0) * chunk_tokens
+                    total_tokens += chunk_tokens
+                    total_changes += chunk_changes
                 
-                # Combinar resultados
-                final_text = "\n\n".join(rewritten_chunks) if paragraphs else " ".join(rewritten_chunks)
+                # Combinar resultados (con los mismos separadores del original)
+                final_text = join_chunks(chunks, rewritten_chunks)
                 final_ratio = total_changes / total_tokens if total_tokens > 0 else 0
                 
                 # Refuerzo: garantizar mínimo
                 if final_ratio < min_change_ratio:
                     # Segundo intento con flag de fuerza (procesar cada chunk)
-                    chunks2 = []
-                    for chunk in chunks:
-                        chunk_prompt = self._build_user_prompt(
-                            text=chunk,
-                            budget=max(effective_budget, 0.6),
-                            respect_style=respect_style,
-                            style_sample=style_sample,
-                            frozen_entities=frozen_entities or [],
-                            voice=voice,
-                            detector_feedback=detector_feedback,
-                            force_min_change=True,
-                            min_change_ratio=min_change_ratio
-                        )
-                        response = await self.client.chat.completions.create(
-                            model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
-                            messages=[
-                                {"role": "system", "content": self.system_prompt},
-                                {"role": "user", "content": chunk_prompt}
-                            ],
-                            temperature=0.75,
-                            max_tokens=self._clamp_max_tokens(8192)
-                        )
-                        raw2 = response.choices[0].message.content
-                        try:
-                            jr = json.loads(raw2)
-                            chunks2.append(jr.get("rewritten", chunk))
-                        except Exception:
-                            chunks2.append(chunk)
-                    final_text = ("\n\n".join(chunks2) if paragraphs else " ".join(chunks2)).strip()
-                    final_ratio = self._calculate_token_change_ratio(text, final_text)
+                    results2 = await self._rewrite_chunks(
+                        chunks,
+                        voice=voice,
+                        include_titles=include_titles,
+                        temperature=0.75,
+                        max_tokens=8192
+                    )
+                    chunks2 = [
+                        chunk.text if result is None else result.get("rewritten", chunk.text)
+                        for chunk, result in zip(chunks, results2)
+                    ]
+                    final_text = join_chunks(chunks, chunks2).strip()
+                    final_ratio = self._calculate_token_change_ratio(text, final_text, analysis)
                 
                 return {
                     "rewritten": final_text,
@@ -399,7 +354,7 @@ REGLAS
                     if recovered:
                         return {
                             "rewritten": recovered,
-                            "changed_tokens_ratio": self._calculate_token_change_ratio(text, recovered),
+                            "changed_tokens_ratio": self._calculate_token_change_ratio(text, recovered, analysis),
                             "notes": ["json_stream_recovered"]
                         }
                     # Si no llegó JSON válido, usar heurístico
@@ -408,7 +363,8 @@ REGLAS
                         budget=budget,
                         frozen_entities=frozen_entities or [],
                         progress_callback=progress_callback,
-                        voice=voice
+                        voice=voice,
+                        analysis=analysis
                     )
                 # Intentar parsear el bloque JSON encontrado; si falla, recuperar 'rewritten'
                 try:
@@ -418,7 +374,7 @@ REGLAS
                     if recovered:
                         result = {
                             "rewritten": recovered,
-                            "changed_tokens_ratio": self._calculate_token_change_ratio(text, recovered),
+                            "changed_tokens_ratio": self._calculate_token_change_ratio(text, recovered, analysis),
                             "notes": ["json_block_recovered"]
                         }
                     else:
@@ -427,7 +383,8 @@ REGLAS
                             budget=budget,
                             frozen_entities=frozen_entities or [],
                             progress_callback=progress_callback,
-                            voice=voice
+                            voice=voice,
+                            analysis=analysis
                         )
             
             # Validate the response structure
@@ -436,19 +393,19 @@ REGLAS
                 rewritten_fallback = result.get("rewritten") if isinstance(result, dict) else text
                 result = {
                     "rewritten": rewritten_fallback or text,
-                    "changed_tokens_ratio": self._calculate_token_change_ratio(text, rewritten_fallback or text),
+                    "changed_tokens_ratio": self._calculate_token_change_ratio(text, rewritten_fallback or text, analysis),
                     "notes": ["estructura_incompleta: calculado localmente"]
                 }
             
             # Ensure budget compliance y estimación si falta
             actual_ratio = result.get("changed_tokens_ratio")
             if actual_ratio is None:
-                actual_ratio = self._calculate_token_change_ratio(text, result.get("rewritten", text))
+                actual_ratio = self._calculate_token_change_ratio(text, result.get("rewritten", text), analysis)
                 result["changed_tokens_ratio"] = actual_ratio
             
             # Refuerzo de longitudes: si hay pocas oraciones largas, solicitar ajuste
             def _long_sentence_ratio(t: str) -> float:
-                sents = [s.strip() for s in re.split(r'(?<=[\.!?])\s+', t) if s.strip()]
+                sents = analysis.get(t).sentences
                 if not sents:
                     return 0.0
                 long_count = sum(1 for s in sents if len(s.split()) >= 28)
@@ -459,14 +416,9 @@ REGLAS
                 reinforce_prompt = (
                     self._build_user_prompt(
                         text=result.get("rewritten", text),
-                        budget=max(effective_budget, 0.65),
-                        respect_style=respect_style,
-                        style_sample=style_sample,
                         frozen_entities=frozen_entities or [],
                         voice=voice,
-                        detector_feedback=detector_feedback,
-                        force_min_change=False,
-                        min_change_ratio=min_change_ratio
+                        include_titles=include_titles
                     )
                     + "\n" +
                     "ENFASIS_LONG_SENTENCES=TRUE\nHARD_REQUIREMENTS: Al menos 50% de oraciones entre 28–70 palabras y 2 oraciones ≥65 palabras si el tema lo permite; mantiene la coherencia."
@@ -493,13 +445,9 @@ REGLAS
                 # Segundo intento con "force"
                 force_prompt = self._build_user_prompt(
                     text=text,
-                    budget=max(effective_budget, 0.6),
-                    respect_style=respect_style,
-                    style_sample=style_sample,
                     frozen_entities=frozen_entities or [],
-                    detector_feedback=detector_feedback,
-                    force_min_change=True,
-                    min_change_ratio=min_change_ratio
+                    voice=voice,
+                    include_titles=include_titles
                 )
                 response2 = await self.client.chat.completions.create(
                     model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
@@ -512,7 +460,7 @@ REGLAS
                     result2 = json.loads(raw2)
                 except Exception:
                     result2 = {"rewritten": result.get("rewritten", text)}
-                result2_ratio = self._calculate_token_change_ratio(text, result2.get("rewritten", text))
+                result2_ratio = self._calculate_token_change_ratio(text, result2.get("rewritten", text), analysis)
                 if result2_ratio >= min_change_ratio:
                     return {
                         "rewritten": result2.get("rewritten", text),
@@ -524,7 +472,8 @@ REGLAS
                     budget=effective_budget,
                     frozen_entities=frozen_entities or [],
                     progress_callback=progress_callback,
-                    voice=voice
+                    voice=voice,
+                    analysis=analysis
                 )
                 return heuristic
             # Nota informativa si ratio bajo (para trazas)
@@ -542,7 +491,8 @@ REGLAS
                 budget=budget,
                 frozen_entities=frozen_entities or [],
                 progress_callback=progress_callback,
-                voice=voice
+                voice=voice,
+                analysis=analysis
             )
         except json.JSONDecodeError as e:
             # Fallback to original text if JSON parsing fails
@@ -552,7 +502,8 @@ REGLAS
                 budget=budget,
                 frozen_entities=frozen_entities or [],
                 progress_callback=progress_callback,
-                voice=voice
+                voice=voice,
+                analysis=analysis
             )
         except Exception as e:
             # General error fallback
@@ -567,20 +518,90 @@ REGLAS
                 budget=budget,
                 frozen_entities=frozen_entities or [],
                 progress_callback=progress_callback,
-                voice=voice
+                voice=voice,
+                analysis=analysis
             )
 
+    async def _rewrite_chunks(self,
+                              chunks: List[TextChunk],
+                              *,
+                              voice: Optional[str],
+                              include_titles: bool,
+                              temperature: float,
+                              max_tokens: int,
+                              progress_callback: Optional[Callable[[str, int, int], Awaitable[None]]] = None
+                              ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Rewrite the chunks of a long text with at most chunk_concurrency
+        calls in flight. Returns the parsed JSON of each chunk in chunk order
+        (None for blank chunks and unparseable responses). An API error
+        cancels the remaining calls and propagates.
+        """
+        pending = [index for index, chunk in enumerate(chunks) if chunk.text.strip()]
+        results: List[Optional[Dict[str, Any]]] = [None] * len(chunks)
+        semaphore = asyncio.Semaphore(self.chunk_concurrency)
+        started = 0
+        finished = 0
+        
+        async def rewrite_chunk(index: int):
+            nonlocal started, finished
+            chunk = chunks[index]
+            async with semaphore:
+                started += 1
+                if progress_callback:
+                    await progress_callback("chunk_start", started, len(pending))
+                print(f"[DeepSeek] Procesando parte {index + 1}/{len(chunks)}...")
+                
+                chunk_prompt = self._build_user_prompt(
+                    text=chunk.text,
+                    frozen_entities=chunk.entities,
+                    voice=voice,
+                    include_titles=include_titles
+                )
+                # Usar exclusivamente deepseek-chat
+                response = await self.client.chat.completions.create(
+                    model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+                    messages=[
+                        {"role": "system", "content": self.system_prompt},
+                        {"role": "user", "content": chunk_prompt},
+                    ],
+                    temperature=temperature,
+                    max_tokens=self._clamp_max_tokens(max_tokens),
+                )
+                try:
+                    chunk_result = json.loads(response.choices[0].message.content)
+                    if isinstance(chunk_result, dict):
+                        results[index] = chunk_result
+                except json.JSONDecodeError:
+                    pass
+                if results[index] is None:
+                    print(f"[DeepSeek] Error en chunk {index + 1}, usando texto original")
+            
+            # Cuenta de partes terminadas: avanza aunque terminen fuera de orden
+            finished += 1
+            if progress_callback:
+                await progress_callback("chunk_done", finished, len(pending))
+        
+        tasks = [asyncio.ensure_future(rewrite_chunk(index)) for index in pending]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return results
+
     async def _heuristic_humanize(self,
                                   text: str,
                                   budget: float,
                                   frozen_entities: List[str],
                                   progress_callback: Optional[Callable[[str, int, int], Awaitable[None]]] = None,
-                                  voice: Optional[str] = None) -> Dict[str, Any]:
+                                  voice: Optional[str] = None,
+                                  analysis: Optional[AnalysisCache] = None) -> Dict[str, Any]:
         """Humanización heurística local para cuando no hay API.
         Aplica variación de longitudes, conectores menos típicos de IA y sinónimos controlados.
         """
-        sentences = re.split(r'(?<=[\.!?])\s+', text.strip())
-        sentences = [s.strip() for s in sentences if s.strip()]
+        sentences = analyze(text, analysis).sentences
         if not sentences:
             return {"rewritten": text, "changed_tokens_ratio": 0.0, "notes": ["texto vacío"]}
 
@@ -653,7 +674,7 @@ REGLAS
                 for s in rewritten_sentences
             ]
 
-        # Reinstaurar placeholders de entidades (no tocar __ENTITY_X__)
+        # Reinstaurar placeholders de entidades (no tocar [E<n>])
         rewritten_text = " ".join(rewritten_sentences)
         
         # Refuerzo: si el texto quedó con pocas oraciones largas, combina más
@@ -667,7 +688,7 @@ REGLAS
             if ph not in rewritten_text and ph in text:
                 rewritten_text = rewritten_text.replace(ph, ph)
 
-        ratio = self._calculate_token_change_ratio(text, rewritten_text)
+        ratio = self._calculate_token_change_ratio(text, rewritten_text, analysis)
         # Limitar por budget
         max_ratio = min(0.95, max(0.05, budget + 0.15))
         if ratio > max_ratio:
@@ -692,16 +713,18 @@ REGLAS
         
         Args:
             text: Text to rewrite
-            budget: Budget constraint
-            respect_style: Whether to respect style
-            style_sample: Style sample text
-            frozen_entities: Entities to preserve
+            frozen_entities: Placeholders of the frozen entities (only the ones
+                present in this text are listed)
+            voice: Voice of the rewrite (neutral | collective)
+            include_titles: Whether titles are kept as they are
             
         Returns:
             Formatted user prompt
         """
+        # Separados por espacios: cada marcador cuesta sus propios tokens, sin comillas ni comas
+        present = [placeholder for placeholder in frozen_entities if placeholder in text]
         prompt_parts = [
-            f"FROZEN_ENTITIES={json.dumps(frozen_entities, ensure_ascii=False)}",
+            f"FROZEN_ENTITIES={' '.join(present)}",
         ]
         if voice:
             prompt_parts.append(f"VOICE={voice}")
@@ -711,20 +734,22 @@ REGLAS
         
         return "\n".join(prompt_parts)
     
-    def _calculate_token_change_ratio(self, original: str, rewritten: str) -> float:
+    def _calculate_token_change_ratio(self, original: str, rewritten: str,
+                                      analysis: Optional[AnalysisCache] = None) -> float:
         """
         Calculate the approximate ratio of changed tokens.
         
         Args:
             original: Original text
             rewritten: Rewritten text
+            analysis: Analysis cache of the current job (optional)
             
         Returns:
             Ratio of changed tokens (0.0-1.0)
         """
-        # Simple tokenization by splitting on whitespace and punctuation
-        original_tokens = re.findall(r'\w+', original.lower())
-        rewritten_tokens = re.findall(r'\w+', rewritten.lower())
+        # Palabras (\w+) en minúsculas del análisis compartido
+        original_tokens = analyze(original, analysis).words_lower
+        rewritten_tokens = analyze(rewritten, analysis).words_lower
         
         # Convert to sets to find differences
         original_set = set(original_tokens)
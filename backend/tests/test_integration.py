@@ -1,14 +1,33 @@
 import pytest
+import numpy as np
 from fastapi.testclient import TestClient
 import sys
+import asyncio
 import os
+import json
+import pickle
+import re
+import threading
+import time
+from types import SimpleNamespace
 
 # Add the backend directory to the Python path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import main
 from main import app
-from modules.entity_extractor import EntityExtractor
+from modules.entity_extractor import PLACEHOLDER_PATTERN, EntityExtractor
 from modules.metrics_calculator import MetricsCalculator
+from modules.edit_distance import EditDistanceEngine, dp_distance, myers_distance
+from modules.ai_detector import AIDetector, TextProfile
+from modules.live_detector import LiveDetectionSession
+from modules.live_metrics import LiveMetricsSession
+from modules.stream_detector import StreamingDetector, iter_paragraphs
+from modules.ngram_lm import NGramLanguageModel, build_model
+from modules.calibrator import DeepSeekCalibrator
+from modules.cpu_executor import CPUExecutor
+from modules.text_analysis import AnalysisCache, get_lexicon
+from modules.text_rewriter import TextRewriter
 
 client = TestClient(app)
 
@@ -77,7 +96,175 @@ class TestEntityPreservation:
         assert any("500" in entity for entity in entities)
         
         # Verify placeholders were inserted
-        assert "__ENTITY_" in processed_text
+        assert PLACEHOLDER_PATTERN.search(processed_text)
+
+    def test_freeze_and_restore_many_entities(self):
+        """Test that citation-heavy texts freeze and restore every entity in place"""
+        extractor = EntityExtractor()
+        test_text = " ".join(
+            f"Según García ({1990 + i % 30}), el {i}% de los casos [{i}] mejora."
+            for i in range(300)
+        )
+
+        context = extractor.extract_and_freeze(test_text)
+        entities, processed_text = context
+
+        assert len(entities) == len(context.placeholders) == len(PLACEHOLDER_PATTERN.findall(processed_text))
+        # Numeradas desde el final del texto
+        assert entities[0] == "299"
+        assert extractor.restore_entities(processed_text, context) == test_text
+        assert extractor.restore_entities("[E99999]", context) == "[E99999]"
+
+    def test_restore_recovers_mangled_placeholders(self):
+        """Test that lightly corrupted placeholders are restored without a retry"""
+        extractor = EntityExtractor()
+        context = extractor.extract_and_freeze("El 85% de los casos en 2020 (García, 2019).")
+        assert context.processed_text == "El [E2]% de los casos en [E1] [E0]."
+
+        mangled = "En [e1] y [ E 0 ], el [E 2 ]% de los casos; [E7] no existe."
+        assert extractor.restore_entities(mangled, context) == \
+            "En 2020 y (García, 2019), el 85% de los casos; [E7] no existe."
+
+        # Si el texto ya trae algo parecido a [E<n>], formato largo (también tolerante)
+        legacy = extractor.extract_and_freeze("Ver [e1] en 2020.")
+        placeholder = next(iter(legacy.placeholders))
+        assert placeholder.startswith("__ENTITY_0_")
+        assert legacy.processed_text == f"Ver [e1] en {placeholder}."
+        mangled = "ver [e1] en " + placeholder.upper().replace("_", " ").strip() + "."
+        assert extractor.restore_entities(mangled, legacy) == "ver [e1] en 2020."
+
+    def test_freeze_contexts_are_request_scoped(self):
+        """Test that overlapping jobs on one extractor keep their own placeholder maps"""
+        extractor = EntityExtractor()
+        first = extractor.extract_and_freeze("El 85% de los casos en 2020.")
+        second = extractor.extract_and_freeze("Solo el 12% en 2021 (García, 2019).")
+
+        assert extractor.restore_entities(first.processed_text, first) == "El 85% de los casos en 2020."
+        assert extractor.restore_entities(second.processed_text, second) == "Solo el 12% en 2021 (García, 2019)."
+        assert extractor.verify_entities_preserved("", "El 85% de los casos en 2020.", first)
+        with pytest.raises(AttributeError):
+            first.placeholders = {}
+        with pytest.raises(TypeError):
+            first.placeholders["[E9]"] = "x"
+        assert pickle.loads(pickle.dumps(second)).placeholders == second.placeholders
+
+
+    def test_entity_types_recorded_at_extraction(self):
+        """Test that entity stats come from the named group that matched each entity"""
+        extractor = EntityExtractor()
+        text = "Según (López et al., 2019), el 85% mejora en 2021; ver https://x.org/a."
+        context = extractor.extract_and_freeze(text)
+
+        assert context.entity_types == ("urls", "numbers", "numbers", "citations")
+        stats = extractor.get_entity_stats(context)
+        assert stats == extractor.get_entity_stats(list(context.entities))
+        assert (stats["citations"], stats["urls"], stats["numbers"], stats["total"]) == (1, 1, 2, 4)
+        assert pickle.loads(pickle.dumps(context)).entity_types == context.entity_types
+
+        # "<mes> <día>, <año>" exige un nombre de mes
+        dated = extractor.extract_and_freeze("Publicado en Marzo 5, 2020; véase el capítulo 3, 2020.")
+        assert "Marzo 5, 2020" in dated.entities
+        assert not any(entity.startswith("capítulo") for entity in dated.entities)
+
+    def test_entity_search_is_bounded_on_adversarial_input(self):
+        """Test that unclosed parentheses do not make extraction super-linear"""
+        extractor = EntityExtractor()
+        start = time.perf_counter()
+        context = extractor.extract_and_freeze("(1234 " * 5000 + "(García, 2019).")
+        assert time.perf_counter() - start < 1.0
+        assert not context.timed_out
+        assert context.entities[0] == "(García, 2019)"
+
+        # Con el tiempo agotado se congela solo lo encontrado y el texto sigue siendo restaurable
+        extractor.match_timeout = 1e-6
+        text = "Según García (2019), el 85% de 1,234 casos. " * 20000
+        context = extractor.extract_and_freeze(text)
+        assert context.timed_out
+        assert len(context.entities) < 3 * 20000
+        assert extractor.restore_entities(context.processed_text, context) == text
+
+    def test_verify_reports_positions_and_multiplicity(self):
+        """Test that one scan locates every entity, overlapping ones included"""
+        extractor = EntityExtractor()
+        entities = ["2019", "(García, 2019)", "85", "2020"]
+        rewritten = "En 2020 (García, 2019) el 85%; en 2019 también el 85%."
+
+        positions = extractor.verify_entities_preserved("", rewritten, entities)
+        assert positions == {
+            "2019": [17, 34],
+            "(García, 2019)": [8],
+            "85": [26, 50],
+            "2020": [3],
+        }
+        for entity, starts in positions.items():
+            assert starts == [m.start() for m in re.finditer(f"(?={re.escape(entity)})", rewritten)]
+
+        with pytest.raises(ValueError, match="2021"):
+            extractor.verify_entities_preserved("", rewritten, entities + ["2021"])
+
+    def test_long_text_chunks_carry_only_their_entities(self):
+        """Test that long texts are cut outside citations and each prompt lists its own entities"""
+        extractor = EntityExtractor()
+        sentence = "Según López et al. (2019) el {}% de los casos mejora (ver p. 4. Nota). "
+        text = "\n\n".join("".join(sentence.format(i * 40 + j) for j in range(40)) for i in range(6))
+        context = extractor.extract_and_freeze(text)
+
+        prompts = []
+
+        async def create(**kwargs):
+            prompt = kwargs["messages"][1]["content"]
+            prompts.append(prompt)
+            chunk = prompt.split('TEXT="', 1)[1][:-1]
+            content = json.dumps({"rewritten": chunk, "changed_tokens_ratio": 0.9})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+        rewriter = TextRewriter()
+        rewriter.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        result = asyncio.run(rewriter.rewrite(context.processed_text, budget=0.6,
+                                              frozen_entities=list(context.placeholders)))
+
+        assert len(prompts) > 1
+        assert result["rewritten"] == context.processed_text
+        listed = []
+        for prompt in prompts:
+            chunk = prompt.split('TEXT="', 1)[1][:-1]
+            assert not chunk.endswith(("al.", "p. 4.")) and chunk.count("(") == chunk.count(")")
+            entities = prompt.split("FROZEN_ENTITIES=", 1)[1].split("\n", 1)[0].split()
+            assert entities == PLACEHOLDER_PATTERN.findall(chunk)
+            listed += entities
+        assert sorted(listed) == sorted(context.placeholders)
+
+    def test_long_text_chunks_rewritten_concurrently_in_order(self):
+        """Test that chunks run concurrently, reassemble in order and report completion counts"""
+        text = "\n\n".join(f"Párrafo {i}. " + "Una oración de relleno bastante larga. " * 180 for i in range(8))
+        in_flight, peak, events = 0, 0, []
+
+        async def create(**kwargs):
+            nonlocal in_flight, peak
+            chunk = kwargs["messages"][1]["content"].split('TEXT="', 1)[1][:-1]
+            in_flight += 1
+            peak = max(peak, in_flight)
+            # Las primeras partes tardan más: terminan fuera de orden
+            await asyncio.sleep(0.2 - 0.02 * int(chunk.split()[1].rstrip(".")))
+            in_flight -= 1
+            content = json.dumps({"rewritten": chunk.upper(), "changed_tokens_ratio": 0.9})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+        async def progress(event, i, total):
+            events.append((event, i, total))
+
+        rewriter = TextRewriter()
+        rewriter.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        rewriter.chunk_concurrency = 3
+        start = time.perf_counter()
+        result = asyncio.run(rewriter.rewrite(text, budget=0.6, progress_callback=progress))
+        elapsed = time.perf_counter() - start
+
+        assert result["rewritten"] == text.upper()
+        assert peak == 3
+        assert elapsed < 0.9  # en serie serían ~1.04 s
+        done = [i for event, i, total in events if event == "chunk_done"]
+        assert done == list(range(1, 9)) and all(total == 8 for _, _, total in events)
 
 
 class TestBudgetCompliance:
@@ -211,6 +398,227 @@ class TestMetricsCalculation:
             assert "token" in item
             assert item["type"] in ["equal", "insert", "delete"]
     
+    def test_edit_distance_backends_agree(self):
+        """Test that the bit-parallel engine matches the reference DP"""
+        pairs = [
+            ("", "abc"),
+            ("kitten", "sitting"),
+            ("El 85% de los estudiantes", "Un 85% de estudiantes"),
+            ("a" * 70 + "b" * 70, "b" * 70 + "a" * 70),  # más de 64 bits de patrón
+        ]
+        for s1, s2 in pairs:
+            expected = dp_distance(s1, s2)
+            assert myers_distance(s1, s2) == expected
+            assert EditDistanceEngine().distance(s1, s2) == expected
+            # Corte temprano: devuelve cota + 1 si se supera
+            assert myers_distance(s1, s2, max_distance=1) == min(expected, 2)
+    
+    def test_edit_distance_approximate_bounds(self):
+        """Test that the approximate mode brackets the exact distance"""
+        original = " ".join(f"Frase número {i} del ensayo original." for i in range(300))
+        rewritten = original.replace("ensayo", "texto")
+        engine = EditDistanceEngine(chunk_chars=500)
+        
+        upper, lower = engine.approximate(original, rewritten)
+        exact = engine.distance(original, rewritten)
+        assert lower <= exact <= upper
+        assert upper == exact
+    
+    def test_diff_engine_reconstructs_both_texts(self):
+        """Test that the histogram diff is a valid edit script with consistent stats"""
+        calculator = MetricsCalculator()
+        original = " ".join(f"En {2000 + i % 20} la tasa fue de {i}% según el informe." for i in range(150))
+        rewritten = original.replace("la tasa fue de", "se registró un").replace("informe", "estudio")
+        
+        diff, stats = calculator.generate_diff_with_stats(original, rewritten)
+        original_tokens = calculator._tokenize(original)
+        rewritten_tokens = calculator._tokenize(rewritten)
+        assert [d["token"] for d in diff if d["type"] != "insert"] == original_tokens
+        assert [d["token"] for d in diff if d["type"] != "delete"] == rewritten_tokens
+        
+        assert stats["equal_tokens"] + stats["deleted_tokens"] == len(original_tokens)
+        assert stats["equal_tokens"] + stats["inserted_tokens"] == len(rewritten_tokens)
+        # Cada frase cambia en dos sitios
+        assert stats["changed_hunks"] == 300
+        assert calculator.generate_diff(original, original) == [
+            {"type": "equal", "token": token} for token in original_tokens
+        ]
+    
+    def test_diff_runs_cover_both_texts(self):
+        """Test that the run-length diff rebuilds both texts exactly, whitespace included"""
+        calculator = MetricsCalculator()
+        pairs = [
+            ("El gato come pescado. En 2020, el 85% de los gatos comía pescado.",
+             "El gato come atún fresco. En 2020, el 85% de los gatos prefería atún."),
+            ("Texto original termina aquí.", "Texto original termina aquí y sigue más."),
+            ("El gato duerme.", "El gato duerme mucho."),
+            ("  Hola,   mundo.\n", "Hola mundo,\t otra vez.  "),
+            ("Sin cambios.", "   "),
+        ]
+        for original, rewritten in pairs:
+            runs = calculator.generate_diff_runs(original, rewritten)
+            assert "".join(original[a1:a2] for _, a1, a2, _, _ in runs) == original
+            assert "".join(rewritten[b1:b2] for _, _, _, b1, b2 in runs) == rewritten
+            assert all(a1 == a2 for op, a1, a2, _, _ in runs if op == "insert")
+
+        with pytest.raises(ValueError):
+            calculator.generate_diff_with_stats("a", "b", "bogus")
+        with pytest.raises(ValueError):
+            main.HumanizeRequest(text="Texto", diff_format="bogus")
+        # Una entrada por tramo, no por token
+        original, rewritten = pairs[0]
+        assert len(calculator.generate_diff_runs(original, rewritten)) < len(calculator.generate_diff(original, rewritten)) / 2
+    
+    def test_paragraph_aligned_diff(self):
+        """Test that long documents are diffed per aligned paragraph and still cover both texts"""
+        calculator = MetricsCalculator()
+        calculator.paragraph_diff_min_chars = 0
+        paragraphs = [
+            "La inteligencia artificial transforma la educación universitaria.",
+            "Los docentes adaptan sus métodos de evaluación a las nuevas herramientas.",
+            "Los estudiantes, por su parte, necesitan formación en pensamiento crítico.",
+        ]
+        original = "\n\n".join(paragraphs)
+        rewritten = "\n\n".join([
+            paragraphs[0].replace("transforma", "cambia"),
+            "Un párrafo completamente nuevo sobre otra cuestión.",
+            paragraphs[1],
+            paragraphs[2].replace("necesitan", "requieren"),
+        ])
+
+        segments = calculator.paragraph_diff_segments(original, rewritten)
+        assert segments is not None and len(segments) == 4
+        assert segments[1] == (segments[0][1], segments[0][1], segments[0][3], segments[2][2])
+
+        diff, stats = calculator.generate_diff_with_stats(original, rewritten)
+        assert "".join(d["token"] for d in diff if d["type"] != "insert") == "".join(calculator._tokenize(original))
+        assert "".join(d["token"] for d in diff if d["type"] != "delete") == "".join(calculator._tokenize(rewritten))
+        assert stats["changed_hunks"] == 3
+
+        runs, _ = calculator.generate_diff_with_stats(original, rewritten, diff_format="runs")
+        assert "".join(original[a1:a2] for _, a1, a2, _, _ in runs) == original
+        assert "".join(rewritten[b1:b2] for _, _, _, b1, b2 in runs) == rewritten
+
+    def test_live_metrics_match_full_calculation(self):
+        """Test that metrics and diff updated while streaming end equal to the full calculation"""
+        calculator = MetricsCalculator()
+        original = ("El estudio analiza 120 casos. Los resultados muestran mejoras claras. "
+                    "Además, el método es sencillo y barato. Por lo tanto, se recomienda su uso.")
+        rewritten = ("El estudio revisa 120 casos. Los resultados muestran mejoras claras. "
+                     "El método, además, es sencillo y barato. ¿Conviene usarlo? Sí, sin duda.")
+
+        session = LiveMetricsSession(calculator, original)
+        for end in range(7, len(rewritten), 7):
+            live = session.update(rewritten[:end])
+            assert 0.0 <= live["change_ratio"] <= 1.0
+        # Un borrador que cambia texto ya fijado obliga a reescanear (y volver al final otra vez)
+        session.update("Otro texto")
+        metrics, diff, _ = session.finish(rewritten)
+
+        assert session.rescans == 2
+        assert metrics == calculator.calculate(original, rewritten)
+        assert "".join(d["token"] for d in diff if d["type"] != "insert") == "".join(calculator._tokenize(original))
+        assert "".join(d["token"] for d in diff if d["type"] != "delete") == "".join(calculator._tokenize(rewritten))
+
+    def test_live_diff_tail_is_bounded_without_long_equal_runs(self):
+        """Test that a rewrite with no long equal runs still advances the live diff frontier"""
+        calculator = MetricsCalculator()
+        original = " ".join(f"palabra{i}" for i in range(400))
+        # Cada cuarta palabra cambia: ninguna racha igual llega a FRONTIER_MIN_RUN tokens
+        rewritten = " ".join(f"otra{i}" if i % 4 == 0 else f"palabra{i}" for i in range(400))
+
+        session = LiveMetricsSession(calculator, original)
+        session.max_tail_tokens = 40
+        for end in range(0, len(rewritten), 50):
+            session.update(rewritten[:end])
+            assert len(session.tokens) - session.frontier[1] <= session.max_tail_tokens + 10
+        metrics, runs, _ = session.finish(rewritten, "runs")
+
+        assert session.frontier[1] > 0
+        assert metrics == calculator.calculate(original, rewritten)
+        assert "".join(original[a1:a2] for _, a1, a2, _, _ in runs) == original
+        assert "".join(rewritten[b1:b2] for _, _, _, b1, b2 in runs) == rewritten
+
+    def test_humanization_streams_live_metrics(self, monkeypatch):
+        """Test that a streamed rewrite sends live metrics and ends with the streamed result"""
+        original = "El estudio analiza 120 casos en 2019. " * 4 + "Los resultados muestran mejoras claras."
+        rewritten = ("Tras revisar [E1] casos durante [E2], el trabajo concluye que las mejoras observadas "
+                     "son claras, constantes y, sobre todo, fáciles de reproducir en otros contextos. ") * 4
+        content = json.dumps({"rewritten": rewritten, "changed_tokens_ratio": 0.8, "notes": []},
+                             ensure_ascii=False)
+
+        async def create(**kwargs):
+            if kwargs.get("stream"):
+                async def events():
+                    for i in range(0, len(content), 40):
+                        await asyncio.sleep(0)
+                        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i:i + 40]))])
+                return events()
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+        monkeypatch.setattr(main.text_rewriter, "client",
+                            SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        monkeypatch.setattr(main, "LIVE_METRICS_INTERVAL", 0)
+        task_id = main.progress_manager.create_task()
+        queue = main.progress_manager.add_listener(task_id)
+        asyncio.run(main.process_humanization(task_id, main.HumanizeRequest(text=original)))
+
+        updates = []
+        while not queue.empty():
+            updates.append(queue.get_nowait())
+        live = [update["metrics"] for update in updates if update["metrics"]]
+        assert len(live) > 1
+        assert all(0.0 <= metrics["change_ratio"] <= 1.0 for metrics in live)
+        result = main.progress_manager.tasks[task_id]["result"]
+        assert result["result"].startswith("Tras revisar 120 casos durante 2019,")
+        assert result["metrics"] == MetricsCalculator().calculate(original, result["result"])
+
+    def test_humanization_reports_chunk_completion_counts(self, monkeypatch):
+        """Test that the first pass maps every completed chunk of a long text into its progress range"""
+        text = "\n\n".join(f"Párrafo {i}. " + "Una oración de relleno bastante larga. " * 180 for i in range(5))
+
+        async def create(**kwargs):
+            chunk = kwargs["messages"][1]["content"].split('TEXT="', 1)[1][:-1]
+            await asyncio.sleep(0.01 * int(chunk.split()[1].rstrip(".")))
+            content = json.dumps({"rewritten": chunk.upper(), "changed_tokens_ratio": 0.9})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+        monkeypatch.setattr(main.text_rewriter, "client",
+                            SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        task_id = main.progress_manager.create_task()
+        queue = main.progress_manager.add_listener(task_id)
+        asyncio.run(main.process_humanization(task_id, main.HumanizeRequest(text=text, preserve_entities=False)))
+
+        completed = []
+        while not queue.empty():
+            update = queue.get_nowait()
+            if "partes completadas" in update["message"]:
+                completed.append((update["message"], update["progress"]))
+        assert completed == [(f"Pase 1/1: {i}/5 partes completadas", 30 + 8 * i) for i in range(1, 5)] + \
+            [("Pase 1/1: partes completadas", 70)]
+        assert main.progress_manager.tasks[task_id]["result"]["result"] == text.upper()
+
+    def test_single_scan_shared_by_metrics_stats_and_diff(self):
+        """Test that one analysis per text feeds calculate, get_text_stats, the diff and the rewriter"""
+        calculator = MetricsCalculator()
+        rewriter = TextRewriter()
+        analysis = AnalysisCache()
+        original = "El gato come pescado. ¿Come también atún? Sí, a veces."
+        rewritten = "El gato come pescado fresco. ¿Come también atún? Sí, casi siempre."
+        
+        metrics = calculator.calculate(original, rewritten, analysis)
+        stats = calculator.get_text_stats(rewritten, analysis)
+        calculator.generate_diff(original, rewritten, analysis)
+        rewriter._calculate_token_change_ratio(original, rewritten, analysis)
+        # Cada texto se analiza una sola vez
+        assert analysis.misses == 2
+        assert analysis.get(rewritten).sentences[-1] == "Sí, casi siempre."
+        
+        assert stats["sentence_count"] == 3
+        assert stats["word_count"] == 11
+        assert metrics["avg_sentence_len"] == pytest.approx(11 / 3)
+        assert calculator._tokenize(rewritten)[-3:] == ["casi", "siempre", "."]
+    
     def test_api_response_structure(self):
         """Test that API response has all required fields and correct structure"""
         test_text = "Texto de prueba para verificar la estructura de respuesta de la API."
@@ -249,6 +657,260 @@ class TestMetricsCalculation:
         assert isinstance(result["alerts"], list)
 
 
+class TestAIDetector:
+    """Test suite for the AI detector"""
+    
+    AI_TEXT = (
+        "La inteligencia artificial es fundamental para el desarrollo tecnológico moderno. "
+        "Mediante diversos algoritmos, es posible crear sistemas que realizan tareas complejas. "
+        "Además, estos sistemas mejoran continuamente su rendimiento. "
+        "Por lo tanto, la implementación de soluciones basadas en IA resulta crucial."
+    )
+    
+    def test_text_profile_tokenization(self):
+        """Test that the shared profile segments words and sentences once"""
+        detector = AIDetector()
+        profile = detector.build_profile("Hola mundo. Otra frase aquí! ¿Y esta?")
+        
+        assert profile.words == ["hola", "mundo", "otra", "frase", "aquí", "y", "esta"]
+        assert profile.sentence_lengths == [2, 3, 2]
+        assert profile.sentence_first_words == ["hola", "otra", "¿y"]
+        start, end = profile.sentence_spans[1]
+        assert profile.text[start:end] == "Otra frase aquí"
+    
+    def test_detect_with_precomputed_profile(self):
+        """Test that passing a precomputed profile yields the same result"""
+        detector = AIDetector()
+        profile = detector.build_profile(self.AI_TEXT)
+        
+        assert detector.detect(self.AI_TEXT, 'es', profile=profile) == detector.detect(self.AI_TEXT, 'es')
+
+    def test_profile_reuses_shared_analysis_and_lexicons(self):
+        """Test that the detector profile and the metrics share one analysis and the lexicon registry"""
+        detector = AIDetector()
+        analysis = AnalysisCache()
+        profile = detector.build_profile(self.AI_TEXT, analysis)
+        MetricsCalculator().get_text_stats(self.AI_TEXT, analysis)
+
+        assert analysis.misses == 1 and analysis.hits == 1
+        assert profile.words == analysis.get(self.AI_TEXT).words_lower
+        assert detector.spanish_stopwords is get_lexicon('stopwords_es_frequent')
+        with pytest.raises(KeyError):
+            get_lexicon('desconocido')
+
+
+    def test_phrase_matcher_word_boundaries(self):
+        """Test that connectors match whole words, including overlapping phrases"""
+        detector = AIDetector()
+        profile = detector.build_profile("Los buenos resultados, ahora bien, mejoran. Ahora  bien no cuenta.")
+        counts = detector.phrase_matcher.scan(profile.word_segments)
+        
+        assert counts["bueno"] == 0  # "buenos" no es el conector "bueno"
+        assert counts["ahora bien"] == 1  # el doble espacio rompe la frase
+        assert counts["ahora"] == 2
+
+    
+    def test_detect_many_matches_detect(self):
+        """Test that batch detection keeps input order and matches single detection"""
+        detector = AIDetector()
+        texts = [self.AI_TEXT, "corto", self.AI_TEXT.upper()]
+        
+        results = detector.detect_many(texts, 'es')
+        
+        assert len(results) == len(texts)
+        assert results == [detector.detect(text, 'es') for text in texts]
+
+    
+    def test_detect_many_runs_off_the_event_loop(self):
+        """Test that batch detection through the executor leaves the event loop thread"""
+        detector = AIDetector()
+        texts = [self.AI_TEXT, "corto"]
+        threads = []
+        detect_many = detector.detect_many
+        
+        def recording_detect_many(*args):
+            threads.append(threading.get_ident())
+            return detect_many(*args)
+        
+        detector.detect_many = recording_detect_many
+        
+        async def run():
+            return threading.get_ident(), await CPUExecutor(enabled=False).detect_many(detector, texts, 'es')
+        
+        loop_thread, results = asyncio.run(run())
+        
+        assert threads and threads[0] != loop_thread
+        assert results == [detector.detect(text, 'es') for text in texts]
+
+    
+    def test_cpu_pool_starts_without_blocking_the_loop(self):
+        """Test that warming the worker pool lets the event loop run and offloaded detection matches inline"""
+        detector = AIDetector()
+        executor = CPUExecutor(enabled=True, pool_size=1, thresholds={'detect': 0})
+        ticks = 0
+
+        async def run():
+            nonlocal ticks
+            starting = asyncio.ensure_future(executor.start())
+            while not starting.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            await starting
+            return await executor.detect(detector, self.AI_TEXT, 'es')
+
+        try:
+            result = asyncio.run(run())
+        finally:
+            executor.shutdown()
+
+        assert ticks > 1
+        assert result == AIDetector().detect(self.AI_TEXT, 'es')
+
+    
+    def test_detection_cache_hits_on_repeated_text(self):
+        """Test that repeated detections of the same content hit the cache"""
+        detector = AIDetector()
+        
+        first = detector.detect(self.AI_TEXT, 'es')
+        second = detector.detect("  " + self.AI_TEXT + "\n", 'es')
+        detector.get_detailed_report(self.AI_TEXT, 'es')
+        
+        assert first == second
+        stats = detector.cache.stats()
+        assert stats["misses"] == 1
+        assert stats["hits"] == 2
+        
+        # Otro idioma es otra entrada
+        detector.detect(self.AI_TEXT, 'en')
+        assert detector.cache.stats()["size"] == 2
+
+    
+    def test_merged_paragraph_profiles_match_full_text(self):
+        """Test that merging paragraph profiles gives the full-text metrics"""
+        detector = AIDetector()
+        paragraphs = ["Introducción", self.AI_TEXT, "Sin embargo el texto sigue", "aquí. Fin"]
+        text = "\n\n".join(paragraphs)
+        
+        profiles = [detector.build_profile(p) for p in paragraphs]
+        for profile in profiles:
+            detector._phrase_counts(profile)
+        merged = TextProfile.merged(profiles)
+        full = detector.build_profile(text)
+        
+        assert merged.sentence_lengths == full.sentence_lengths
+        assert merged.clause_counts == full.clause_counts
+        assert merged.bigram_counts == full.bigram_counts
+        assert detector._calculate_metrics(merged, 'es') == detector._calculate_metrics(full, 'es')
+    
+    def test_live_session_reprocesses_only_edited_paragraphs(self):
+        """Test that a live session re-profiles only the changed paragraphs"""
+        session = LiveDetectionSession(AIDetector())
+        text = self.AI_TEXT + "\n\n" + self.AI_TEXT.upper() + "\n\nÚltimo párrafo."
+        
+        first = session.update(text, 'es')
+        assert first["paragraphs"] == 3
+        assert first["reprocessed"] == 3
+        
+        edited = text.replace("Último párrafo.", "Último párrafo, ya editado.")
+        second = session.update(edited, 'es')
+        assert second["reprocessed"] == 1
+        assert second["ai_probability"] == AIDetector().detect(edited, 'es')["ai_probability"]
+    
+    def test_live_channel_rejects_bad_messages_and_keeps_pending_edit(self):
+        """Test that invalid live messages get an error frame without dropping the pending edit"""
+        with client.websocket_connect("/api/detect/live") as websocket:
+            websocket.send_json({"text": self.AI_TEXT})
+            websocket.send_text("{no es json")
+            assert websocket.receive_json()["status"] == "error"
+            websocket.send_json(["no", "es", "un", "objeto"])
+            assert websocket.receive_json()["status"] == "error"
+            websocket.send_json({"text": 42})
+            assert websocket.receive_json()["status"] == "error"
+            
+            result = websocket.receive_json()
+            assert result["ai_probability"] == AIDetector().detect(self.AI_TEXT, 'es')["ai_probability"]
+    
+    def test_streaming_detection_matches_detect(self):
+        """Test that paragraph-by-paragraph detection scores like detect()"""
+        detector = AIDetector()
+        text = "\n\n".join([self.AI_TEXT, "Sin embargo el texto sigue", "aquí. Y termina.", self.AI_TEXT])
+        chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+        assert list(iter_paragraphs(chunks)) == text.split("\n\n")
+        
+        provisional = []
+        stream = StreamingDetector(detector)
+        result = stream.detect_stream(iter_paragraphs(chunks), 'es', every=2, on_provisional=provisional.append)
+        
+        assert len(provisional) == 2
+        assert result["paragraphs"] == 4
+        expected = AIDetector().detect(text, 'es')
+        assert result["metrics"] == expected["metrics"]
+        assert result["ai_probability"] == expected["ai_probability"]
+    
+    def test_streaming_detection_of_request_body(self, monkeypatch):
+        """Test that /api/detect/stream scores a chunked body like detect() and bounds paragraph size"""
+        text = "\n\n".join([self.AI_TEXT, "Sin embargo, el análisis sigue", "aquí. Y termina.", self.AI_TEXT])
+        data = text.encode("utf-8")
+        # Bloques de 5 bytes: cortan caracteres multibyte y separadores de párrafo
+        response = client.post("/api/detect/stream?language=es",
+                               content=(data[i:i + 5] for i in range(0, len(data), 5)))
+
+        assert response.status_code == 200
+        result = response.json()
+        expected = AIDetector().detect(text, 'es')
+        assert result["paragraphs"] == 4
+        assert result["metrics"] == expected["metrics"]
+        assert result["ai_probability"] == expected["ai_probability"]
+
+        monkeypatch.setattr(main, "STREAM_DETECT_MAX_PARAGRAPH_CHARS", 100)
+        assert client.post("/api/detect/stream", content=data).status_code == 413
+        assert client.post("/api/detect/stream", content=b"\xff\xfe").status_code == 400
+        assert client.post("/api/detect/stream", content=b"  \n\n ").status_code == 400
+    
+    def test_trigram_language_model_perplexity(self, tmp_path):
+        """Test the memory-mapped trigram model and its use as perplexity"""
+        meta = build_model([self.AI_TEXT] * 3, str(tmp_path))
+        assert meta["order"] == 3
+        
+        model = NGramLanguageModel(str(tmp_path))
+        assert model.available and not model.keys  # carga perezosa
+        shuffled = " ".join(reversed(self.AI_TEXT.split()))
+        assert model.perplexity(self.AI_TEXT) < model.perplexity(shuffled)
+        assert isinstance(model.keys[0], np.memmap)
+        
+        detector = AIDetector()
+        plain_key = detector.cache_key(self.AI_TEXT, 'es')
+        detector.language_model = model
+        result = detector.detect(self.AI_TEXT, 'es')
+        expected = detector._lm_perplexity_score(model.score_text(self.AI_TEXT))
+        assert result["metrics"]["perplexity"] == expected
+        assert detector.cache_key(self.AI_TEXT, 'es') != plain_key
+    
+    def test_calibration_deadline_and_cache(self, monkeypatch):
+        """Test that calibration degrades at the deadline, then serves from cache"""
+        monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+        calibrator = DeepSeekCalibrator(max_concurrency=2, timeout=2.0)
+        calls = []
+        
+        async def slow_completion(text, base_ai_probability, metrics):
+            calls.append(text)
+            await asyncio.sleep(0.2)
+            return 42.0
+        calibrator._complete = slow_completion
+        
+        async def scenario():
+            late = await asyncio.gather(*[
+                calibrator.calibrate(self.AI_TEXT, 60.0, {}, deadline=0.01) for _ in range(3)
+            ])
+            await asyncio.sleep(0.4)  # la llamada sigue en segundo plano y llena la caché
+            cached = await calibrator.calibrate(self.AI_TEXT, 60.0, {}, deadline=0.01)
+            return late, cached
+        
+        late, cached = asyncio.run(scenario())
+        assert late == [None, None, None]
+        assert cached == 42.0
+        assert len(calls) == 1
+
 class TestErrorHandling:
     """Test suite for error handling"""
     
@@ -1,6 +1,7 @@
 import type { 
   HumanizeRequest, 
   HumanizeResponse, 
+  Metrics,
   DetectRequest, 
   DetectResponse 
 } from '../types';
@@ -19,6 +20,7 @@ interface ProgressUpdate {
   total_steps?: number;
   phase?: string;
   partial?: string;
+  metrics?: Metrics | null;
 }
 
 // Función para humanizar texto con progreso
@@ -94,7 +96,8 @@ export async function humanizeText(
               step: data.step,
               total_steps: data.total_steps,
               phase: data.phase,
-              partial: data.partial
+              partial: data.partial,
+              metrics: data.metrics
             } as any);
           }
           
@@ -9,6 +9,7 @@ export interface HumanizeRequest {
   voice?: 'neutral' | 'collective';
   plan?: 'free' | 'basic' | 'pro' | 'ultra';
   max_words?: number;
+  diff_format?: 'tokens' | 'runs';
 }
 
 export interface DiffItem {
@@ -23,11 +24,26 @@ export interface Metrics {
   lix: number;
 }
 
+// [op, inicio, fin en el texto original, inicio, fin en result]
+export type DiffRun = ['insert' | 'delete' | 'equal', number, number, number, number];
+
+export interface DiffStats {
+  original_tokens: number;
+  rewritten_tokens: number;
+  equal_tokens: number;
+  inserted_tokens: number;
+  deleted_tokens: number;
+  changed_hunks: number;
+  similarity: number;
+}
+
 export interface HumanizeResponse {
   result: string;
   diff: DiffItem[];
   metrics: Metrics;
   alerts: string[];
+  diff_stats?: DiffStats | null;
+  diff_runs?: DiffRun[] | null;
 }
 
 // Tipos para el Detector de IA